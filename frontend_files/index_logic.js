@@ -171,6 +171,10 @@ async function appendMessage(message, options = {}) {
     nodeText.classList.add("message-text");
     nodeDiv.appendChild(nodeText);
 
+    if (!options.unconfirmed && typeof message.seq === "number" && !(message.seq <= lastReceivedSeq)) {
+        lastReceivedSeq = message.seq;
+    }
+
     if (options.start) {
         msgDiv.insertBefore(nodeDiv, msgDiv.firstChild);
         messagesBuffer.splice(0, 0, message);
@@ -194,31 +198,85 @@ function shouldHideHeader(message, lastMessage) {
 }
 
 
+async function prependMessages(messages) {
+    for (let i = messages.length - 1; i >= 0; i--) {
+        let message = messages[i];
+        await loadAccountMeta(message.author);
+
+        if (i > 0 && shouldHideHeader(message, messages[i - 1])) {
+            await appendMessage(message, {start: true, hideHeader: true});
+        } else {
+            await appendMessage(message, {start: true});
+        }
+    }
+}
+
+
 async function loadMessages(batchID) {
     loadingMessages = true;
     const url = fixLocalURL(`messages?batch=${batchID}`);
 
-    const resp = await fetch(url, {cache: 'no-cache'});
+    // Older batches may come from the browser cache; the latest one is always revalidated (see server.py)
+    const resp = await fetch(url);
     if (resp.ok) {
         const messages = await resp.json();
+        await prependMessages(messages);
+        loadingMessages = false;
+        currentBatchID--;
+        return;
+    }
+    console.warn(`Error to ${url}: ${resp.status} - ${resp.statusText}`);
+    console.log(`Error Message to ${url}:`, (await resp.json())['error']);
 
-        for (let i = messages.length - 1; i >= 0; i--) {
-            let message = messages[i];
-            await loadAccountMeta(message.author);
+}
 
-            if (i > 0 && shouldHideHeader(message, messages[i - 1])) {
-                await appendMessage(message, {start: true, hideHeader: true});
-            } else {
-                await appendMessage(message, {start: true});
-            }
+
+async function loadMessageBatches(firstBatchID, lastBatchID) {
+    // Loads several batches with one request
+    loadingMessages = true;
+    const url = fixLocalURL(`messages?batches=${firstBatchID}-${lastBatchID}`);
+
+    const resp = await fetch(url, {cache: 'no-cache'});
+    if (resp.ok) {
+        const batches = await resp.json();
+        for (let batchID = lastBatchID; batchID >= firstBatchID; batchID--) {
+            await prependMessages(batches[batchID] || []);
         }
         loadingMessages = false;
-        currentBatchID--;
+        currentBatchID = firstBatchID - 1;
         return;
     }
     console.warn(`Error to ${url}: ${resp.status} - ${resp.statusText}`);
     console.log(`Error Message to ${url}:`, (await resp.json())['error']);
+}
+
+
+async function loadMissedMessages() {
+    // Fetches the messages sent while the websocket was disconnected
+    let lastConfirmedMessage = null;
+    for (let i = messagesBuffer.length - 1; i >= 0; i--) {
+        if (messagesBuffer[i].tempID) continue;
+        lastConfirmedMessage = messagesBuffer[i];
+        break;
+    }
+    if (lastConfirmedMessage === null) return;
 
+    const url = fixLocalURL(`messages?since=${lastConfirmedMessage.timestamp}&limit=600`);
+    const resp = await fetch(url, {cache: 'no-cache'});
+    if (!resp.ok) {
+        console.warn(`Error to ${url}: ${resp.status} - ${resp.statusText}`);
+        return;
+    }
+
+    const response = await resp.json();
+    for (const message of response['messages']) {
+        // Messages from the same second as the last one might already be displayed
+        const alreadyDisplayed = messagesBuffer.some(other =>
+            other.timestamp === message.timestamp && other.author === message.author && other.text === message.text
+        );
+        if (alreadyDisplayed) continue;
+        await receiveMessage(message);
+    }
 }
 
 
@@ -263,17 +321,46 @@ async function loadChannelAbout() {
 }
 
 
-function connectWebSocket() {
+async function receiveMessage(message) {
+    let hideHeader = false;
+    let lastConfirmedMessage = null;
+    for (let i = messagesBuffer.length - 1; i >= 0; i--) {
+        if (messagesBuffer[i].tempID) continue;
+        lastConfirmedMessage = messagesBuffer[i];
+        break;
+    }
+    console.log(messagesBuffer.length, message, lastConfirmedMessage);
+    if (lastConfirmedMessage !== null) {
+        hideHeader = shouldHideHeader(message, lastConfirmedMessage);
+    }
+
+    await loadAccountMeta(message.author);
+    await appendMessage(message, {hideHeader: hideHeader});
+    if (typeof message.tempID !== "undefined") {
+        removeUnconfirmedMessage(message.tempID);
+    }
+}
+
+
+function connectWebSocket(reconnecting = false) {
     const sock = new WebSocket(`ws://${window.location.hostname}:8982`);
 
     sock.onopen = () => {
         console.log("[WS] Connection opened. Sent token and username.");
-        sock.send(`${token} ${username} ${channelID}`);
+        if (lastReceivedSeq !== null) {
+            // The server replays the messages after this one (or answers with "resync")
+            sock.send(`${token} ${username} ${channelID} ${lastReceivedSeq}`);
+        } else {
+            sock.send(`${token} ${username} ${channelID}`);
+            if (reconnecting) {
+                loadMissedMessages().then();
+            }
+        }
     };
 
     sock.onclose = event => {
         console.warn("[WS] Connection closed:", event);
-        setTimeout(connectWebSocket, 1000);
+        setTimeout(() => connectWebSocket(true), 1000);
     }
 
     sock.onmessage = async event => {
@@ -282,26 +369,21 @@ function connectWebSocket() {
             console.warn("[WS] Received error:", response['error']);
             return;
         }
-
-        console.log("[WS] Received message:", response);
-
-        let hideHeader = false;
-        let lastConfirmedMessage = null;
-        for (let i = messagesBuffer.length - 1; i >= 0; i--) {
-            if (messagesBuffer[i].tempID) continue;
-            lastConfirmedMessage = messagesBuffer[i];
-            break;
+        if (response['resync']) {
+            console.log("[WS] Missed messages can't be replayed, loading them.");
+            await loadMissedMessages();
+            return;
         }
-        console.log(messagesBuffer.length, response, lastConfirmedMessage);
-        if (lastConfirmedMessage !== null) {
-            hideHeader = shouldHideHeader(response, lastConfirmedMessage);
+        if (typeof response.seq === "number" && response.seq <= lastReceivedSeq) {
+            // Already loaded over HTTP
+            if (typeof response.tempID !== "undefined") {
+                removeUnconfirmedMessage(response.tempID);
+            }
+            return;
         }
 
-        await loadAccountMeta(response.author);
-        await appendMessage(response, {hideHeader: hideHeader});
-        if (typeof response.tempID !== "undefined") {
-            removeUnconfirmedMessage(response.tempID);
-        }
+        console.log("[WS] Received message:", response);
+        await receiveMessage(response);
     }
 
     let token = getCookie("token");
@@ -371,7 +453,7 @@ function deleteAccount() {
     const xhr = new XMLHttpRequest();
 
     xhr.onreadystatechange = () => {
-        if (xhr.readyState === 4 && xhr.status === 200) {
+        if (xhr.readyState === 4 && xhr.status === 202) {
             let response = JSON.parse(xhr.responseText);
             console.log("Response to /delete_account:", response);
             alert("Your account was deleted.");
@@ -586,7 +668,7 @@ function deleteChannel() {
     xhr.onreadystatechange = () => {
         if (xhr.readyState !== 4) return;
 
-        if (xhr.status === 200) {
+        if (xhr.status === 202) {
             let response = JSON.parse(xhr.responseText);
             console.log("Response to /delete_channel:", response);
             let channelID = response['channelID'];
@@ -733,6 +815,7 @@ window.onload = async () => {
     selfDisplayname = null;
     loadingMessages = true;
     messagesBuffer = [];
+    lastReceivedSeq = null;     // sequence number of the newest message, to resume the websocket from
     channelKey = null;
     channelKeyIV = null;
 
@@ -758,9 +841,8 @@ window.onload = async () => {
     await loadSelfChannels();
 
     console.log("Self channels loaded. Loading message history.")
-    for (let i = 0; i < 2; i++) {
-        if (currentBatchID < 1) break;
-        await loadMessages(currentBatchID);
+    if (currentBatchID >= 1) {
+        await loadMessageBatches(Math.max(1, currentBatchID - 1), currentBatchID);
     }
 
     console.log("Message history loaded. Connecting WebSocket and initializing scroller.");
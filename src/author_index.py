@@ -0,0 +1,114 @@
+"""Per-user index of the batches a user wrote messages in, for the JSON storage (`accounts/<user>/messages.idx`).
+
+Deleting an account or exporting a user's data only has to look at these batches instead of every batch
+of every channel. The file is append-only: one `ENTRY` per (channel, batch) pair, written before the user's first
+message in that batch is stored (see `JSONStorage.messages_storing`). Entries are never removed, so some may point
+to batches without messages of the user (deleted since, or never written) or to channels which don't exist anymore;
+readers filter by author anyway.
+
+Accounts created before the index existed have no index file. Nothing is recorded for them (the index would be
+incomplete), so they fall back to scanning every batch; `migrate.py index` builds their index files.
+"""
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+import metrics
+import tracing
+from durable_writes import DurableWriter
+from file_locks import PathLocks
+
+# Channel ID (decimal string stored as integer) and batch ID
+ENTRY = struct.Struct("<QI")
+
+
+class AuthorIndex:
+    """Reads and appends to the index files. The entries of the `max_cached_users` most recently used
+    users are kept in memory, so sending a message only touches the file when it starts a new batch."""
+
+    def __init__(self, accounts_dir: str, locks: PathLocks, writer: DurableWriter, max_cached_users: int = 4096) -> None:
+        self.accounts_dir = accounts_dir
+        self.locks = locks
+        self.writer = writer
+        self.max_cached_users = max_cached_users
+        self._cache: OrderedDict[str, set[tuple[int, int]] | None] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def index_file(self, username: str) -> str:
+        return os.path.join(self.accounts_dir, username, "messages.idx")
+
+    def create(self, username: str) -> None:
+        """Creates the (empty) index of a new account."""
+        index_file = self.index_file(username)
+        with self.locks.hold(index_file):
+            self.writer.write_bytes(index_file, b"")
+            self._store(username, set())
+
+    def add(self, username: str, channel_id: str, batch_id: int) -> None:
+        """Records that `username` wrote a message in a batch. Raises `OSError` if the index can't be written."""
+        entry = (int(channel_id), batch_id)
+        index_file = self.index_file(username)
+
+        with self.locks.hold(index_file):
+            recorded = self._load(username)
+            if recorded is None or entry in recorded:
+                return
+
+            with tracing.span("file_write"), open(index_file, 'ab') as file:
+                file.write(ENTRY.pack(*entry))
+                self.writer.sync_file(file)
+            metrics.record_write("append", ENTRY.size)
+            recorded.add(entry)
+
+    def batches(self, username: str) -> dict[str, list[int]] | None:
+        """Returns the IDs of the batches the user wrote messages in, by channel ID (sorted),
+        or None if the account has no index."""
+        with self.locks.hold(self.index_file(username)):
+            recorded = self._load(username)
+            if recorded is None:
+                return None
+
+            batches: dict[str, list[int]] = {}
+            for channel_id, batch_id in sorted(recorded):
+                batches.setdefault(str(channel_id), []).append(batch_id)
+            return batches
+
+    def remove(self, username: str) -> None:
+        """Deletes the index of a purged account."""
+        index_file = self.index_file(username)
+        with self.locks.hold(index_file):
+            try:
+                os.remove(index_file)
+            except FileNotFoundError:
+                pass
+            self._store(username, None)
+
+    def _load(self, username: str) -> set[tuple[int, int]] | None:
+        """Must be called with the lock of the index file held."""
+        with self._lock:
+            if username in self._cache:
+                self._cache.move_to_end(username)
+                return self._cache[username]
+
+        try:
+            with tracing.span("file_read"), open(self.index_file(username), 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            recorded = None
+        else:
+            metrics.record_read("author_index", len(data))
+            # A crash in the middle of an append can leave half an entry at the end
+            usable_size = len(data) - len(data) % ENTRY.size
+            if usable_size != len(data):
+                os.truncate(self.index_file(username), usable_size)
+            recorded = set(ENTRY.iter_unpack(memoryview(data)[:usable_size]))
+        self._store(username, recorded)
+        return recorded
+
+    def _store(self, username: str, recorded: set[tuple[int, int]] | None) -> None:
+        with self._lock:
+            self._cache[username] = recorded
+            self._cache.move_to_end(username)
+            while len(self._cache) > self.max_cached_users:
+                self._cache.popitem(last=False)
@@ -0,0 +1,591 @@
+#!/usr/bin/python
+"""Load test of the HTTP and websocket endpoints, against a server started just for it.
+
+    python benchmark.py                                  every workload with the default sizes
+    python benchmark.py send history --rate 200          only some of them
+    python benchmark.py --output before.json             ... and compare the files of two runs
+    python benchmark.py --server-args "--storage sqlite --concurrency asyncio"
+
+`server.py` is started on free ports with a temporary backend directory (deleted afterwards, unless `--keep`),
+seeded with `--users` accounts, `--channels` channels and `--batches` full message batches per channel,
+and then put under these workloads, one after another:
+
+    login      a login storm: `--workers` clients log in as random users as fast as they can
+    send       messages are sent at `--rate` per second while `--listeners` websocket clients per channel receive
+               them. The load is open loop: a message which is sent late because the server is behind counts
+               from when it should have been sent. Also reports the fan-out latency, from sending to receiving.
+    history    `--workers` clients scroll through the history of random channels (`/channels/<id>/messages?batch=`)
+    delete     `--deletions` accounts which wrote messages are deleted; also reports the time until they are purged
+
+The results are printed as JSON (and written to `--output`): per workload the throughput, the latency percentiles
+in milliseconds and the status codes (503 and 429 are results as well: the server shedding load).
+The clients run in this process, on the same machine as the server, so only compare runs on the same machine.
+"""
+import argparse
+import asyncio
+import http.client
+import itertools
+import json
+import math
+import os
+import random
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+import websockets
+
+from message_store import MESSAGE_BATCH_SIZE
+
+WORKLOADS = ("login", "send", "history", "delete")
+PASSWORD = "benchmark-password"
+PUBLIC_KEY = "A" * 64       # the server only stores it
+SERVER_START_TIMEOUT = 15
+FAN_OUT_TIMEOUT = 10        # seconds the listeners may take to receive the last messages
+PURGE_TIMEOUT = 60
+
+
+class BenchmarkError(Exception): ...
+
+
+class Session(NamedTuple):
+    username: str
+    token: str
+
+
+class Client:
+    """One keep-alive HTTP connection. http.client reconnects by itself when the server closed the connection."""
+
+    def __init__(self, port: int) -> None:
+        self.connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+
+    def request(self, method: str, path: str, body: dict = None, session: Session = None) -> tuple[int, bytes]:
+        headers = {}
+        if session is not None:
+            headers['Cookie'] = f"username={session.username}; token={session.token}"
+        data = None
+        if body is not None:
+            data = bytes(json.dumps(body), "utf-8")
+            headers['Content-Type'] = "application/json"
+        try:
+            self.connection.request(method, path, data, headers)
+            response = self.connection.getresponse()
+            return response.status, response.read()
+        except (http.client.HTTPException, OSError):
+            self.connection.close()
+            raise
+
+    def expect(self, method: str, path: str, body: dict = None, session: Session = None, attempts: int = 20) -> dict:
+        """For seeding: retries while the server is busy (503/429), raises `BenchmarkError` for any other error."""
+        for attempt in range(attempts):
+            status, raw = self.request(method, path, body, session)
+            if status in (200, 202):
+                return json.loads(raw)
+            if status not in (429, 503):
+                break
+            time.sleep(0.05 * (attempt + 1))
+        raise BenchmarkError(f"{method} {path} failed: {status} {raw[:200]!r}")
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def percentiles(seconds: list[float]) -> dict:
+    """Latency summary in milliseconds (nearest rank)."""
+    if not seconds:
+        return {}
+    ordered = sorted(seconds)
+
+    def rank(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, math.ceil(q * len(ordered)) - 1)] * 1000, 2)
+
+    return {
+        "p50": rank(0.5), "p90": rank(0.9), "p99": rank(0.99), "max": round(ordered[-1] * 1000, 2),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 2),
+    }
+
+
+class Recorder:
+    """Latencies and status codes of the requests of one workload."""
+
+    def __init__(self) -> None:
+        self.latencies: list[float] = []
+        self.statuses: dict[str, int] = {}
+        self.started = time.perf_counter()
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def request(self, client: Client, method: str, path: str, body: dict = None, session: Session = None,
+                started: float = None) -> tuple[int | None, bytes | None]:
+        """Sends a request and records it, timed from `started` (default: now). Returns None for failed connections."""
+        started = time.perf_counter() if started is None else started
+        try:
+            status, raw = client.request(method, path, body, session)
+        except (http.client.HTTPException, OSError):
+            status, raw = None, None
+        latency = time.perf_counter() - started
+        with self._lock:
+            self.latencies.append(latency)
+            key = "connectionError" if status is None else str(status)
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+        return status, raw
+
+    def finish(self) -> None:
+        self.finished = time.perf_counter()
+
+    def result(self) -> dict:
+        duration = (self.finished or time.perf_counter()) - self.started
+        return {
+            "requests": len(self.latencies),
+            "seconds": round(duration, 3),
+            "throughput": round(len(self.latencies) / duration, 1) if duration > 0 else None,
+            "latencyMs": percentiles(self.latencies),
+            "statusCodes": dict(sorted(self.statuses.items())),
+        }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def username_for(index: int) -> str:
+    """bench-a, bench-b, ..., bench-ba, ... (usernames may only contain a-z, - and _)."""
+    letters = ""
+    while True:
+        index, digit = divmod(index, 26)
+        letters = chr(ord("a") + digit) + letters
+        if index == 0:
+            return "bench-" + letters
+
+
+class ServerProcess:
+    """`server.py` with its own ports and backend directory; its output goes to `server.log` in that directory."""
+
+    def __init__(self, backend_dir: str, server_args: list[str]) -> None:
+        self.backend_dir = backend_dir
+        self.server_args = server_args
+        self.port = free_port()
+        self.ws_port = free_port()
+        self.log_path = os.path.join(backend_dir, "server.log")
+        self.process: subprocess.Popen | None = None
+
+    def start(self) -> None:
+        for directory in ("accounts", "channels"):
+            os.makedirs(os.path.join(self.backend_dir, directory), exist_ok=True)
+        command = [
+            sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"),
+            "--port", str(self.port), "--ws-port", str(self.ws_port), "--backend-dir", self.backend_dir,
+            # the login storm would just measure the rate limiter otherwise
+            "--login-attempts-per-user", "0", "--login-attempts-per-ip", "0",
+            "--log-level", "warning",
+            *self.server_args,
+        ]
+        with open(self.log_path, 'wb') as log_file:
+            self.process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT)
+
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise BenchmarkError(f"The server exited with code {self.process.returncode}:\n{self.log_tail()}")
+            try:
+                with socket.create_connection(("127.0.0.1", self.ws_port), timeout=1):
+                    pass
+                status, _ = Client(self.port).request("GET", "/server_stats")
+                if status == 200:
+                    return
+            except OSError:
+                pass
+            time.sleep(0.1)
+        raise BenchmarkError(f"The server didn't start within {SERVER_START_TIMEOUT} seconds:\n{self.log_tail()}")
+
+    def stop(self) -> None:
+        """Stops the server like Ctrl+C would, so it closes the storage properly."""
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.send_signal(signal.SIGINT if os.name == "posix" else signal.SIGTERM)
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def log_tail(self, lines: int = 20) -> str:
+        with open(self.log_path, 'r', errors="replace") as log_file:
+            return "".join(log_file.readlines()[-lines:])
+
+
+class Seed(NamedTuple):
+    sessions: dict[str, Session]        # username -> the newest session; updated by the login storm
+    channels: dict[str, list[str]]      # channel ID -> members
+    seconds: float
+
+
+def run_parallel(workers: int, function, items) -> list:
+    with ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(function, items))
+
+
+def seed(port: int, args) -> Seed:
+    started = time.perf_counter()
+    clients = threading.local()
+
+    def client() -> Client:
+        if not hasattr(clients, "client"):
+            clients.client = Client(port)
+        return clients.client
+
+    def register(username: str) -> Session:
+        response = client().expect("POST", "/register", {
+            "username": username, "displayname": username, "password": PASSWORD, "publicKey": PUBLIC_KEY
+        })
+        return Session(username, response['generatedToken'])
+
+    usernames = [username_for(index) for index in range(args.users)]
+    sessions = {session.username: session for session in run_parallel(args.workers, register, usernames)}
+
+    # Every channel needs a distinct member per websocket listener (another connection of the same user
+    # replaces the first one), and at least two members
+    member_count = min(args.users, max(args.listeners, 2))
+
+    def create_channel(index: int) -> tuple[str, list[str]]:
+        members = [usernames[(index + offset) % args.users] for offset in range(member_count)]
+        creator = sessions[members[0]]
+        response = client().expect("POST", "/create_channel", {
+            "channelName": f"benchmark {index}", "encryptedChannelKey": "key", "iv": "iv"
+        }, creator)
+        for member in members[1:]:
+            client().expect("POST", "/add_member_to_channel", {
+                "channelID": response['channelID'], "newMember": member, "encryptedChannelKey": "key", "iv": "iv"
+            }, creator)
+        return response['channelID'], members
+
+    channels = dict(run_parallel(args.workers, create_channel, range(args.channels)))
+
+    def send_message(item: tuple[str, int]):
+        channel_id, number = item
+        author = sessions[channels[channel_id][number % len(channels[channel_id])]]
+        client().expect("POST", "/send_message", {
+            "text": f"seed message {number}", "channel": channel_id, "tempID": str(number)
+        }, author)
+
+    run_parallel(args.workers, send_message, [
+        (channel_id, number) for number in range(args.batches * MESSAGE_BATCH_SIZE) for channel_id in channels
+    ])
+    return Seed(sessions, channels, time.perf_counter() - started)
+
+
+def run_for(duration: float, workers: int, port: int, work) -> Recorder:
+    """Closed loop: every worker calls `work(client, recorder)` again and again for `duration` seconds."""
+    recorder = Recorder()
+    deadline = time.perf_counter() + duration
+
+    def worker(_):
+        client = Client(port)
+        try:
+            while time.perf_counter() < deadline:
+                work(client, recorder)
+        finally:
+            client.close()
+
+    run_parallel(workers, worker, range(workers))
+    recorder.finish()
+    return recorder
+
+
+def login_storm(port: int, data: Seed, args) -> dict:
+    usernames = list(data.sessions)
+
+    def login(client: Client, recorder: Recorder):
+        username = random.choice(usernames)
+        status, raw = recorder.request(client, "POST", "/login", {"username": username, "password": PASSWORD})
+        if status == 200:
+            # Every login adds a session and the oldest ones get logged out, so keep using the newest
+            data.sessions[username] = Session(username, json.loads(raw)['generatedToken'])
+
+    return run_for(args.duration, args.workers, port, login).result()
+
+
+def history(port: int, data: Seed, args) -> dict:
+    client = Client(port)
+    latest_batches = {}
+    for channel_id, members in data.channels.items():
+        about = client.expect("GET", f"/channels/{channel_id}/about", session=data.sessions[members[0]])
+        latest_batches[channel_id] = about['latestMessageBatch']
+    client.close()
+    channel_ids = list(data.channels)
+
+    def scroll(client: Client, recorder: Recorder):
+        channel_id = random.choice(channel_ids)
+        session = data.sessions[random.choice(data.channels[channel_id])]
+        batch_id = random.randint(1, max(1, latest_batches[channel_id]))
+        recorder.request(client, "GET", f"/channels/{channel_id}/messages?batch={batch_id}", session=session)
+
+    return run_for(args.duration, args.workers, port, scroll).result()
+
+
+class Listeners:
+    """The websocket clients of the send workload, on an event loop of their own. Messages of the workload
+    carry their send time ("benchmark <time.time()>"), from which the fan-out latency is measured."""
+
+    def __init__(self, ws_port: int, data: Seed, per_channel: int) -> None:
+        self.ws_port = ws_port
+        self.subscriptions = [
+            (data.sessions[member], channel_id)
+            for channel_id, members in data.channels.items() for member in members[:per_channel]
+        ]
+        self.latencies: list[float] = []
+        self.warmed_up: set[int] = set()   # listeners which received a warm-up message
+        self.errors: list[str] = []
+        self.loop = asyncio.new_event_loop()
+        self._stopped: asyncio.Event | None = None
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result(30)
+
+    async def _start(self) -> None:
+        self._stopped = asyncio.Event()
+        connected = [asyncio.get_running_loop().create_future() for _ in self.subscriptions]
+        for index, (session, channel_id) in enumerate(self.subscriptions):
+            asyncio.create_task(self._listen(index, session, channel_id, connected[index]))
+        await asyncio.gather(*connected)
+
+    async def _listen(self, index: int, session: Session, channel_id: str, connected: asyncio.Future) -> None:
+        try:
+            async with websockets.connect(f"ws://127.0.0.1:{self.ws_port}", max_queue=None) as sock:
+                await sock.send(f"{session.token} {session.username} {channel_id}")
+                connected.set_result(None)
+                receiving = asyncio.create_task(self._receive(index, sock))
+                await self._stopped.wait()
+                receiving.cancel()
+        except (OSError, websockets.ConnectionClosed) as e:
+            self.errors.append(f"{type(e).__name__}: {e}")
+            if not connected.done():
+                connected.set_result(None)
+
+    async def _receive(self, index: int, sock) -> None:
+        async for raw in sock:
+            received = time.time()
+            message = json.loads(raw)
+            if "error" in message:
+                self.errors.append(message['error'])
+                continue
+            if message['text'].startswith("benchmark "):
+                self.latencies.append(received - float(message['text'].removeprefix("benchmark ")))
+            elif message['text'] == "warm-up":
+                self.warmed_up.add(index)
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self._stopped.set)
+        time.sleep(0.2)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(5)
+
+
+def send_messages(port: int, ws_port: int, data: Seed, args) -> dict:
+    listeners = Listeners(ws_port, data, args.listeners)
+    listeners.start()
+    try:
+        # Subscribing isn't acknowledged; a message every listener received shows they are all subscribed
+        client = Client(port)
+        deadline = time.monotonic() + FAN_OUT_TIMEOUT
+        while len(listeners.warmed_up) < len(listeners.subscriptions) and time.monotonic() < deadline:
+            for channel_id, members in data.channels.items():
+                client.expect("POST", "/send_message", {
+                    "text": "warm-up", "channel": channel_id, "tempID": "warm-up"
+                }, data.sessions[members[0]])
+            time.sleep(0.2)
+        client.close()
+        if len(listeners.warmed_up) < len(listeners.subscriptions):
+            raise BenchmarkError(
+                f"Only {len(listeners.warmed_up)} of {len(listeners.subscriptions)} websocket listeners subscribed: "
+                f"{listeners.errors[:3]}"
+            )
+
+        # Open loop: message i is due at `start + i / rate`, no matter how long the earlier ones took
+        total = int(args.rate * args.duration)
+        channel_ids = list(data.channels)
+        indexes = itertools.count()
+        recorder = Recorder()
+        start = recorder.started
+
+        def worker(_):
+            client = Client(port)
+            try:
+                for index in indexes:
+                    if index >= total:
+                        return
+                    due = start + index / args.rate
+                    delay = due - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    channel_id = random.choice(channel_ids)
+                    session = data.sessions[random.choice(data.channels[channel_id])]
+                    recorder.request(client, "POST", "/send_message", {
+                        "text": f"benchmark {time.time()}", "channel": channel_id, "tempID": str(index)
+                    }, session, started=due)
+            finally:
+                client.close()
+
+        run_parallel(args.workers, worker, range(args.workers))
+        recorder.finish()
+
+        expected = recorder.statuses.get("200", 0) * args.listeners
+        deadline = time.monotonic() + FAN_OUT_TIMEOUT
+        while len(listeners.latencies) < expected and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        listeners.stop()
+
+    return dict(recorder.result(), targetRate=args.rate, fanOut={
+        "listeners": len(listeners.subscriptions),
+        "expected": expected,
+        "received": len(listeners.latencies),
+        "latencyMs": percentiles(listeners.latencies),
+    })
+
+
+def delete_accounts(port: int, data: Seed, args) -> dict:
+    """Accounts which each wrote a third of a batch in one of the channels are deleted at once."""
+    channel_ids = list(data.channels)
+    clients = threading.local()
+
+    def client() -> Client:
+        if not hasattr(clients, "client"):
+            clients.client = Client(port)
+        return clients.client
+
+    def prepare(index: int) -> Session:
+        username = username_for(args.users + index)
+        response = client().expect("POST", "/register", {
+            "username": username, "displayname": username, "password": PASSWORD, "publicKey": PUBLIC_KEY
+        })
+        session = Session(username, response['generatedToken'])
+        channel_id = channel_ids[index % len(channel_ids)]
+        client().expect("POST", "/add_member_to_channel", {
+            "channelID": channel_id, "newMember": username, "encryptedChannelKey": "key", "iv": "iv"
+        }, data.sessions[data.channels[channel_id][0]])
+        for number in range(MESSAGE_BATCH_SIZE // 3):
+            client().expect("POST", "/send_message", {
+                "text": f"to be deleted {number}", "channel": channel_id, "tempID": str(number)
+            }, session)
+        return session
+
+    victims = run_parallel(args.workers, prepare, range(args.deletions))
+
+    recorder = Recorder()
+    purge_latencies = []
+    purge_failures = [0]
+    lock = threading.Lock()
+
+    def delete(session: Session):
+        started = time.perf_counter()
+        status, raw = recorder.request(client(), "POST", "/delete_account", session=session)
+        if status not in (200, 202):
+            return
+        job_id = json.loads(raw).get('jobID')
+        deadline = started + PURGE_TIMEOUT
+        job_status = "done" if job_id is None else "queued"   # 200: deleted right away
+        while job_status not in ("done", "failed") and time.perf_counter() < deadline:
+            time.sleep(0.02)
+            status, raw = client().request("GET", f"/jobs/{job_id}")
+            if status == 200:
+                job_status = json.loads(raw)['status']
+        with lock:
+            if job_status == "done":
+                purge_latencies.append(time.perf_counter() - started)
+            else:
+                purge_failures[0] += 1
+
+    run_parallel(args.workers, delete, victims)
+    recorder.finish()
+    return dict(recorder.result(), purge={"latencyMs": percentiles(purge_latencies), "failed": purge_failures[0]})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pigon Messenger load test")
+    parser.add_argument(
+        "workloads", nargs="*", metavar="WORKLOAD",
+        help=f"which workloads to run, in this order: {', '.join(WORKLOADS)} (default: all)"
+    )
+    parser.add_argument("--users", type=int, default=50, help="accounts to seed")
+    parser.add_argument("--channels", type=int, default=5, help="channels to seed")
+    parser.add_argument("--batches", type=int, default=10, help=f"full message batches ({MESSAGE_BATCH_SIZE} messages) per channel")
+    parser.add_argument("--listeners", type=int, default=5, help="websocket listeners per channel during 'send'")
+    parser.add_argument("--rate", type=float, default=100, help="messages per second during 'send'")
+    parser.add_argument("--deletions", type=int, default=10, help="accounts deleted during 'delete'")
+    parser.add_argument("--duration", type=float, default=10, help="seconds the login, send and history workloads run")
+    parser.add_argument("--workers", type=int, default=8, help="concurrent HTTP clients")
+    parser.add_argument("--server-args", default="", help="more arguments for server.py, e.g. \"--storage sqlite\"")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--keep", action="store_true", help="keep the backend directory (and the server log)")
+    args = parser.parse_args()
+    args.workloads = args.workloads or list(WORKLOADS)
+    unknown = [workload for workload in args.workloads if workload not in WORKLOADS]
+    if unknown:
+        parser.error(f"unknown workloads {', '.join(unknown)} (choose from {', '.join(WORKLOADS)})")
+    if args.users < 2 or args.channels < 1 or args.listeners > args.users:
+        parser.error("needs at least 2 users and 1 channel, and at least as many users as listeners per channel")
+
+    backend_dir = tempfile.mkdtemp(prefix="pigon-benchmark-")
+    server = ServerProcess(backend_dir, shlex.split(args.server_args))
+    results = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "serverArgs": server.server_args,
+        "python": sys.version.split()[0],
+        "seed": {"users": args.users, "channels": args.channels, "batches": args.batches},
+        "workloads": {},
+    }
+    try:
+        server.start()
+        print(f"Seeding {args.users} users, {args.channels} channels, {args.batches} batches per channel...", file=sys.stderr)
+        data = seed(server.port, args)
+        results['seed']['seconds'] = round(data.seconds, 3)
+
+        for workload in args.workloads:
+            print(f"Running {workload}...", file=sys.stderr)
+            if workload == "login":
+                results['workloads'][workload] = login_storm(server.port, data, args)
+            elif workload == "send":
+                results['workloads'][workload] = send_messages(server.port, server.ws_port, data, args)
+            elif workload == "history":
+                results['workloads'][workload] = history(server.port, data, args)
+            elif workload == "delete":
+                results['workloads'][workload] = delete_accounts(server.port, data, args)
+
+        client = Client(server.port)
+        status, raw = client.request("GET", "/server_stats")
+        client.close()
+        if status == 200:
+            results['serverStats'] = json.loads(raw)
+
+    except BenchmarkError as e:
+        print(f"Benchmark failed: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        server.stop()
+        if args.keep:
+            print(f"Kept {backend_dir}", file=sys.stderr)
+        else:
+            shutil.rmtree(backend_dir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Atomic file writes with a configurable durability mode.
+
+Files are never rewritten in place: the new content goes into a temporary file next to the target,
+which then replaces the target with `os.replace`. Readers (and a crash) see either the old or the new file,
+never a truncated one. How much is flushed to the disk before a write returns depends on the mode:
+
+- "none": nothing; the OS writes the data back whenever it wants. A power loss can lose recent writes.
+- "fsync-file": the file content is fsynced before it replaces the target.
+- "fsync-dir": additionally the directory is fsynced after the replace, so the rename itself is durable.
+- "group-commit": nothing is fsynced while writing; a background thread fsyncs everything written since its
+  last run every `group_commit_interval` seconds. A power loss can lose the writes of the last interval,
+  and depending on the file system a replaced file can then be empty.
+"""
+import json
+import os
+import threading
+
+import metrics
+import tracing
+
+DURABILITY_MODES = ("none", "fsync-file", "fsync-dir", "group-commit")
+
+
+class DurableWriter:
+    """Writes files atomically and fsyncs them according to `mode`. One instance is shared by all stores."""
+
+    def __init__(self, mode: str = "fsync-file", group_commit_interval: float = 1.0) -> None:
+        self.mode = "none"
+        self.group_commit_interval = group_commit_interval
+        self._pending_files: set[str] = set()
+        self._pending_dirs: set[str] = set()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher: threading.Thread | None = None
+        self.set_mode(mode)
+
+    def set_mode(self, mode: str) -> None:
+        if mode not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode {mode!r}")
+        self.mode = mode
+        if mode == "group-commit" and self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, name="group-commit", daemon=True)
+            self._flusher.start()
+
+    def write_bytes(self, file_path: str, data: bytes) -> None:
+        """Replaces the content of `file_path` atomically. Raises `OSError` if writing fails;
+        the target is left untouched then."""
+        temp_path = f"{file_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        try:
+            with tracing.span("file_write"):
+                with open(temp_path, 'wb') as file:
+                    file.write(data)
+                    metrics.record_write("replace", len(data))
+                    if self.mode in ("fsync-file", "fsync-dir"):
+                        file.flush()
+                        os.fsync(file.fileno())
+                self.replace(temp_path, file_path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+    def write_json(self, file_path: str, obj) -> None:
+        self.write_bytes(file_path, bytes(json.dumps(obj), "utf8"))
+
+    def replace(self, temp_path: str, file_path: str) -> None:
+        """Moves a completely written (and, if the mode asks for it, fsynced) file into place."""
+        os.replace(temp_path, file_path)
+        if self.mode == "fsync-dir":
+            self._fsync_dir(os.path.dirname(file_path))
+        elif self.mode == "group-commit":
+            with self._lock:
+                self._pending_files.add(file_path)
+                self._pending_dirs.add(os.path.dirname(file_path))
+
+    def sync_file(self, file) -> None:
+        """Makes what was written to an open file durable according to the mode.
+        For files which are changed in place instead of being replaced, e.g. appended to."""
+        if self.mode == "none":
+            return
+        file.flush()
+        if self.mode == "group-commit":
+            with self._lock:
+                self._pending_files.add(file.name)
+            return
+        os.fsync(file.fileno())
+
+    def sync(self) -> None:
+        """Fsyncs everything the group commit is still waiting for."""
+        with self._lock:
+            files, self._pending_files = self._pending_files, set()
+            dirs, self._pending_dirs = self._pending_dirs, set()
+
+        for file_path in files:
+            try:
+                with open(file_path, 'rb') as file:
+                    os.fsync(file.fileno())
+            except OSError:   # deleted in the meantime
+                pass
+        for dir_path in dirs:
+            try:
+                self._fsync_dir(dir_path)
+            except OSError:
+                pass
+
+    def close(self) -> None:
+        """Stops the group commit thread after a last sync."""
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.sync()
+
+    def _flush_loop(self) -> None:
+        while not self._closed.wait(self.group_commit_interval):
+            self.sync()
+
+    @staticmethod
+    def _fsync_dir(dir_path: str) -> None:
+        if os.name == "nt":   # directories can't be opened (nor need to be fsynced) on Windows
+            return
+        fd = os.open(dir_path or ".", os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -0,0 +1,44 @@
+"""Per-file locking for the backend files, so concurrent requests don't write the same file at the same time."""
+import os
+import threading
+from contextlib import contextmanager
+
+
+class PathLocks:
+    """Hands out one reentrant lock per file path.
+    Locks are created on demand and forgotten again when no thread holds or waits for them."""
+
+    def __init__(self) -> None:
+        self._locks: dict[str, list] = {}   # path -> [lock, number of threads holding or waiting for it]
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, *file_paths: str):
+        """Locks all given paths. They are always acquired in sorted order, so two threads locking
+        overlapping sets of files can't deadlock each other."""
+        keys = sorted({os.path.normpath(file_path) for file_path in file_paths})
+
+        with self._lock:
+            locks = []
+            for key in keys:
+                entry = self._locks.get(key)
+                if entry is None:
+                    entry = self._locks[key] = [threading.RLock(), 0]
+                entry[1] += 1
+                locks.append(entry[0])
+
+        acquired = []
+        try:
+            for lock in locks:
+                lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+            with self._lock:
+                for key in keys:
+                    entry = self._locks[key]
+                    entry[1] -= 1
+                    if entry[1] == 0:
+                        del self._locks[key]
@@ -0,0 +1,196 @@
+"""Persistent background jobs, for work too slow to do while a client waits (e.g. purging a deleted account).
+
+Every job is a JSON file in `jobs_dir`, rewritten whenever its status changes:
+
+    {"id": ..., "kind": "delete_account", "args": {"username": ...}, "status": "queued", "attempts": 0, ...}
+
+A job is "queued", "running", "done" or "failed". Jobs which fail are retried with exponential backoff until
+`max_attempts` attempts failed. When the server starts, every job that is not finished is queued again,
+including those which were running when the server stopped, so job functions must be idempotent:
+running a job again after it was interrupted (or even after it finished) has to be harmless.
+Finished jobs are kept for `retention` seconds, so clients can look up their status.
+"""
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+from typing import Callable
+
+import logs
+from durable_writes import DurableWriter
+
+JOB_STATUSES = ("queued", "running", "done", "failed")
+
+log = logs.get_logger("jobs")
+
+
+class UnknownJobKindError(Exception): ...
+
+
+class JobQueue:
+    """Runs the jobs on `workers` threads. `handlers` maps the job kinds to the functions doing the work;
+    they are called with the arguments of the job as keyword arguments."""
+
+    def __init__(
+            self,
+            jobs_dir: str,
+            writer: DurableWriter,
+            handlers: dict[str, Callable[..., None]],
+            workers: int,
+            max_attempts: int = 5,
+            retry_delay: float = 1.0,
+            retention: float = 60 * 60 * 24
+    ) -> None:
+        self.jobs_dir = jobs_dir
+        self.writer = writer
+        self.handlers = handlers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.retention = retention
+        self._jobs: dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._queue: queue.Queue[str | None] = queue.Queue()
+        self._closed = threading.Event()
+        self._threads = [
+            threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True) for i in range(workers)
+        ]
+
+    def start(self) -> None:
+        """Loads the jobs left over from the last run, queues the unfinished ones and starts the workers."""
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        for name in os.listdir(self.jobs_dir):
+            if not name.endswith(".json"):   # e.g. a temporary file of an interrupted write
+                continue
+            job = self._read_job(os.path.join(self.jobs_dir, name))
+            if job is None:
+                continue
+            self._jobs[job['id']] = job
+            if job['status'] in ("queued", "running"):
+                job['status'] = "queued"
+                self._queue.put(job['id'])
+
+        with self._lock:
+            self._prune()
+        log.info("resumed", queued=self._queue.qsize())
+
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, kind: str, **args) -> dict:
+        """Queues a job and returns a copy of it. If the same job is queued or running already, that one is returned.
+        Raises `OSError` if the job can't be saved."""
+        if kind not in self.handlers:
+            raise UnknownJobKindError(kind)
+
+        with self._lock:
+            for job in self._jobs.values():
+                if job['kind'] == kind and job['args'] == args and job['status'] in ("queued", "running"):
+                    return dict(job)
+
+            job = {
+                "id": secrets.token_hex(16),
+                "kind": kind,
+                "args": args,
+                "status": "queued",
+                "attempts": 0,
+                "error": None,
+                "created": time.time(),
+                "finished": None,
+            }
+            # Saved before it is queued: once a job was accepted, it has to survive a restart
+            self.writer.write_json(self._job_file(job['id']), job)
+            self._jobs[job['id']] = job
+
+        self._queue.put(job['id'])
+        return dict(job)
+
+    def get(self, job_id: str) -> dict | None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return None if job is None else dict(job)
+
+    def close(self) -> None:
+        """Stops the workers once they finished their current job. Jobs still queued run after the next start."""
+        self._closed.set()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            if thread.is_alive():
+                thread.join()
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = dict.fromkeys(JOB_STATUSES, 0)
+            for job in self._jobs.values():
+                counts[job['status']] += 1
+            return counts
+
+    def _work(self) -> None:
+        while True:
+            job_id = self._queue.get()
+            if job_id is None or self._closed.is_set():
+                return
+
+            with self._lock:
+                job = self._jobs[job_id]
+                job['status'] = "running"
+                job['attempts'] += 1
+                args = dict(job['args'])
+                self._save(job)
+
+            try:
+                self.handlers[job['kind']](**args)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            else:
+                error = None
+
+            with self._lock:
+                job['error'] = error
+                if error is None or job['attempts'] >= self.max_attempts:
+                    job['status'] = "done" if error is None else "failed"
+                    job['finished'] = time.time()
+                else:
+                    job['status'] = "queued"
+                self._save(job)
+                self._prune()
+
+            if error is not None:
+                log.warning("failed", job=job_id, kind=job['kind'], attempt=job['attempts'], error=str(error), status=job['status'])
+            if job['status'] == "queued":
+                retry = threading.Timer(self.retry_delay * 2 ** (job['attempts'] - 1), self._queue.put, (job_id,))
+                retry.daemon = True
+                retry.start()
+
+    def _job_file(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, f"{job_id}.json")
+
+    def _save(self, job: dict) -> None:
+        try:
+            self.writer.write_json(self._job_file(job['id']), job)
+        except OSError as e:   # the job still runs; it just won't be resumed after a restart
+            log.error("save_failed", job=job['id'], error=str(e))
+
+    def _prune(self) -> None:
+        """Forgets finished jobs older than `retention`. Must be called with the lock held."""
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job['finished'] is not None and job['finished'] < time.time() - self.retention
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+            try:
+                os.remove(self._job_file(job_id))
+            except OSError:
+                pass
+
+    @staticmethod
+    def _read_job(file_path: str) -> dict | None:
+        try:
+            with open(file_path, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            log.warning("unreadable_file", path=file_path)
+            return None
@@ -0,0 +1,154 @@
+"""Structured logging which never blocks the thread that logs.
+
+Log calls only put the record into a bounded queue; a background thread (`logging.handlers.QueueListener`)
+formats and writes them. If the queue is full (the output can't keep up), records are dropped and counted
+instead of making requests wait. Every record is an event name plus fields:
+
+    log = get_logger("http")
+    log.info("request", method="GET", route="/export", status=200)
+
+which is written as one JSON object per line (`{"time": ..., "level": "info", "logger": "pigon.http",
+"event": "request", "method": "GET", ...}`) or, with the "text" format, as `event key=value ...`.
+
+Events happening for every request or websocket message can be logged with `sampled`, which only logs a fraction
+of them (the record gets a `sampleRate` field, so counts can be scaled back up).
+
+Session tokens must never end up in the log: fields named like secrets are replaced, and long runs of
+token characters in any other string field (e.g. a raw websocket message) are cut out.
+"""
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import sys
+import time
+
+REDACTED = "[redacted]"
+SECRET_FIELDS = {"token", "tokenhash", "token_hash", "password", "passwordhash", "cookie", "authorization"}
+# Session tokens are 344 base64url characters, token and password hashes 64 hex characters
+TOKEN_PATTERN = re.compile(r"[A-Za-z0-9+/\-_]{40,}={0,2}")
+LOG_FORMATS = ("json", "text")
+
+
+def redact(value):
+    if isinstance(value, str):
+        return TOKEN_PATTERN.sub(REDACTED, value)
+    return value
+
+
+def redact_fields(fields: dict) -> dict:
+    return {key: REDACTED if key.lower() in SECRET_FIELDS else redact(value) for key, value in fields.items()}
+
+
+class EventLogger:
+    """Thin wrapper around a `logging.Logger` for structured events."""
+
+    def __init__(self, logger: logging.Logger) -> None:
+        self.logger = logger
+
+    def debug(self, event: str, **fields) -> None:
+        self.log(logging.DEBUG, event, fields)
+
+    def info(self, event: str, **fields) -> None:
+        self.log(logging.INFO, event, fields)
+
+    def warning(self, event: str, **fields) -> None:
+        self.log(logging.WARNING, event, fields)
+
+    def error(self, event: str, exc_info: bool = False, **fields) -> None:
+        self.log(logging.ERROR, event, fields, exc_info)
+
+    def sampled(self, rate: float, event: str, level: int = logging.INFO, **fields) -> None:
+        """Logs only a `rate` fraction (0 to 1) of these events."""
+        if rate < 1 and random.random() >= rate:
+            return
+        if rate < 1:
+            fields['sampleRate'] = rate
+        self.log(level, event, fields)
+
+    def log(self, level: int, event: str, fields: dict, exc_info: bool = False) -> None:
+        # Checked first, so disabled levels cost next to nothing
+        if not self.logger.isEnabledFor(level):
+            return
+        self.logger.log(level, event, extra={"fields": redact_fields(fields)}, exc_info=exc_info)
+
+
+def get_logger(name: str) -> EventLogger:
+    return EventLogger(logging.getLogger(f"pigon.{name}"))
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.created))
+        fields = " ".join(f"{key}={value}" for key, value in getattr(record, "fields", {}).items())
+        line = f"{timestamp} {record.levelname:<7} {record.name} {record.getMessage()} {fields}".rstrip()
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Puts records into a bounded queue without ever waiting; drops them when it is full."""
+
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Unlike `QueueHandler.prepare`, this keeps the event and its fields apart for the formatter.
+        # Only the traceback has to be rendered here, since it refers to the logging thread's frames.
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+_handler: DroppingQueueHandler | None = None
+
+
+def setup(level: str = "info", log_format: str = "json", queue_size: int = 10000, stream=None) -> logging.handlers.QueueListener:
+    """Routes the "pigon" loggers through a queue to `stream` (stdout by default).
+    Returns the listener (its thread writes the log); call `stop()` on it to flush the queue when shutting down."""
+    global _handler
+    log_queue = queue.Queue(queue_size)
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JSONFormatter() if log_format == "json" else TextFormatter())
+
+    _handler = DroppingQueueHandler(log_queue)
+    logger = logging.getLogger("pigon")
+    logger.handlers = [_handler]
+    logger.setLevel(level.upper())
+    logger.propagate = False
+
+    listener = logging.handlers.QueueListener(log_queue, output)
+    listener.start()
+    return listener
+
+
+def dropped() -> int:
+    """How many records were dropped because the queue was full."""
+    return 0 if _handler is None else _handler.dropped
@@ -0,0 +1,649 @@
+"""Storage backends for the messages of a channel.
+
+Messages are grouped into numbered batches (starting at 1) of at most `batch_size` messages.
+The HTTP API (`/channels/<id>/messages?batch=N`) and the frontend only know about batches,
+so every backend has to be able to map a batch ID to its messages.
+
+- `BatchFileMessageStore` is the original layout: one JSON file per batch
+  (`channels/<id>/message_batches/<n>.json`) which gets rewritten on every message.
+- `LogMessageStore` keeps one append-only log per channel (`messages.log`, one JSON object per line)
+  plus a binary offset index (`messages.idx`), so sending a message is a single append.
+
+Besides batches, messages can be addressed by a cursor `(batch ID, position in batch)`.
+Positions don't change when other messages of the batch get deleted (except in `BatchFileMessageStore`).
+
+Sequence numbers (`seq`, assigned by write_coalescer.py) must never be used twice in a channel, so after a restart
+they continue from `latest_sequence`, which includes deleted messages: the log and SQLite stores keep an entry
+for every deleted message; `BatchFileMessageStore` records the highest deleted number in `sequence.json`.
+"""
+import json
+import os
+import shutil
+import struct
+import threading
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import BinaryIO, Iterable
+
+import metrics
+import tracing
+from durable_writes import DurableWriter
+from file_locks import PathLocks
+
+MESSAGE_BATCH_SIZE = 30     # messages per batch; changing it changes the batch IDs of stored messages
+
+
+class MessageStoreError(Exception): ...
+class ChannelNotFoundError(MessageStoreError): ...
+class BatchNotFoundError(MessageStoreError): ...
+
+
+def encode_message(message_obj: dict) -> bytes:
+    return bytes(json.dumps(message_obj, separators=(',', ':')), 'utf-8')
+
+
+def format_cursor(cursor: tuple[int, int]) -> str:
+    batch_id, position = cursor
+    return f"{batch_id}.{position}"
+
+
+def parse_cursor(cursor: str) -> tuple[int, int]:
+    """Parses a cursor created by `format_cursor`. Raises `ValueError` if it is invalid."""
+    batch_id, position = (int(part) for part in cursor.split("."))
+    if batch_id < 1 or position < 0:
+        raise ValueError(cursor)
+    return batch_id, position
+
+
+class MessageStore:
+    """Base class for message storage backends. One instance is shared by all request handlers.
+    Everything written is made durable as configured in `writer`."""
+
+    def __init__(self, channels_dir: str, batch_size: int, writer: DurableWriter) -> None:
+        self.channels_dir = channels_dir
+        self.batch_size = batch_size
+        self.writer = writer
+
+    def channel_dir(self, channel_id: str) -> str:
+        return os.path.join(self.channels_dir, channel_id)
+
+    def create_channel(self, channel_id: str) -> None:
+        """Creates the (empty) message storage of a new channel. The channel directory has to exist already."""
+        raise NotImplementedError
+
+    def forget_channel(self, channel_id: str) -> None:
+        """Drops everything kept in memory about a channel. Called after the channel directory was deleted."""
+
+    def latest_batch(self, channel_id: str) -> int:
+        raise NotImplementedError
+
+    def last_timestamp(self, channel_id: str) -> int | None:
+        """Returns the timestamp of the newest (not deleted) message, or None if there are no messages."""
+        for batch_id in range(self.latest_batch(channel_id), 0, -1):
+            try:
+                entries = self.batch_entries(channel_id, batch_id)
+            except BatchNotFoundError:
+                continue
+            if entries:
+                return entries[-1][1]
+        return None
+
+    def latest_sequence(self, channel_id: str) -> int:
+        """Returns the highest sequence number given to a message of the channel, including deleted messages
+        (it may be higher than that, gaps are harmless). 0 if no message got a sequence number yet."""
+        sequence = self.deleted_sequence(channel_id)
+        for batch_id in range(self.latest_batch(channel_id), 0, -1):
+            try:
+                messages = self.read_batch(channel_id, batch_id)
+            except BatchNotFoundError:
+                continue
+            if messages:
+                return max(sequence, max(message_obj.get('seq', 0) for message_obj in messages))
+        return sequence
+
+    def deleted_sequence(self, channel_id: str) -> int:
+        """The highest sequence number of a deleted message recorded in `sequence.json` (0 if there is none)."""
+        try:
+            with open(os.path.join(self.channel_dir(channel_id), "sequence.json"), 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return 0
+
+    def append(self, channel_id: str, message_obj: dict) -> int:
+        """Stores a message and returns the ID of the batch it was put in."""
+        return self.append_many(channel_id, [message_obj])[0]
+
+    def append_many(self, channel_id: str, message_objs: list[dict]) -> list[int]:
+        """Stores several messages (in this order) with as few writes as possible.
+        Returns the ID of the batch each message was put in."""
+        raise NotImplementedError
+
+    def read_batch(self, channel_id: str, batch_id: int) -> list[dict]:
+        """Returns the messages of a batch. Raises `BatchNotFoundError` if the batch doesn't exist."""
+        raise NotImplementedError
+
+    def batch_entries(self, channel_id: str, batch_id: int) -> list[tuple[int, int, bytes]]:
+        """Returns `(position, timestamp, JSON encoded message)` for every message of a batch.
+        Raises `BatchNotFoundError` if the batch doesn't exist."""
+        raise NotImplementedError
+
+    def read_batch_raw(self, channel_id: str, batch_id: int) -> bytes:
+        """Returns the messages of a batch as an encoded JSON list."""
+        return b"[" + b",".join(line for _, _, line in self.batch_entries(channel_id, batch_id)) + b"]"
+
+    def open_batch_file(self, channel_id: str, batch_id: int) -> BinaryIO | None:
+        """Opens a file which contains exactly the encoded batch (so it can be sent with `socket.sendfile`),
+        if the backend stores batches like that. Otherwise returns None; use `read_batch_raw` then."""
+        return None
+
+    def batch_version(self, channel_id: str, batch_id: int) -> tuple[str, float]:
+        """Returns an ETag and the modification time of a batch, without reading the messages.
+        Raises `BatchNotFoundError` if the batch doesn't exist."""
+        raise NotImplementedError
+
+    def read_before(
+            self,
+            channel_id: str,
+            before: tuple[int, int] | None,
+            limit: int,
+            since: int | None = None
+    ) -> tuple[list[bytes], tuple[int, int] | None]:
+        """Returns up to `limit` encoded messages (oldest first) which come before the cursor `before`
+        (or the newest messages if it is None) and are not older than the timestamp `since`.\n
+        Also returns the cursor to continue with, or None if there are no more (matching) messages."""
+        if before is None:
+            batch_id, position = self.latest_batch(channel_id), None
+        else:
+            batch_id, position = before
+            batch_id = min(batch_id, self.latest_batch(channel_id))
+
+        lines: list[bytes] = []
+        while batch_id >= 1:
+            for entry_position, timestamp, line in reversed(self.batch_entries(channel_id, batch_id)):
+                if position is not None and entry_position >= position:
+                    continue
+                if since is not None and timestamp < since:
+                    return lines[::-1], None
+                if len(lines) == limit:
+                    return lines[::-1], (batch_id, entry_position + 1)
+                lines.append(line)
+
+            batch_id -= 1
+            position = None
+
+        return lines[::-1], None
+
+    def read_author(self, channel_id: str, username: str, batch_ids: Iterable[int] | None = None) -> list[bytes]:
+        """Returns every (encoded) message written by `username`, oldest first.
+        If `batch_ids` is given, only these batches are searched (e.g. those listed in the author index)."""
+        if batch_ids is None:
+            batch_ids = range(1, self.latest_batch(channel_id) + 1)
+
+        lines = []
+        for batch_id in sorted(batch_ids):
+            try:
+                entries = self.batch_entries(channel_id, batch_id)
+            except BatchNotFoundError:
+                continue
+            lines.extend(line for _, _, line in entries if json.loads(line)['author'] == username)
+        return lines
+
+    def remove_author(self, channel_id: str, username: str, batch_ids: Iterable[int] | None = None) -> int:
+        """Deletes every message written by `username` and returns how many were deleted.
+        If `batch_ids` is given, only these batches are searched."""
+        raise NotImplementedError
+
+
+class BatchFileMessageStore(MessageStore):
+    """The original storage layout: every batch is a JSON list in `message_batches/<n>.json`.
+    All batch files of a channel are protected by one lock per channel."""
+
+    def __init__(self, channels_dir: str, batch_size: int, writer: DurableWriter) -> None:
+        super().__init__(channels_dir, batch_size, writer)
+        self._latest_batches: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._channel_locks = PathLocks()
+
+    def batch_file(self, channel_id: str, batch_id: int) -> str:
+        return os.path.join(self.channel_dir(channel_id), "message_batches", f"{batch_id}.json")
+
+    def create_channel(self, channel_id: str) -> None:
+        os.makedirs(os.path.join(self.channel_dir(channel_id), "message_batches"), exist_ok=True)
+        self.writer.write_json(self.batch_file(channel_id, 1), [])
+        with self._lock:
+            self._latest_batches[channel_id] = 1
+
+    def forget_channel(self, channel_id: str) -> None:
+        with self._lock:
+            self._latest_batches.pop(channel_id, None)
+
+    def latest_batch(self, channel_id: str) -> int:
+        with self._lock:
+            latest = self._latest_batches.get(channel_id)
+        if latest is not None:
+            return latest
+
+        batches_dir = os.path.join(self.channel_dir(channel_id), "message_batches")
+        try:
+            batch_ids = [int(name.removesuffix(".json")) for name in os.listdir(batches_dir) if name.endswith(".json")]
+        except FileNotFoundError:
+            raise ChannelNotFoundError(channel_id)
+
+        latest = max(batch_ids, default=1)
+        with self._lock:
+            self._latest_batches[channel_id] = latest
+        return latest
+
+    def append_many(self, channel_id: str, message_objs: list[dict]) -> list[int]:
+        batch_ids = []
+        with self._channel_locks.hold(channel_id):
+            batch_id = self.latest_batch(channel_id)
+            messages = self.read_batch(channel_id, batch_id)
+
+            # Every batch that gets new messages is written once
+            for message_obj in message_objs:
+                if len(messages) >= self.batch_size:
+                    self.writer.write_json(self.batch_file(channel_id, batch_id), messages)
+                    batch_id += 1
+                    messages = []
+                messages.append(message_obj)
+                batch_ids.append(batch_id)
+
+            self.writer.write_json(self.batch_file(channel_id, batch_id), messages)
+
+            with self._lock:
+                self._latest_batches[channel_id] = batch_id
+        return batch_ids
+
+    def read_batch(self, channel_id: str, batch_id: int) -> list[dict]:
+        try:
+            with tracing.span("file_read"), self._channel_locks.hold(channel_id), \
+                    open(self.batch_file(channel_id, batch_id), 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            raise BatchNotFoundError(batch_id)
+        metrics.record_read("messages", len(data))
+        return json.loads(data)
+
+    def batch_entries(self, channel_id: str, batch_id: int) -> list[tuple[int, int, bytes]]:
+        messages = self.read_batch(channel_id, batch_id)
+        return [(position, message_obj['timestamp'], encode_message(message_obj))
+                for position, message_obj in enumerate(messages)]
+
+    def read_batch_raw(self, channel_id: str, batch_id: int) -> bytes:
+        try:
+            with tracing.span("file_read"), self._channel_locks.hold(channel_id), \
+                    open(self.batch_file(channel_id, batch_id), 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            raise BatchNotFoundError(batch_id)
+        metrics.record_read("messages", len(data))
+        return data
+
+    def open_batch_file(self, channel_id: str, batch_id: int) -> BinaryIO | None:
+        try:
+            with self._channel_locks.hold(channel_id):
+                file = open(self.batch_file(channel_id, batch_id), 'rb')
+        except FileNotFoundError:
+            raise BatchNotFoundError(batch_id)
+        metrics.record_read("messages", os.fstat(file.fileno()).st_size)   # sent with sendfile
+        return file
+
+    def batch_version(self, channel_id: str, batch_id: int) -> tuple[str, float]:
+        try:
+            stat = os.stat(self.batch_file(channel_id, batch_id))
+        except FileNotFoundError:
+            raise BatchNotFoundError(batch_id)
+        return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"', stat.st_mtime
+
+    def remove_author(self, channel_id: str, username: str, batch_ids: Iterable[int] | None = None) -> int:
+        removed = 0
+        with self._channel_locks.hold(channel_id):
+            if batch_ids is None:
+                batch_ids = range(self.latest_batch(channel_id), 0, -1)
+
+            for batch_id in batch_ids:
+                try:
+                    messages = self.read_batch(channel_id, batch_id)
+                except BatchNotFoundError:
+                    continue
+
+                kept_messages = [message for message in messages if message['author'] != username]
+                if len(kept_messages) == len(messages):
+                    continue
+
+                # Recorded first, so the sequence numbers of the deleted messages can't get lost
+                deleted_sequence = max(message.get('seq', 0) for message in messages if message['author'] == username)
+                if deleted_sequence > self.deleted_sequence(channel_id):
+                    self.writer.write_json(os.path.join(self.channel_dir(channel_id), "sequence.json"), deleted_sequence)
+
+                removed += len(messages) - len(kept_messages)
+                self.writer.write_json(self.batch_file(channel_id, batch_id), kept_messages)
+
+        return removed
+
+
+# Every message has one fixed-size entry in the index file:
+# byte offset in the log, length in bytes (0 = deleted), batch ID and timestamp.
+# Storing the batch ID keeps the batch numbering stable when messages get deleted;
+# storing the timestamp allows time based lookups without parsing the log.
+INDEX_ENTRY = struct.Struct("<QIIq")
+
+
+class _ChannelLog:
+    """In-memory copy of the index of one channel's log. Columns are kept in separate arrays for compactness."""
+
+    def __init__(self, log_file: str, index_file: str) -> None:
+        self.log_file = log_file
+        self.index_file = index_file
+        self.lock = threading.RLock()
+        self.offsets = array('Q')
+        self.lengths = array('I')
+        self.batches = array('I')
+        self.timestamps = array('q')
+        self.log_size = 0
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def add_entry(self, offset: int, length: int, batch_id: int, timestamp: int) -> None:
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        self.batches.append(batch_id)
+        self.timestamps.append(timestamp)
+
+    @property
+    def latest_batch(self) -> int:
+        return self.batches[-1] if self.batches else 1
+
+    def batch_range(self, batch_id: int) -> tuple[int, int]:
+        """Returns the index range [start, end) of the entries belonging to a batch (batch IDs are sorted)."""
+        return bisect_left(self.batches, batch_id), bisect_right(self.batches, batch_id)
+
+    def live_count(self, start: int, end: int) -> int:
+        return sum(1 for i in range(start, end) if self.lengths[i])
+
+
+class LogMessageStore(MessageStore):
+    """Append-only storage: `messages.log` contains one JSON message per line, `messages.idx` one `INDEX_ENTRY` per message.
+
+    Sending a message appends one line to the log and one entry to the index; nothing gets rewritten.
+    The index of a channel is loaded into memory the first time the channel is used.
+    Deleted messages are overwritten with spaces in the log and marked with length 0 in the index.
+
+    Channels still using the old `message_batches` layout are converted on first access.
+    """
+
+    def __init__(self, channels_dir: str, batch_size: int, writer: DurableWriter) -> None:
+        super().__init__(channels_dir, batch_size, writer)
+        self._channels: dict[str, _ChannelLog] = {}
+        self._lock = threading.Lock()
+        self._load_locks = PathLocks()
+
+    def _paths(self, channel_id: str) -> tuple[str, str]:
+        channel_dir = self.channel_dir(channel_id)
+        return os.path.join(channel_dir, "messages.log"), os.path.join(channel_dir, "messages.idx")
+
+    def _get(self, channel_id: str) -> _ChannelLog:
+        with self._lock:
+            channel_log = self._channels.get(channel_id)
+        if channel_log is not None:
+            return channel_log
+
+        # Loading (or even converting) a channel only holds up the requests for that channel
+        with self._load_locks.hold(channel_id):
+            with self._lock:
+                channel_log = self._channels.get(channel_id)
+            if channel_log is None:
+                channel_log = self._load(channel_id)
+                with self._lock:
+                    self._channels[channel_id] = channel_log
+            return channel_log
+
+    def _load(self, channel_id: str) -> _ChannelLog:
+        channel_dir = self.channel_dir(channel_id)
+        log_file, index_file = self._paths(channel_id)
+
+        if not os.path.isdir(channel_dir):
+            raise ChannelNotFoundError(channel_id)
+
+        if not os.path.exists(log_file):
+            if os.path.isdir(os.path.join(channel_dir, "message_batches")):
+                self.import_batch_files(channel_id)
+            else:
+                self.create_channel(channel_id)
+
+        channel_log = _ChannelLog(log_file, index_file)
+
+        with tracing.span("file_read"), open(index_file, 'rb') as file:
+            index_data = file.read()
+        metrics.record_read("messages", len(index_data))
+        # A crash in the middle of an append can leave half an entry at the end
+        usable_size = len(index_data) - len(index_data) % INDEX_ENTRY.size
+        log_size = os.path.getsize(log_file)
+
+        for entry in INDEX_ENTRY.iter_unpack(memoryview(index_data)[:usable_size]):
+            offset, length, batch_id, timestamp = entry
+            if offset + length >= log_size:   # the line (including its newline) is not completely in the log
+                break
+            channel_log.add_entry(offset, length, batch_id, timestamp)
+
+        indexed_size = len(channel_log) * INDEX_ENTRY.size
+        if indexed_size != len(index_data):
+            os.truncate(index_file, indexed_size)
+
+        # Log lines which never made it into the index are dropped as well
+        channel_log.log_size = channel_log.offsets[-1] + channel_log.lengths[-1] + 1 if len(channel_log) else 0
+        if len(channel_log) and channel_log.lengths[-1] == 0:
+            channel_log.log_size = self._line_end(log_file, channel_log.offsets[-1])
+        if log_size != channel_log.log_size:
+            os.truncate(log_file, channel_log.log_size)
+
+        return channel_log
+
+    @staticmethod
+    def _line_end(log_file: str, offset: int) -> int:
+        """Finds the end of a (deleted) log line; its index entry does not know its length anymore."""
+        with open(log_file, 'rb') as file:
+            file.seek(offset)
+            return offset + len(file.readline())
+
+    def import_batch_files(self, channel_id: str, keep_batch_files: bool = False) -> None:
+        """Converts a channel from the `message_batches/<n>.json` layout. The log file is renamed into place last,
+        so an interrupted import is simply restarted the next time the channel is loaded.
+        Once the log file exists, left over batch files are ignored (migrate.py keeps them until it verified the log)."""
+        channel_dir = self.channel_dir(channel_id)
+        batches_dir = os.path.join(channel_dir, "message_batches")
+        log_file, index_file = self._paths(channel_id)
+        batch_ids = sorted(int(name.removesuffix(".json")) for name in os.listdir(batches_dir) if name.endswith(".json"))
+
+        offset = 0
+        with open(log_file + ".tmp", 'wb') as log, open(index_file + ".tmp", 'wb') as index:
+            for batch_id in batch_ids:
+                with open(os.path.join(batches_dir, f"{batch_id}.json"), 'r') as file:
+                    messages = json.load(file)
+
+                for message_obj in messages:
+                    line = encode_message(message_obj)
+                    log.write(line + b"\n")
+                    index.write(INDEX_ENTRY.pack(offset, len(line), batch_id, message_obj.get('timestamp', 0)))
+                    offset += len(line) + 1
+
+                if not messages:
+                    # Keep empty batches (e.g. the latest batch of a new channel) addressable with a deleted entry
+                    log.write(b"\n")
+                    index.write(INDEX_ENTRY.pack(offset, 0, batch_id, 0))
+                    offset += 1
+
+            self.writer.sync_file(log)
+            self.writer.sync_file(index)
+
+        self.writer.replace(index_file + ".tmp", index_file)
+        self.writer.replace(log_file + ".tmp", log_file)
+        if not keep_batch_files:
+            shutil.rmtree(batches_dir, ignore_errors=True)
+
+    def create_channel(self, channel_id: str) -> None:
+        log_file, index_file = self._paths(channel_id)
+        open(index_file, 'wb').close()
+        open(log_file, 'wb').close()
+
+    def forget_channel(self, channel_id: str) -> None:
+        with self._load_locks.hold(channel_id), self._lock:   # not while the channel is being loaded
+            self._channels.pop(channel_id, None)
+
+    def latest_batch(self, channel_id: str) -> int:
+        return self._get(channel_id).latest_batch
+
+    def last_timestamp(self, channel_id: str) -> int | None:
+        channel_log = self._get(channel_id)
+        with channel_log.lock:
+            for i in range(len(channel_log) - 1, -1, -1):
+                if channel_log.lengths[i]:
+                    return channel_log.timestamps[i]
+        return None
+
+    def latest_sequence(self, channel_id: str) -> int:
+        channel_log = self._get(channel_id)
+        with channel_log.lock:
+            # Every message since the first one with a sequence number has one, increasing by one per entry
+            # (including deleted entries): the newest message's number plus the deleted entries after it.
+            # The number of entries covers channels whose messages got deleted before there were sequence numbers.
+            sequence = len(channel_log)
+            for i in range(len(channel_log) - 1, -1, -1):
+                if channel_log.lengths[i]:
+                    (_, line), = self._read_lines(channel_log, i, i + 1)
+                    sequence = max(sequence, json.loads(line).get('seq', 0) + len(channel_log) - 1 - i)
+                    break
+
+        # Channels imported from batch files may have recorded the numbers of messages deleted before
+        return max(sequence, self.deleted_sequence(channel_id))
+
+    def append_many(self, channel_id: str, message_objs: list[dict]) -> list[int]:
+        channel_log = self._get(channel_id)
+        lines = [encode_message(message_obj) for message_obj in message_objs]
+
+        with channel_log.lock:
+            batch_id = channel_log.latest_batch
+            batch_count = channel_log.live_count(*channel_log.batch_range(batch_id))
+            offset = channel_log.log_size
+            entries = []
+            for message_obj, line in zip(message_objs, lines):
+                if batch_count >= self.batch_size:
+                    batch_id += 1
+                    batch_count = 0
+                entries.append((offset, len(line), batch_id, message_obj.get('timestamp', 0)))
+                batch_count += 1
+                offset += len(line) + 1
+
+            # The lines are synced before their index entries are written; see `_load` for what happens otherwise
+            log_data = b"".join(line + b"\n" for line in lines)
+            index_data = b"".join(INDEX_ENTRY.pack(*entry) for entry in entries)
+            with tracing.span("file_write"):
+                with open(channel_log.log_file, 'ab') as file:
+                    file.write(log_data)
+                    self.writer.sync_file(file)
+                with open(channel_log.index_file, 'ab') as file:
+                    file.write(index_data)
+                    self.writer.sync_file(file)
+            metrics.record_write("append", len(log_data) + len(index_data))
+
+            for entry in entries:
+                channel_log.add_entry(*entry)
+            channel_log.log_size = offset
+
+        return [entry[2] for entry in entries]
+
+    def _read_lines(self, channel_log: _ChannelLog, start: int, end: int) -> list[tuple[int, bytes]]:
+        """Reads the (non-deleted) log lines of the index entries [start, end) with a single read.
+        Returns `(entry index, line)` pairs."""
+        if start >= end:
+            return []
+
+        first_offset = channel_log.offsets[start]
+        last_offset = channel_log.offsets[end - 1] + channel_log.lengths[end - 1]
+        with tracing.span("file_read"), open(channel_log.log_file, 'rb') as file:
+            file.seek(first_offset)
+            data = file.read(last_offset - first_offset)
+        metrics.record_read("messages", len(data))
+
+        lines = []
+        for i in range(start, end):
+            length = channel_log.lengths[i]
+            if length == 0:
+                continue
+            relative_offset = channel_log.offsets[i] - first_offset
+            lines.append((i, data[relative_offset:relative_offset + length]))
+        return lines
+
+    def read_batch(self, channel_id: str, batch_id: int) -> list[dict]:
+        return [json.loads(line) for _, _, line in self.batch_entries(channel_id, batch_id)]
+
+    def batch_entries(self, channel_id: str, batch_id: int) -> list[tuple[int, int, bytes]]:
+        channel_log = self._get(channel_id)
+
+        with channel_log.lock:
+            if not 1 <= batch_id <= channel_log.latest_batch:
+                raise BatchNotFoundError(batch_id)
+            start, end = channel_log.batch_range(batch_id)
+            lines = self._read_lines(channel_log, start, end)
+            return [(i - start, channel_log.timestamps[i], line) for i, line in lines]
+
+    def read_batch_raw(self, channel_id: str, batch_id: int) -> bytes:
+        channel_log = self._get(channel_id)
+
+        with channel_log.lock:
+            if not 1 <= batch_id <= channel_log.latest_batch:
+                raise BatchNotFoundError(batch_id)
+            lines = self._read_lines(channel_log, *channel_log.batch_range(batch_id))
+
+        return b"[" + b",".join(line for _, line in lines) + b"]"
+
+    def batch_version(self, channel_id: str, batch_id: int) -> tuple[str, float]:
+        channel_log = self._get(channel_id)
+
+        with channel_log.lock:
+            if not 1 <= batch_id <= channel_log.latest_batch:
+                raise BatchNotFoundError(batch_id)
+            start, end = channel_log.batch_range(batch_id)
+            # Appending changes the number of entries, deleting changes their lengths
+            first_offset = channel_log.offsets[start] if start < end else channel_log.log_size
+            lengths_checksum = zlib.crc32(channel_log.lengths[start:end])
+
+        etag = f'"{batch_id:x}-{first_offset:x}-{end - start:x}-{lengths_checksum:08x}"'
+        return etag, os.path.getmtime(channel_log.log_file)
+
+    def remove_author(self, channel_id: str, username: str, batch_ids: Iterable[int] | None = None) -> int:
+        channel_log = self._get(channel_id)
+        author_marker = bytes(f'"author":{json.dumps(username)}', 'utf-8')
+        removed = 0
+
+        with channel_log.lock:
+            if batch_ids is None:
+                batch_ids = range(1, channel_log.latest_batch + 1)
+
+            with open(channel_log.log_file, 'r+b') as log, open(channel_log.index_file, 'r+b') as index:
+                for batch_id in batch_ids:
+                    for i, line in self._read_lines(channel_log, *channel_log.batch_range(batch_id)):
+                        if author_marker not in line or json.loads(line)['author'] != username:
+                            continue
+
+                        offset = channel_log.offsets[i]
+                        log.seek(offset)
+                        log.write(b" " * channel_log.lengths[i])
+                        index.seek(i * INDEX_ENTRY.size)
+                        index.write(INDEX_ENTRY.pack(offset, 0, channel_log.batches[i], channel_log.timestamps[i]))
+                        channel_log.lengths[i] = 0
+                        removed += 1
+
+                self.writer.sync_file(log)
+                self.writer.sync_file(index)
+
+        return removed
+
+
+MESSAGE_STORES = {
+    "batches": BatchFileMessageStore,
+    "log": LogMessageStore,
+}
@@ -0,0 +1,100 @@
+"""In-process cache for the parsed JSON meta files (`accounts/<user>/meta.json`, `channels/<id>/meta.json`)."""
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import metrics
+import tracing
+from durable_writes import DurableWriter
+from file_locks import PathLocks
+
+
+def copy_json(obj):
+    """Copies a parsed JSON object. A lot faster than `copy.deepcopy` because it only has to know dicts and lists."""
+    if isinstance(obj, dict):
+        return {key: copy_json(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [copy_json(value) for value in obj]
+    return obj
+
+
+class JSONFileCache:
+    """Bounded LRU cache of parsed JSON files, keyed by file path.
+
+    Every lookup `stat`s the file and compares modification time and size with the cached entry,
+    so files edited by something else than the server are reloaded. Writes of the server itself
+    should go through `write` (write-through), which keeps the entry valid without reading the file again.
+    Files are written atomically by `writer` and only read and written while holding their lock in `locks`.
+    """
+
+    def __init__(self, max_entries: int, locks: PathLocks, writer: DurableWriter) -> None:
+        self.max_entries = max_entries
+        self.locks = locks
+        self.writer = writer
+        self._entries: OrderedDict[str, tuple[tuple[int, int], object]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _version(stat: os.stat_result) -> tuple[int, int]:
+        return stat.st_mtime_ns, stat.st_size
+
+    def _store(self, file_path: str, version: tuple[int, int], obj) -> None:
+        with self._lock:
+            self._entries[file_path] = (version, obj)
+            self._entries.move_to_end(file_path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, file_path: str, mutable: bool = True):
+        """Returns the parsed contents of a JSON file. Raises `FileNotFoundError`/`OSError` like `open` would.\n
+        With `mutable=False` the cached object itself is returned; it is shared with other requests and
+        must not be modified. Otherwise the caller gets its own copy."""
+        try:
+            version = self._version(os.stat(file_path))
+        except OSError:
+            self.invalidate(file_path)
+            raise
+
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(file_path)
+                self.hits += 1
+                obj = entry[1]
+            else:
+                self.misses += 1
+                obj = None
+
+        if obj is None:
+            with self.locks.hold(file_path):
+                with tracing.span("file_read"), open(file_path, 'rb') as file:
+                    stat = os.fstat(file.fileno())
+                    obj = json.load(file)
+                metrics.record_read("meta", stat.st_size)
+                version = self._version(stat)
+                self._store(file_path, version, obj)
+
+        return copy_json(obj) if mutable else obj
+
+    def write(self, file_path: str, obj) -> None:
+        """Writes `obj` to `file_path` and updates the cache. `obj` must not be modified afterwards.
+        Raises `OSError` if writing fails."""
+        with self.locks.hold(file_path):
+            try:
+                self.writer.write_json(file_path, obj)
+                version = self._version(os.stat(file_path))
+            except OSError:
+                self.invalidate(file_path)
+                raise
+            self._store(file_path, version, obj)
+
+    def invalidate(self, file_path: str) -> None:
+        with self._lock:
+            self._entries.pop(file_path, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,180 @@
+"""Counters and histograms in the Prometheus text exposition format, served on `/metrics`.
+
+Recording is cheap (a lock and a dict update), so it is done on the hot path. Everything that can be read off
+existing state (queue lengths, connected clients, ...) is not recorded at all, but collected by the functions
+registered with `add_collector` when `/metrics` is requested.
+
+The metrics of the server are defined at the bottom of this module, so the list of what is exported is in one place.
+"""
+import bisect
+import math
+import threading
+from typing import Callable, Iterable
+
+import logs
+
+# Seconds; from a cached read to a slow fsync
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+log = logs.get_logger("metrics")
+
+Sample = tuple[str, dict[str, str], float]    # sample name suffix (e.g. "_bucket"), labels, value
+
+
+def escape_label_value(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in labels.items()) + "}"
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def format_metric(name: str, metric_type: str, help_text: str, samples: Iterable[Sample]) -> str:
+    """One metric family."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    lines.extend(f"{name}{suffix}{format_labels(labels)} {format_value(value)}" for suffix, labels, value in samples)
+    return "\n".join(lines) + "\n"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> str:
+        with self._lock:
+            values = dict(self._values)
+        return format_metric(self.name, "counter", self.help_text, (
+            ("", dict(zip(self.label_names, label_values)), value) for label_values, value in sorted(values.items())
+        ))
+
+
+class Histogram:
+    def __init__(
+            self,
+            name: str,
+            help_text: str,
+            label_names: tuple[str, ...] = (),
+            buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._counts: dict[tuple[str, ...], list[int]] = {}    # per bucket (not cumulative), the last one is +Inf
+        self._sums: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str) -> None:
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(label_values)
+            if counts is None:
+                counts = self._counts[label_values] = [0] * (len(self.buckets) + 1)
+                self._sums[label_values] = 0.0
+            counts[bucket] += 1
+            self._sums[label_values] += value
+
+    def render(self) -> str:
+        with self._lock:
+            counts = {label_values: list(bucket_counts) for label_values, bucket_counts in self._counts.items()}
+            sums = dict(self._sums)
+
+        return format_metric(self.name, "histogram", self.help_text, (
+            sample
+            for label_values in sorted(counts)
+            for sample in histogram_samples(
+                self.buckets + (math.inf,), counts[label_values], sums[label_values],
+                dict(zip(self.label_names, label_values))
+            )
+        ))
+
+
+def histogram_samples(upper_bounds: Iterable, counts: Iterable[int], total: float, labels: dict[str, str] = None) -> list[Sample]:
+    """The samples of a histogram from the (not cumulative) counts per bucket. The last bound has to be infinite."""
+    labels = labels or {}
+    samples = []
+    cumulative = 0
+    for upper_bound, count in zip(upper_bounds, counts):
+        cumulative += count
+        le = upper_bound if isinstance(upper_bound, str) else format_value(upper_bound)
+        samples.append(("_bucket", dict(labels, le=le), cumulative))
+    samples.append(("_sum", labels, total))
+    samples.append(("_count", labels, cumulative))
+    return samples
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: list[Counter | Histogram] = []
+        self._collectors: list[Callable[[], Iterable[tuple[str, str, str, list[Sample]]]]] = []
+
+    def counter(self, name: str, help_text: str, label_names: tuple[str, ...] = ()) -> Counter:
+        counter = Counter(name, help_text, label_names)
+        self._metrics.append(counter)
+        return counter
+
+    def histogram(self, name: str, help_text: str, label_names: tuple[str, ...] = (), **kwargs) -> Histogram:
+        histogram = Histogram(name, help_text, label_names, **kwargs)
+        self._metrics.append(histogram)
+        return histogram
+
+    def add_collector(self, collector: Callable[[], Iterable[tuple[str, str, str, list[Sample]]]]) -> None:
+        """`collector` is called for every scrape and returns (name, type, help, samples) of the metrics it collects."""
+        self._collectors.append(collector)
+
+    def render(self) -> bytes:
+        parts = [metric.render() for metric in self._metrics]
+        for collector in self._collectors:
+            try:
+                for name, metric_type, help_text, samples in collector():
+                    parts.append(format_metric(name, metric_type, help_text, samples))
+            except Exception:   # a broken collector shouldn't take the other metrics down
+                log.error("collector_failed", exc_info=True, collector=collector.__name__)
+        return bytes("".join(parts), "utf-8")
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.counter(
+    "pigon_http_requests_total", "HTTP requests by route and status code.", ("method", "route", "status"))
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "pigon_http_request_duration_seconds", "Time from reading an HTTP request to the end of the response.", ("method", "route"))
+FILE_READS = REGISTRY.counter("pigon_file_reads_total", "Files (or parts of the message log) read, by store.", ("store",))
+FILE_READ_BYTES = REGISTRY.counter("pigon_file_read_bytes_total", "Bytes read from files, by store.", ("store",))
+FILE_WRITES = REGISTRY.counter(
+    "pigon_file_writes_total", "File writes: whole files replaced atomically, or appends.", ("kind",))
+FILE_WRITTEN_BYTES = REGISTRY.counter("pigon_file_written_bytes_total", "Bytes written to files.", ("kind",))
+
+WS_FAN_OUT_SECONDS = REGISTRY.histogram(
+    "pigon_websocket_fan_out_seconds",
+    "Time from storing a message to having queued it for every websocket client of the channel.")
+WS_MESSAGES_QUEUED = REGISTRY.counter(
+    "pigon_websocket_messages_queued_total", "Messages queued for sending to websocket clients.")
+WS_SLOW_CLIENTS = REGISTRY.counter(
+    "pigon_websocket_slow_clients_total", "Websocket clients disconnected because their send queue was full.")
+
+
+def record_read(store: str, size: int) -> None:
+    FILE_READS.inc(store)
+    FILE_READ_BYTES.inc(store, amount=size)
+
+
+def record_write(kind: str, size: int) -> None:
+    FILE_WRITES.inc(kind)
+    FILE_WRITTEN_BYTES.inc(kind, amount=size)
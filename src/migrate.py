@@ -0,0 +1,394 @@
+#!/usr/bin/python
+"""Converts the backend_files JSON tree to another on-disk format. Run it while the server is stopped.
+
+    python migrate.py sqlite    copies everything into the SQLite database used by `server.py --storage sqlite`
+    python migrate.py compact   packs the `message_batches/<n>.json` files of every channel into the
+                                append-only log of the "log" message store (one log and one index file per channel)
+    python migrate.py index     builds the author index (see author_index.py) of accounts created before it existed
+
+Channels are read (and, for `compact`, converted) in parallel by a process pool. The messages of every channel
+are counted and checksummed when reading them and again after writing them; a channel whose copy doesn't match
+is rolled back and reported. The commands can be interrupted and simply started again: finished channels
+are recorded (in the database, or by the converted files themselves) and skipped; `index` only writes
+the index files once all channels were read.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from author_index import ENTRY as AUTHOR_INDEX_ENTRY
+from durable_writes import DURABILITY_MODES, DurableWriter
+from message_store import INDEX_ENTRY, MESSAGE_BATCH_SIZE, LogMessageStore, encode_message
+from sqlite_storage import Database
+
+
+class MigrationError(Exception): ...
+
+
+class ChannelMessages:
+    """All messages of one channel as `(batch ID, position, timestamp, author, JSON encoded message)` rows,
+    with deleted messages as rows without author and message. `checksum` covers the encoded messages in order."""
+
+    def __init__(self, channel_id: str, rows: list[tuple[int, int, int, str, bytes | None]]) -> None:
+        self.channel_id = channel_id
+        self.rows = rows
+        self.count = sum(1 for row in rows if row[4] is not None)
+        self.size = sum(len(row[4]) for row in rows if row[4] is not None)
+        self.checksum = checksum(row[4] for row in rows)
+
+
+def checksum(bodies) -> str:
+    digest = hashlib.sha256()
+    for body in bodies:
+        if body is not None:
+            digest.update(body)
+            digest.update(b"\n")
+    return digest.hexdigest()
+
+
+def read_batch_files(channel_dir: str) -> list[tuple[int, int, int, str, bytes | None]]:
+    batches_dir = os.path.join(channel_dir, "message_batches")
+    batch_ids = sorted(int(name.removesuffix(".json")) for name in os.listdir(batches_dir) if name.endswith(".json"))
+
+    rows = []
+    for batch_id in batch_ids:
+        with open(os.path.join(batches_dir, f"{batch_id}.json"), 'r') as file:
+            messages = json.load(file)
+        for position, message_obj in enumerate(messages):
+            rows.append((batch_id, position, message_obj.get('timestamp', 0), message_obj['author'],
+                         encode_message(message_obj)))
+    return rows
+
+
+def read_log(channel_dir: str) -> list[tuple[int, int, int, str, bytes | None]]:
+    """Reads `messages.log` like `LogMessageStore` does, including its recovery from interrupted appends."""
+    log_file = os.path.join(channel_dir, "messages.log")
+    with open(os.path.join(channel_dir, "messages.idx"), 'rb') as file:
+        index_data = file.read()
+    usable_size = len(index_data) - len(index_data) % INDEX_ENTRY.size
+
+    with open(log_file, 'rb') as file:
+        log_data = file.read()
+
+    rows = []
+    position = 0
+    for offset, length, batch_id, timestamp in INDEX_ENTRY.iter_unpack(memoryview(index_data)[:usable_size]):
+        if offset + length >= len(log_data):   # the line (including its newline) is not completely in the log
+            break
+        position = position + 1 if rows and rows[-1][0] == batch_id else 0
+        if length == 0:   # deleted
+            rows.append((batch_id, position, timestamp, "", None))
+        else:
+            body = log_data[offset:offset + length]
+            rows.append((batch_id, position, timestamp, json.loads(body)['author'], body))
+    return rows
+
+
+def read_channel(channels_dir: str, channel_id: str) -> tuple[dict, ChannelMessages]:
+    """Reads the meta and the messages of a channel in whichever layout it is stored. Runs in the worker processes."""
+    channel_dir = os.path.join(channels_dir, channel_id)
+    with open(os.path.join(channel_dir, "meta.json"), 'r') as file:
+        channel_meta = json.load(file)
+
+    if os.path.exists(os.path.join(channel_dir, "messages.log")):
+        rows = read_log(channel_dir)
+    elif os.path.isdir(os.path.join(channel_dir, "message_batches")):
+        rows = read_batch_files(channel_dir)
+    else:
+        rows = []
+    return channel_meta, ChannelMessages(channel_id, rows)
+
+
+def compact_channel(channels_dir: str, channel_id: str) -> ChannelMessages | None:
+    """Packs the batch files of a channel into the log layout. Runs in the worker processes.
+    Returns None if the channel has no batch files (anymore)."""
+    channel_dir = os.path.join(channels_dir, channel_id)
+    batches_dir = os.path.join(channel_dir, "message_batches")
+    log_file = os.path.join(channel_dir, "messages.log")
+    if not os.path.isdir(batches_dir):
+        return None
+
+    source = ChannelMessages(channel_id, read_batch_files(channel_dir))
+    converted_before = os.path.exists(log_file)   # interrupted after the conversion, before removing the batch files
+    if not converted_before:
+        store = LogMessageStore(channels_dir, MESSAGE_BATCH_SIZE, DurableWriter("fsync-file"))
+        store.import_batch_files(channel_id, keep_batch_files=True)
+
+    copy = ChannelMessages(channel_id, read_log(channel_dir))
+    if (copy.count, copy.checksum) != (source.count, source.checksum):
+        if not converted_before:   # back to the original layout
+            os.remove(log_file)
+            os.remove(os.path.join(channel_dir, "messages.idx"))
+        raise MigrationError(f"channel {channel_id}: {copy.count} messages in the log, {source.count} in the batch files")
+
+    shutil.rmtree(batches_dir)
+    return source
+
+
+def channel_authors(channels_dir: str, channel_id: str) -> tuple[dict[str, set[int]], ChannelMessages]:
+    """Returns the batches every user wrote messages in. Runs in the worker processes."""
+    _, messages = read_channel(channels_dir, channel_id)
+    authors: dict[str, set[int]] = {}
+    for batch_id, _, _, author, body in messages.rows:
+        if body is not None:
+            authors.setdefault(author, set()).add(batch_id)
+    messages.rows = []   # only the counts are needed
+    return authors, messages
+
+
+def run_parallel(executor: ProcessPoolExecutor, function, channels_dir: str, channel_ids: list[str]):
+    """Runs `function(channels_dir, channel_id)` for every channel and yields `(channel_id, result, exception)`
+    in the order they finish. Only a few channels are in flight at once, so results don't pile up in memory."""
+    max_pending = executor._max_workers * 2
+    remaining = iter(channel_ids)
+    pending = {}
+
+    while True:
+        for channel_id in remaining:
+            pending[executor.submit(function, channels_dir, channel_id)] = channel_id
+            if len(pending) >= max_pending:
+                break
+        if not pending:
+            return
+
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            channel_id = pending.pop(future)
+            try:
+                yield channel_id, future.result(), None
+            except Exception as e:
+                yield channel_id, None, e
+
+
+class Progress:
+    """Prints how far the migration is and how fast it goes, at most once per `interval` seconds."""
+
+    def __init__(self, total_channels: int, interval: float = 2.0) -> None:
+        self.total_channels = total_channels
+        self.interval = interval
+        self.channels = 0
+        self.messages = 0
+        self.bytes = 0
+        self.failed: list[tuple[str, Exception]] = []
+        self.start = self.last_print = time.perf_counter()
+
+    def add(self, messages: ChannelMessages | None) -> None:
+        self.channels += 1
+        if messages is not None:
+            self.messages += messages.count
+            self.bytes += messages.size
+        if time.perf_counter() - self.last_print >= self.interval:
+            self.print()
+
+    def fail(self, channel_id: str, error: Exception) -> None:
+        self.channels += 1
+        self.failed.append((channel_id, error))
+        print(f"Channel {channel_id} failed: {error}")
+
+    def print(self, done: bool = False) -> None:
+        self.last_print = time.perf_counter()
+        elapsed = max(self.last_print - self.start, 1e-9)
+        print(f"{'Done: ' if done else ''}{self.channels}/{self.total_channels} channels, {self.messages} messages, "
+              f"{self.bytes / 1e6:.1f} MB in {elapsed:.1f} s "
+              f"({self.messages / elapsed:.0f} messages/s, {self.bytes / 1e6 / elapsed:.2f} MB/s)")
+
+
+def list_channels(channels_dir: str) -> list[str]:
+    return sorted(name for name in os.listdir(channels_dir) if os.path.isfile(os.path.join(channels_dir, name, "meta.json")))
+
+
+def migrate_accounts(database: Database, accounts_dir: str) -> dict[str, dict]:
+    """Copies accounts and sessions (existing ones are left alone) and returns the account metas by username."""
+    accounts = {}
+    now = int(time.time())
+
+    with database.transaction(MigrationError, write=True) as connection:
+        for username in sorted(os.listdir(accounts_dir)):
+            account_dir = os.path.join(accounts_dir, username)
+            if not os.path.isfile(os.path.join(account_dir, "meta.json")):
+                continue
+            with open(os.path.join(account_dir, "meta.json"), 'r') as file:
+                account = json.load(file)
+            accounts[username] = account
+
+            connection.execute(
+                "INSERT OR IGNORE INTO accounts (username, displayname, account_created, password_hash, public_key, deleted) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (username, account['displayname'], account['accountCreated'], account['passwordHash'],
+                 account['publicKey'], account['deleted'])
+            )
+
+            try:
+                with open(os.path.join(account_dir, "sessions.json"), 'r') as file:
+                    sessions: dict[str, int] = json.load(file)
+            except FileNotFoundError:   # not logged in since sessions.json was introduced
+                sessions = {token_hash: now for token_hash in account.get('validTokens', [])}
+            connection.executemany(
+                "INSERT OR IGNORE INTO sessions (token_hash, username, created) VALUES (?, ?, ?)",
+                [(token_hash, username, created) for token_hash, created in sessions.items()]
+            )
+
+    return accounts
+
+
+def insert_channel(database: Database, accounts: dict[str, dict], channel_meta: dict, messages: ChannelMessages) -> None:
+    """Copies a channel with its members and messages in one transaction, including the record that it was copied."""
+    channel_id = messages.channel_id
+
+    with database.transaction(MigrationError, write=True) as connection:
+        connection.execute(
+            "INSERT INTO channels (channel_id, name, timestamp_created, deleted, messages_modified) VALUES (?, ?, ?, ?, ?)",
+            (channel_id, channel_meta['name'], channel_meta['timestampCreated'], channel_meta['deleted'], time.time())
+        )
+
+        for username in channel_meta['members']:
+            channels = accounts.get(username, {}).get('channels')
+            key = channels.get(channel_id) if isinstance(channels, dict) else None
+            if key is None:
+                print(f"Channel {channel_id}: member {username} has no key for the channel; not copying the membership")
+                continue
+            connection.execute(
+                "INSERT INTO memberships (channel_id, username, encrypted_key, iv) VALUES (?, ?, ?, ?)",
+                (channel_id, username, key['encryptedKey'], key['iv'])
+            )
+
+        connection.executemany(
+            "INSERT INTO messages (channel_id, batch_id, position, timestamp, author, body) VALUES (?, ?, ?, ?, ?, ?)",
+            [(channel_id, *row) for row in messages.rows]
+        )
+
+        stored = connection.execute(
+            "SELECT body FROM messages WHERE channel_id = ? ORDER BY batch_id, position", (channel_id,)
+        ).fetchall()
+        stored_count = sum(1 for body, in stored if body is not None)
+        if (stored_count, checksum(body for body, in stored)) != (messages.count, messages.checksum):
+            raise MigrationError(f"channel {channel_id}: {stored_count} messages stored, {messages.count} read")
+
+        connection.execute(
+            "INSERT INTO migrated_channels (channel_id, messages, checksum) VALUES (?, ?, ?)",
+            (channel_id, messages.count, messages.checksum)
+        )
+
+
+def migrate_to_sqlite(backend_dir: str, db_file: str, workers: int, durability: str) -> Progress:
+    database = Database(db_file, durability)
+    with database.transaction(MigrationError, write=True) as connection:
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS migrated_channels (channel_id TEXT PRIMARY KEY, messages INTEGER, checksum TEXT)"
+        )
+        migrated = {channel_id for channel_id, in connection.execute("SELECT channel_id FROM migrated_channels")}
+
+    print("Copying accounts and sessions...")
+    accounts = migrate_accounts(database, os.path.join(backend_dir, "accounts"))
+    print(f"{len(accounts)} accounts.")
+
+    channels_dir = os.path.join(backend_dir, "channels")
+    channel_ids = [channel_id for channel_id in list_channels(channels_dir) if channel_id not in migrated]
+    print(f"Copying {len(channel_ids)} channels ({len(migrated)} were copied before)...")
+
+    progress = Progress(len(channel_ids))
+    with ProcessPoolExecutor(workers) as executor:
+        for channel_id, result, error in run_parallel(executor, read_channel, channels_dir, channel_ids):
+            if error is None:
+                try:
+                    insert_channel(database, accounts, *result)
+                except MigrationError as e:
+                    error = e
+            if error is not None:
+                progress.fail(channel_id, error)
+            else:
+                progress.add(result[1])
+
+    database.close()
+    return progress
+
+
+def compact(backend_dir: str, workers: int) -> Progress:
+    channels_dir = os.path.join(backend_dir, "channels")
+    channel_ids = list_channels(channels_dir)
+    print(f"Compacting the batch files of {len(channel_ids)} channels...")
+
+    progress = Progress(len(channel_ids))
+    with ProcessPoolExecutor(workers) as executor:
+        for channel_id, result, error in run_parallel(executor, compact_channel, channels_dir, channel_ids):
+            if error is not None:
+                progress.fail(channel_id, error)
+            else:
+                progress.add(result)
+    return progress
+
+
+def build_author_indexes(backend_dir: str, workers: int) -> Progress:
+    accounts_dir = os.path.join(backend_dir, "accounts")
+    channels_dir = os.path.join(backend_dir, "channels")
+    usernames = [
+        username for username in os.listdir(accounts_dir)
+        if os.path.isfile(os.path.join(accounts_dir, username, "meta.json"))
+        and not os.path.exists(os.path.join(accounts_dir, username, "messages.idx"))
+    ]
+    # Channels are read completely, so it doesn't matter how many accounts need an index
+    channel_ids = list_channels(channels_dir) if usernames else []
+    print(f"Building the author index of {len(usernames)} accounts from {len(channel_ids)} channels...")
+
+    entries: dict[str, list[tuple[int, int]]] = {username: [] for username in usernames}
+    progress = Progress(len(channel_ids))
+    with ProcessPoolExecutor(workers) as executor:
+        for channel_id, result, error in run_parallel(executor, channel_authors, channels_dir, channel_ids):
+            if error is not None:
+                progress.fail(channel_id, error)
+                continue
+            authors, messages = result
+            for author, batch_ids in authors.items():
+                if author in entries:
+                    entries[author].extend((int(channel_id), batch_id) for batch_id in batch_ids)
+            progress.add(messages)
+
+    if progress.failed:   # the indexes would be incomplete
+        return progress
+
+    writer = DurableWriter("fsync-file")
+    for username, user_entries in entries.items():
+        data = b"".join(AUTHOR_INDEX_ENTRY.pack(*entry) for entry in sorted(user_entries))
+        writer.write_bytes(os.path.join(accounts_dir, username, "messages.idx"), data)
+    return progress
+
+
+def main():
+    default_backend_dir = os.path.join(os.path.dirname(__file__), "../backend_files")
+
+    parser = argparse.ArgumentParser(description="Converts the Pigon Messenger backend files to another format")
+    parser.add_argument("command", choices=["sqlite", "compact", "index"], help="see the top of migrate.py")
+    parser.add_argument("--backend-dir", default=default_backend_dir, help="the backend_files directory")
+    parser.add_argument("--db", help="the SQLite database to copy into (default: <backend dir>/pigon.sqlite3)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument(
+        "--durability", choices=DURABILITY_MODES, default="group-commit",
+        help="durability of the SQLite writes; as safe as the server's --durability, but the copy can be redone anyway"
+    )
+    args = parser.parse_args()
+
+    try:
+        if args.command == "sqlite":
+            db_file = args.db or os.path.join(args.backend_dir, "pigon.sqlite3")
+            progress = migrate_to_sqlite(args.backend_dir, db_file, args.workers, args.durability)
+        elif args.command == "compact":
+            progress = compact(args.backend_dir, args.workers)
+        else:
+            progress = build_author_indexes(args.backend_dir, args.workers)
+    except KeyboardInterrupt:
+        print("Interrupted; run the same command again to continue.")
+        sys.exit(130)
+
+    progress.print(done=True)
+    if progress.failed:
+        print(f"{len(progress.failed)} channels failed:", ", ".join(channel_id for channel_id, _ in progress.failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
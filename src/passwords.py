@@ -0,0 +1,136 @@
+"""Password hashing with scrypt, on a small thread pool, and rate limiting of login attempts.
+
+Hashes are stored as `scrypt$<n>$<r>$<p>$<salt>$<hash>` (salt and hash base64 encoded), so the cost parameters
+can be raised later: hashes with other parameters, and the legacy unsalted SHA-256 hex digests, still verify
+and are reported as outdated, so the caller can replace them with a new hash right after a successful login.
+
+scrypt takes tens of milliseconds of CPU and 16 MiB of memory per hash (with the default parameters).
+Hashing runs on `workers` threads (hashlib releases the GIL while hashing); at most `max_waiting` more
+requests wait for a free thread, everything beyond that is rejected with `HasherBusyError`. That way a storm
+of logins occupies a bounded number of HTTP worker threads and can't starve everything else.
+"""
+import hashlib
+import hmac
+import os
+import threading
+import time
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import tracing
+
+
+class HasherBusyError(Exception): ...
+
+
+def legacy_hash(password: str, username: str) -> str:
+    """The original password hash: one SHA-256 round with a fixed salt and the reversed username."""
+    m = hashlib.sha256()
+    m.update(bytes(password, 'utf-8'))
+    salt1 = bytes("o8i3Sidf/B2", 'utf-8')
+    m.update(salt1)
+    salt2 = bytes(username[::-1], 'utf-8')
+    m.update(salt2)
+    return m.hexdigest()
+
+
+class PasswordHasher:
+    """Hashes and verifies passwords on its own thread pool. Both block the calling thread until done."""
+
+    def __init__(self, workers: int, max_waiting: int, n: int = 2 ** 14, r: int = 8, p: int = 1) -> None:
+        self.n = n
+        self.r = r
+        self.p = p
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="password-hasher")
+        self._slots = threading.BoundedSemaphore(workers + max_waiting)
+        self._lock = threading.Lock()
+        self.hashed = 0
+        self.rejected = 0
+
+    def hash(self, password: str) -> str:
+        """Raises `HasherBusyError` if too many passwords are being hashed already."""
+        salt = os.urandom(16)
+        digest = self._run(self._scrypt, password, salt, self.n, self.r, self.p)
+        return f"scrypt${self.n}${self.r}${self.p}${str(b64encode(salt), 'ascii')}${str(b64encode(digest), 'ascii')}"
+
+    def verify(self, password: str, password_hash: str, username: str) -> tuple[bool, bool]:
+        """Checks a password against a stored hash. Returns whether it matches and whether the hash is outdated
+        (legacy format or other cost parameters) and should be replaced.
+        Raises `HasherBusyError` if too many passwords are being hashed already."""
+        if not password_hash.startswith("scrypt$"):
+            if len(password_hash) != 64:   # e.g. the placeholder of deleted accounts
+                return False, False
+            # Cheap enough to not need the pool
+            return hmac.compare_digest(legacy_hash(password, username), password_hash), True
+
+        try:
+            _, n, r, p, salt, digest = password_hash.split("$")
+            n, r, p = int(n), int(r), int(p)
+            salt, digest = b64decode(salt), b64decode(digest)
+        except ValueError:
+            return False, False
+
+        matches = hmac.compare_digest(self._run(self._scrypt, password, salt, n, r, p), digest)
+        return matches, (n, r, p) != (self.n, self.r, self.p)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hashed": self.hashed, "rejected": self.rejected}
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HasherBusyError
+        try:
+            with tracing.span("password_hash"):   # including the wait for a free thread
+                result = self._executor.submit(function, *args).result()
+        finally:
+            self._slots.release()
+        with self._lock:
+            self.hashed += 1
+        return result
+
+    @staticmethod
+    def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+        # maxmem: scrypt needs 128 * n * r bytes; OpenSSL's default limit is 32 MiB
+        return hashlib.scrypt(bytes(password, 'utf-8'), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r, dklen=32)
+
+
+class RateLimiter:
+    """A token bucket per key (e.g. username or IP address): `per_minute` requests per minute on average,
+    up to `burst` at once. Only the `max_keys` most recently used keys are remembered. `per_minute=0` disables it."""
+
+    def __init__(self, per_minute: float, burst: int, max_keys: int = 65536) -> None:
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()   # key -> (tokens, last update)
+        self._lock = threading.Lock()
+        self.limited = 0
+
+    def acquire(self, key: str) -> float:
+        """Takes a token of `key`. Returns 0 if there was one, otherwise the seconds until there will be one."""
+        if not self.rate:
+            return 0.0
+
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                self.limited += 1
+                wait = (1 - tokens) / self.rate
+
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
@@ -0,0 +1,174 @@
+"""Profiles of the running server, started and stopped over HTTP (`/profiler`, see server.py).
+
+Two kinds of profiles:
+
+- "cprofile": deterministic profiles (cProfile) of the request handling, merged. Only one profile can be enabled
+  at a time (since Python 3.12, enabling a second one raises `ValueError`), so requests are profiled one at a time;
+  requests starting while another one is profiled run unprofiled. This slows the profiled requests down a lot.
+  The result is a pstats dump (`python -m pstats profile.pstats`, snakeviz, ...).
+- "sampling": a thread records the stacks of all other threads every `interval` seconds, including the websocket
+  event loop and the background threads, so this also shows where a server which "hangs" is stuck.
+  The profiled threads aren't slowed down (apart from sharing the GIL). The result is in the "collapsed stacks"
+  format (one `thread;outermost;...;innermost count` line per stack) of flamegraph.pl and speedscope.
+
+Only one profile can run at a time.
+"""
+import cProfile
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+PROFILE_MODES = ("cprofile", "sampling")
+DEFAULT_SAMPLING_INTERVAL = 0.005
+MIN_SAMPLING_INTERVAL = 0.001
+
+
+class ProfilerError(Exception): ...
+class ProfilerBusyError(ProfilerError): ...
+class ProfilerNotRunningError(ProfilerError): ...
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.samples = 0
+        self._stacks: Counter[str] = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> bytes:
+        self._stopped.set()
+        self._thread.join()
+        lines = [f"{stack} {count}\n" for stack, count in self._stacks.most_common()]
+        return bytes("".join(lines), "utf-8")
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)).replace(" ", "_"))
+                self._stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+
+class RequestProfiler:
+    """Collects the cProfile profiles of single requests (see `Profiler.request`)."""
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.skipped = 0      # requests which weren't profiled since another one was
+        self.running = threading.Lock()     # held while a request is profiled
+        self._stats: pstats.Stats | None = None
+        self._lock = threading.Lock()
+
+    def skip(self) -> None:
+        with self._lock:
+            self.skipped += 1
+
+    def add(self, profile: cProfile.Profile) -> None:
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self.requests += 1
+
+    def stop(self) -> bytes:
+        """The stats in the format of `pstats.Stats.dump_stats`."""
+        with self._lock:
+            return marshal.dumps({} if self._stats is None else self._stats.stats)
+
+
+class Profiler:
+    def __init__(self) -> None:
+        self.mode: str | None = None
+        self.started: float | None = None
+        self._sampler: SamplingProfiler | None = None
+        self._requests: RequestProfiler | None = None
+        self._lock = threading.Lock()
+
+    def start(self, mode: str, interval: float = DEFAULT_SAMPLING_INTERVAL) -> None:
+        """Raises `ProfilerBusyError` if a profile is running already, `ValueError` for an unknown mode or interval."""
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode {mode!r}")
+        if mode == "sampling" and not interval >= MIN_SAMPLING_INTERVAL:
+            raise ValueError(f"The sampling interval has to be at least {MIN_SAMPLING_INTERVAL} seconds")
+
+        with self._lock:
+            if self.mode is not None:
+                raise ProfilerBusyError(self.mode)
+            if mode == "sampling":
+                self._sampler = SamplingProfiler(interval)
+                self._sampler.start()
+            else:
+                self._requests = RequestProfiler()
+            self.mode = mode
+            self.started = time.time()
+
+    def stop(self) -> tuple[str, bytes]:
+        """Stops the profile and returns its mode and result. Raises `ProfilerNotRunningError` if none is running."""
+        with self._lock:
+            if self.mode is None:
+                raise ProfilerNotRunningError()
+            mode = self.mode
+            sampler, requests = self._sampler, self._requests
+            self.mode = self.started = self._sampler = self._requests = None
+
+        # Requests which are still running add their profiles to `requests`, which is discarded
+        return mode, (sampler.stop() if sampler is not None else requests.stop())
+
+    def status(self) -> dict:
+        with self._lock:
+            status = {"mode": self.mode, "started": self.started}
+            if self._sampler is not None:
+                status['samples'] = self._sampler.samples
+                status['interval'] = self._sampler.interval
+            if self._requests is not None:
+                status['requests'] = self._requests.requests
+                status['skippedRequests'] = self._requests.skipped
+            return status
+
+    @contextmanager
+    def request(self):
+        """Profiles the block (the handling of a request) if a cProfile profile is running
+        and no other request is being profiled."""
+        requests = self._requests
+        if requests is None:
+            yield
+            return
+        if not requests.running.acquire(blocking=False):
+            requests.skip()
+            yield
+            return
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:   # another profiling tool (e.g. a debugger) is active
+            requests.running.release()
+            requests.skip()
+            yield
+            return
+
+        try:
+            yield
+        finally:
+            profile.disable()
+            requests.running.release()
+            requests.add(profile)
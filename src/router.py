@@ -0,0 +1,105 @@
+"""Declarative routing of HTTP requests: method + path pattern -> handler.
+
+Patterns are literal paths with typed parameters, e.g. `/channels/<digits:channel_id>/messages`. A trailing slash
+is optional for every route. Routes without parameters are looked up in a dict; the others are grouped by their
+first path segment (which has to be literal), so finding the route of a request takes the same time
+no matter how many endpoints there are.
+
+The handlers are called with the path parameters (converted) as keyword arguments, plus whichever of
+the request's `query_components`, `token`, `username` and `post_data` they have parameters for.
+What a handler needs is worked out once, when the route is added.
+"""
+import inspect
+import re
+from typing import Callable, NamedTuple
+
+# name -> (regex, conversion)
+CONVERTERS: dict[str, tuple[str, Callable[[str], object]]] = {
+    "str": (r"[^/]+", str),
+    "int": (r"[0-9]+", int),
+    "digits": (r"[0-9]+", str),   # numeric IDs which are used as strings, e.g. channel IDs
+    "username": (r"[A-Za-z0-9\-_]{3,28}", str),
+}
+REQUEST_ARGS = ("query_components", "token", "username", "post_data")
+
+PARAMETER = re.compile(r"<(?:(\w+):)?(\w+)>")
+
+
+class Route(NamedTuple):
+    method: str
+    pattern: str
+    handler: Callable
+    converters: dict[str, Callable[[str], object]]
+    request_args: tuple[str, ...]   # the ones of REQUEST_ARGS the handler takes
+    auth: bool                      # only for logged in users; checked before calling the handler
+    body: dict[str, type] | None    # JSON object body: the required attributes and their types
+    body_error: str                 # the error message if the body doesn't have these attributes
+
+
+class Router:
+    def __init__(self) -> None:
+        self._exact: dict[tuple[str, str], Route] = {}
+        self._patterns: dict[tuple[str, str], list[tuple[re.Pattern, Route]]] = {}
+        self._prefix_errors: dict[tuple[str, str], tuple[int, str]] = {}
+
+    def add(
+            self,
+            method: str,
+            pattern: str,
+            handler: Callable,
+            auth: bool = False,
+            body: dict[str, type] | None = None,
+            body_error: str = "Invalid JSON object."
+    ) -> None:
+        """Routes requests to `handler`, which is a method of the request handler class (called on the instance).
+        `auth=True` answers requests of logged out users with 401. With `body`, the request body has to be
+        a JSON object with (at least) these attributes; otherwise the request is answered with 400 and `body_error`."""
+        request_args = tuple(arg for arg in REQUEST_ARGS if arg in inspect.signature(handler).parameters)
+        if body is not None and "post_data" not in request_args:
+            raise ValueError(f"{handler.__name__} has to take post_data")
+
+        converters = {}
+        regex = ""
+        position = 0
+        for match in PARAMETER.finditer(pattern):
+            converter_name, name = match.group(1) or "str", match.group(2)
+            converter_regex, converters[name] = CONVERTERS[converter_name]
+            regex += re.escape(pattern[position:match.start()]) + f"(?P<{name}>{converter_regex})"
+            position = match.end()
+        regex += re.escape(pattern[position:].rstrip("/")) + "/?"
+
+        route = Route(method, pattern, handler, converters, request_args, auth, body, body_error)
+        if not converters:
+            self._exact[method, pattern.rstrip("/") or "/"] = route
+            return
+
+        first_segment = self._first_segment(pattern)
+        if "<" in first_segment:
+            raise ValueError(f"The first segment of {pattern} has to be literal")
+        self._patterns.setdefault((method, first_segment), []).append((re.compile(regex), route))
+
+    def add_prefix_error(self, method: str, first_segment: str, code: int, message: str) -> None:
+        """Answers requests starting with `first_segment` (e.g. "/channels") which match no route with an error
+        instead of `not_found`."""
+        self._prefix_errors[method, first_segment] = (code, message)
+
+    def match(self, method: str, path: str) -> tuple[Route, dict[str, object]] | tuple[None, tuple[int, str] | None]:
+        """Returns the route and the (converted) path parameters. If no route matches,
+        returns None and the error registered for the first segment of the path (if any)."""
+        route = self._exact.get((method, path.rstrip("/") or "/"))
+        if route is not None:
+            return route, {}
+
+        first_segment = self._first_segment(path)
+        for regex, route in self._patterns.get((method, first_segment), ()):
+            regex_match = regex.fullmatch(path)
+            if regex_match is not None:
+                params = {name: route.converters[name](value) for name, value in regex_match.groupdict().items()}
+                return route, params
+
+        return None, self._prefix_errors.get((method, first_segment))
+
+    @staticmethod
+    def _first_segment(path: str) -> str:
+        end = path.find("/", 1)
+        return path if end == -1 else path[:end]
@@ -1,20 +1,45 @@
 #!/usr/bin/python
+import argparse
 import random
-import shutil
 from base64 import b64encode
 from http.server import HTTPServer as BaseHTTPServer, SimpleHTTPRequestHandler
 from http.cookies import SimpleCookie
 import os
 import json
-import re
+import logging
+import math
+import select
 import threading
 import time
 import hashlib
-from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
+from urllib.parse import unquote, urlparse
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from websockets import ConnectionClosed as WSConnectionClosed
 from websockets import WebSocketServerProtocol
 from websockets.server import serve as ws_serve
+from author_index import AuthorIndex
+from durable_writes import DURABILITY_MODES, DurableWriter
+from file_locks import PathLocks
+from jobs import JobQueue
+import logs
+from message_store import MESSAGE_BATCH_SIZE, MESSAGE_STORES, MessageStoreError, BatchNotFoundError, format_cursor, parse_cursor
+from meta_cache import JSONFileCache
+import metrics
+from passwords import HasherBusyError, PasswordHasher, RateLimiter
+import profiling
+from router import Router
+from sessions import SessionStore, SessionStoreError, UnknownUserError
+from sqlite_storage import SQLiteStorage
+from static_files import IMMUTABLE_MAX_AGE, StaticFiles, choose_encoding
+from storage import (
+    JSONStorage, Storage, StorageError, UnknownChannelError, AccountExistsError, PermissionDeniedError,
+    AlreadyMemberError, NotMemberError
+)
+import tracing
+from websocket_hub import WSBroadcaster, WSClientRegistry
+from write_coalescer import WriteCoalescer
 
 
 # -------- Utility --------
@@ -28,8 +53,26 @@ def validate_username(username: str) -> bool:
     )
 
 
-class FileReadError(Exception): ...
-class FileWriteError(Exception): ...
+def validate_channel_id(channel_id: str) -> bool:
+    # Channel IDs are used in file paths and as keys of in-memory indexes: "1/" or "../channels/1" must not alias "1"
+    return isinstance(channel_id, str) and channel_id != "" and all(ch in "0123456789" for ch in channel_id)
+
+
+class ReadError(Exception): ...
+
+
+class DiscardedBody:
+    """Takes the place of `wfile` once the headers of a response to a HEAD request are sent,
+    so the GET handlers can be used for HEAD as they are."""
+    def write(self, data: bytes) -> int:
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+
+def parse_query(query: str) -> dict[str, str]:
+    return dict(qc.partition("=")[::2] for qc in query.split("&")) if query else {}
 
 
 def generate_token() -> str:
@@ -38,17 +81,6 @@ def generate_token() -> str:
     return token
 
 
-def hash_password(password: str, username: str) -> str:
-    m = hashlib.sha256()
-    m.update(bytes(password, 'utf-8'))
-    salt1 = bytes("o8i3Sidf/B2", 'utf-8')
-    m.update(salt1)
-    salt2 = bytes(username[::-1], 'utf-8')
-    m.update(salt2)
-    password_hash = m.hexdigest()
-    return password_hash
-
-
 def hash_token(token: str) -> str:
     m = hashlib.sha256()
     m.update(bytes(token, 'utf-8'))
@@ -56,184 +88,349 @@ def hash_token(token: str) -> str:
     return token_hashed
 
 
-class WSConnectedClient:
-    def __init__(self, sock: WebSocketServerProtocol, username: str, token: str, channel_id: str) -> None:
-        self.sock = sock
-        self.username = username
-        self.token = token
-        self.channel_id = channel_id
+async def ws_send_error(sock: WebSocketServerProtocol, message: str):
+    response = {'error': message}
+    await sock.send(json.dumps(response))
+    ws_log.sampled(LOG_SAMPLE_RATE, "error_sent", error=message, client=str(sock.id))
 
-    def __hash__(self):
-        return hash((self.username, self.token, self.channel_id))
 
-    def __eq__(self, other):
-        if not isinstance(other, WSConnectedClient):
-            raise ValueError(f"Why would you compare {type(self)} with {type(other)}?")
-        return (self.username == other.username and
-                self.token == other.token and
-                self.channel_id == other.channel_id)
+async def ws_validate_session(username: str, token: str) -> bool:
+    """Checks a session without blocking the event loop: usually the session store can tell from memory,
+    otherwise (first time the user is seen, SQLite storage, expired session) it is checked on a worker thread."""
+    token_hash = hash_token(token)
+    token_valid = storage.sessions.validate_cached(username, token_hash)
+    if token_valid is None:
+        ws_auth_stats['slow'] += 1
+        token_valid = await asyncio.get_running_loop().run_in_executor(
+            ws_auth_executor, storage.sessions.validate, username, token_hash
+        )
+    else:
+        ws_auth_stats['cached'] += 1
+    return token_valid
 
 
-async def ws_send_error(sock: WebSocketServerProtocol, message: str):
-    response = {'error': message}
-    await sock.send(json.dumps(response))
-    print("[WS] Sent error message:", message)
+def is_channel_member(channel_id: str, username: str) -> bool:
+    try:
+        channel = storage.get_channel(channel_id)
+    except UnknownChannelError:
+        return False
+    return not channel['deleted'] and username in channel['members']
 
 
 async def ws_client_connect(sock: WebSocketServerProtocol):
-    global ws_clients_by_channel
+    """Clients subscribe to a channel by sending "{TOKEN} {USERNAME} {CHANNEL_ID}".
+    Once authenticated, a client can subscribe to more channels by just sending "{CHANNEL_ID}".\n
+    A client which reconnects appends the sequence number (`seq`) of the last message it got, "{CHANNEL_ID} {SEQ}",
+    and gets the messages it missed since, or `{"resync": CHANNEL_ID}` if they have to be loaded over HTTP."""
+    client = ws_broadcaster.register(sock)
     try:
         async for message in sock:
-            print("[WS] Received a message:", message)
+            # The message contains the token; it is redacted, but most of the message is useless anyway
+            ws_log.sampled(LOG_SAMPLE_RATE, "message_received", logging.DEBUG, client=str(sock.id), message=message[:400])
 
             try:
-                token, username, channel_id = message.split(" ")
-                assert len(username) <= 28, all(ch in "0123456789" for ch in channel_id)
+                parts = message.split(" ")
+                if len(parts) <= 2 and client.authenticated:
+                    token, username = client.token, client.username
+                else:
+                    assert 3 <= len(parts) <= 4
+                    token, username, *parts = parts
+                channel_id, last_seq = parts[0], parts[1] if len(parts) == 2 else None
+                assert len(username) <= 28
+                assert validate_channel_id(channel_id)
+                assert last_seq is None or (last_seq and all(ch in "0123456789" for ch in last_seq))
             except (ValueError, AssertionError):
-                await ws_send_error(sock, "Format should be: \"{TOKEN} {USERNAME} {CHANNEL_ID}\"")
+                await ws_send_error(sock, "Format should be: \"{TOKEN} {USERNAME} {CHANNEL_ID} [{SEQ}]\"")
+                continue
+
+            if client.authenticated and (username, token) != (client.username, client.token):
+                await ws_send_error(sock, "This connection is already authenticated as another user")
                 continue
 
-            user_dir = os.path.join(backend_dir, "accounts", username)
-            user_meta_file = os.path.join(user_dir, "meta.json")
+            if not client.authenticated:
+                if not validate_username(username):
+                    await ws_send_error(sock, "No user belongs to that username")
+                    continue
 
+                try:
+                    token_valid = await ws_validate_session(username, token)
+                except UnknownUserError:
+                    await ws_send_error(sock, "No user belongs to that username")
+                    continue
+                except (SessionStoreError, OSError):
+                    await ws_send_error(sock, "Internal server error (could not read user sessions file)")
+                    continue
+
+                if not token_valid:
+                    await ws_send_error(sock, "Invalid token")
+                    continue
+
+                client.username = username
+                client.token = token
+
+            # Checked on every subscription: resuming replays messages from before the client connected
             try:
-                with open(user_meta_file, 'r') as file:
-                    user_meta = json.load(file)
-            except FileNotFoundError:
-                await ws_send_error(sock, "No user belongs to that username")
+                is_member = await asyncio.get_running_loop().run_in_executor(
+                    ws_auth_executor, is_channel_member, channel_id, username
+                )
+            except (StorageError, OSError):
+                await ws_send_error(sock, "Internal server error (could not read channel)")
                 continue
-            except OSError:
-                await ws_send_error(sock, "Internal server error (could not read user meta file)")
+            if not is_member:
+                await ws_send_error(sock, "You are not a member of this channel")
                 continue
 
-            m = hashlib.sha256()
-            m.update(bytes(token, 'utf-8'))
-            token_hash = m.hexdigest()
-            if token_hash not in user_meta['validTokens']:
-                await ws_send_error(sock, "Invalid token")
-                continue
+            # Without recent messages to replay, the client can only resume if it hasn't missed anything
+            stored_seq = None
+            if last_seq is not None and not ws_broadcaster.has_recent(channel_id):
+                try:
+                    stored_seq = await asyncio.get_running_loop().run_in_executor(
+                        ws_auth_executor, message_writes.latest_sequence, channel_id
+                    )
+                except (MessageStoreError, OSError):
+                    pass
 
             # Success! Add user to connected clients list
-            print("New client connected:", username, channel_id)
-
-            client = WSConnectedClient(sock, username, token, channel_id)
-            if ws_clients_by_channel.get(channel_id) is not None and client in ws_clients_by_channel[channel_id]:
-                print("Client is already connected; removing other connection.")
-                ws_clients_by_channel[channel_id].remove(client)
-
-            try:
-                ws_clients_by_channel[channel_id].append(client)
-            except KeyError:
-                ws_clients_by_channel[channel_id] = [client]
+            # (and replay in the same step, so no message is published in between)
+            replaced = ws_clients.subscribe(client, channel_id) is not None
+            resumed = None
+            if last_seq is not None:
+                resumed = ws_broadcaster.resume(client, channel_id, int(last_seq), stored_seq)
+            ws_log.sampled(
+                LOG_SAMPLE_RATE, "subscribed", client=str(sock.id), username=username, channel=channel_id,
+                replacedConnection=replaced, lastSeq=last_seq, resumed=resumed
+            )
 
             # await sock.send("ok")  # TODO placeholder
 
     except WSConnectionClosed:
-        print("Client disconnected:", sock.id)
+        ws_log.sampled(LOG_SAMPLE_RATE, "disconnected", client=str(sock.id))
+    finally:
+        ws_broadcaster.unregister(client)
 
 
-async def ws_main():
-    print("Started Websocket server.")
-    async with ws_serve(ws_client_connect, "0.0.0.0", 8982):
+async def ws_main(port: int):
+    ws_log.info("started", port=port)
+    ws_broadcaster.attach(asyncio.get_running_loop())
+    async with ws_serve(ws_client_connect, "0.0.0.0", port):
         await asyncio.Future()
 
 
 # -------- Globals --------
 # WARNING: ./\ SHOULD NEVER BE ALLOWED FOR PATH SECURITY
 USERNAME_CHARSET = set("abcdefghijklmnopqrstuvwxyz-_")
-MESSAGE_BATCH_SIZE = 30
-ws_clients_by_channel: dict[int, list[WSConnectedClient]] = {}
+MAX_BATCHES_PER_REQUEST = 20        # for /channels/<id>/messages?batches=a-b
+MAX_MESSAGES_PER_REQUEST = 600      # for /channels/<id>/messages?before=<cursor>&limit=<n>
+STORAGE = "json"            # "json" (the files in backend_files/) or "sqlite" (backend_files/pigon.sqlite3); see storage.py
+MESSAGE_STORAGE = "log"     # for "json": "log" (append-only log per channel) or "batches" (one JSON file per batch); see message_store.py
+META_CACHE_SIZE = 4096      # how many parsed meta.json files are kept in memory
+SESSION_TTL = 60 * 60 * 24 * 90     # sessions expire 90 days after logging in
+MAX_SESSIONS_PER_USER = 32          # when logging in on more devices, the oldest session is logged out
+HTTP_PORT = 8000
+WS_PORT = 8982
+HTTP_CONCURRENCY = "threadpool"     # "single" (one request at a time), "threadpool" or "asyncio"; see main()
+HTTP_WORKERS = 16                   # number of worker threads for "threadpool" and "asyncio"
+KEEP_ALIVE_TIMEOUT = 5              # seconds an idle HTTP connection is kept open for the next request
+MAX_REQUESTS_PER_CONNECTION = 100   # HTTP connections are closed after this many requests
+HTTP_SOCKET_TIMEOUT = 30            # seconds a client may stall while sending a request or receiving a response
+MAX_DISCARDED_BODY_SIZE = 65536     # unexpected request bodies larger than this close the connection instead of being read
+WS_SEND_QUEUE_SIZE = 256            # websocket clients with more unsent messages than this get disconnected
+WS_REPLAY_MESSAGES = 128            # recent messages kept per channel for reconnecting websocket clients (at most WS_SEND_QUEUE_SIZE)
+WS_REPLAY_CHANNELS = 1000           # channels whose recent messages are kept; the least recently active are dropped
+WS_AUTH_WORKERS = 2                 # threads checking websocket sessions which aren't in memory (keeps the event loop free)
+HISTORICAL_BATCH_MAX_AGE = 300      # seconds browsers may reuse a message batch before the latest one without asking
+WRITE_DURABILITY = "fsync-file"     # "none", "fsync-file", "fsync-dir" or "group-commit"; see durable_writes.py
+GROUP_COMMIT_INTERVAL = 1.0         # seconds between two fsyncs with "group-commit"
+MESSAGE_WRITE_DELAY = 0.005         # seconds new messages of a channel are collected to store them with one write
+PASSWORD_HASH_WORKERS = 2           # threads running scrypt; each hash takes ~50 ms of CPU and 16 MiB of memory
+PASSWORD_HASH_MAX_WAITING = 6       # logins waiting for a hashing thread; more get "503 Service Unavailable"
+SCRYPT_COST = 2 ** 14               # scrypt's n; existing hashes with another cost are rehashed on login
+LOGIN_ATTEMPTS_PER_USER = 10        # login attempts per username per minute (and at once); 0: unlimited
+LOGIN_ATTEMPTS_PER_IP = 30          # login and register attempts per IP address per minute (and at once); 0: unlimited
+JOB_WORKERS = 2                     # threads purging deleted accounts and channels in the background
+JOB_MAX_ATTEMPTS = 5                # failed jobs are retried after 1, 2, 4, ... seconds until this many attempts failed
+LOG_LEVEL = "info"                  # "debug", "info", "warning" or "error"
+LOG_FORMAT = "json"                 # "json" (one object per line) or "text"; see logs.py
+LOG_SAMPLE_RATE = 0.1               # fraction of the per-request / per-websocket-message events which are logged
+LOG_QUEUE_SIZE = 10000              # log records waiting to be written; more are dropped instead of blocking
+SLOW_REQUEST_THRESHOLD = 1.0        # seconds; slower requests are logged with the time per span (see tracing.py); 0: off
+http_log = logs.get_logger("http")
+ws_log = logs.get_logger("websocket")
+ws_clients = WSClientRegistry()
+ws_broadcaster = WSBroadcaster(ws_clients, WS_SEND_QUEUE_SIZE, WS_REPLAY_MESSAGES, WS_REPLAY_CHANNELS)
+ws_auth_executor = ThreadPoolExecutor(WS_AUTH_WORKERS, thread_name_prefix="ws-auth")
+ws_auth_stats = {"cached": 0, "slow": 0}    # session checks answered from memory / on ws_auth_executor
+durable_writer = DurableWriter(WRITE_DURABILITY, GROUP_COMMIT_INTERVAL)
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_WAITING, SCRYPT_COST)
+user_login_limiter = RateLimiter(LOGIN_ATTEMPTS_PER_USER, LOGIN_ATTEMPTS_PER_USER)
+ip_login_limiter = RateLimiter(LOGIN_ATTEMPTS_PER_IP, LOGIN_ATTEMPTS_PER_IP)
+storage: Storage | None = None              # set up in main(), see open_storage()
+message_writes: WriteCoalescer | None = None
+jobs: JobQueue | None = None
+static_files: StaticFiles | None = None     # the frontend files, loaded in main()
+profiler = profiling.Profiler()             # controlled through /profiler
 
 
 class HTTPHandler(SimpleHTTPRequestHandler):
-    """This handler uses server.base_path instead of always using os.getcwd()"""
+    """Static files are served from `static_files` (in memory), everything else is routed by `routes`.\n
+    Connections are kept open for more requests (HTTP/1.1), so every response needs a Content-Length
+    (or has to be chunked). See `handle` for when they are closed."""
+    protocol_version = "HTTP/1.1"
+    timeout = HTTP_SOCKET_TIMEOUT   # while reading a request or sending a response
+    # The headers and the body are separate writes; with Nagle's algorithm, the body of a response on a kept-alive
+    # connection waits for the client's delayed ACK of the headers (~40 ms)
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        """Like `BaseHTTPRequestHandler.handle`, but an idle connection is closed after `KEEP_ALIVE_TIMEOUT` seconds,
+        or as soon as the server is busy (see `wait_for_request`), since it takes up a worker thread while waiting.
+        After `MAX_REQUESTS_PER_CONNECTION` requests, the last response asks the client to close the connection."""
+        self.requests_handled = 0
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.wait_for_request():
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        self.requests_handled += 1
+        self.request_started = time.perf_counter()
+        self.status_code = None
+        self.route_label = "unmatched"   # set by `dispatch`
+        try:
+            with profiler.request():
+                super().handle_one_request()
+        finally:
+            trace = tracing.finish()   # started in `parse_request`
+
+        if self.status_code is not None:   # None: the client closed the connection instead of sending a request
+            method = self.command or "-"
+            path = self.path if self.command else None
+            duration = time.perf_counter() - self.request_started
+            metrics.HTTP_REQUESTS.inc(method, self.route_label, str(self.status_code))
+            metrics.HTTP_REQUEST_SECONDS.observe(duration, method, self.route_label)
+            # Errors are always logged, the rest only sampled
+            http_log.sampled(
+                1 if self.status_code >= 500 else LOG_SAMPLE_RATE, "request",
+                logging.ERROR if self.status_code >= 500 else logging.INFO,
+                method=method, route=self.route_label, path=path, status=self.status_code,
+                ms=round(duration * 1000, 2), client=self.client_address[0]
+            )
+            if trace is not None and duration >= SLOW_REQUEST_THRESHOLD:
+                http_log.warning(
+                    "slow_request", method=method, route=self.route_label, path=path, status=self.status_code,
+                    ms=round(duration * 1000, 2), spans=trace.breakdown(duration)
+                )
+
+    def log_request(self, code='-', size='-'):
+        pass   # see handle_one_request
+
+    def log_message(self, format, *args):
+        # Called for malformed requests and timeouts; the base class writes to stderr right away
+        http_log.warning("protocol_error", message=format % args, client=self.client_address[0])
+
+    def parse_request(self) -> bool:
+        self.request_started = time.perf_counter()   # not counting the wait for the request line
+        if SLOW_REQUEST_THRESHOLD > 0:
+            tracing.start()
+        with tracing.span("parse"):
+            return super().parse_request()
+
+    def wait_for_request(self) -> bool:
+        """Waits until the client sends the next request (or closes the connection). Returns False if
+        it doesn't within `KEEP_ALIVE_TIMEOUT` seconds, or if every worker thread is taken in the meantime."""
+        # The previous read may have buffered (part of) the next request already
+        self.connection.setblocking(False)
+        try:
+            if self.rfile.peek(1):
+                return True
+        finally:
+            self.connection.settimeout(self.timeout)
+
+        deadline = time.monotonic() + KEEP_ALIVE_TIMEOUT
+        while not self.server.is_busy():
+            readable, _, _ = select.select([self.connection], [], [], min(0.25, deadline - time.monotonic()))
+            if readable:
+                return True
+            if time.monotonic() >= deadline:
+                return False
+        return False
+
+    def send_response(self, code, message=None):
+        self.status_code = code
+        super().send_response(code, message)
+        if self.close_connection or self.requests_handled >= MAX_REQUESTS_PER_CONNECTION or self.server.is_busy():
+            self.send_header('Connection', "close")   # also sets close_connection
+
+    def end_headers(self):
+        super().end_headers()
+        if self.command == "HEAD":   # a body would be read as the start of the next response
+            self.wfile = DiscardedBody()
+
+    def send_json(self, response, code: int = 200):
+        body = bytes(json.dumps(response), "utf8")
+        self.send_response(code)
+        self.send_header('Content-Type', "text/json")
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-    def translate_path(self, path):
-        path = SimpleHTTPRequestHandler.translate_path(self, path)
-        relpath = os.path.relpath(path, os.getcwd())
-        fullpath = os.path.join(self.server.base_path, relpath)
-        return fullpath
+    def send_error(self, code: int, message: str, explain: str = None):
+        self.send_json({"error": message}, code)
 
-    def send_error(self, code: int, message: str):
+    def send_retry_later(self, code: int, message: str, retry_after: float):
+        """Like `send_error`, for 429 (rate limited) and 503 (overloaded) responses."""
+        body = bytes(json.dumps({"error": message}), "utf8")
         self.send_response(code)
         self.send_header('Content-Type', "text/json")
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Retry-After', str(max(1, math.ceil(retry_after))))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_redirect(self, location: str):
+        self.send_response(303)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', "0")
         self.end_headers()
-        response = {"error": message}
-        self.wfile.write(bytes(json.dumps(response), "utf8"))
-
-    def read_json_file(
-            self,
-            file_path: str,
-            error_message_notfound: str = "The requested file does not exist.",
-            error_message_os: str = "",
-            send_errors: bool = True
-    ):
-        """Tries to read a JSON file in the server backend using the provided absolute `file_path`.\n
-        If it fails, it will respond to the HTTP request automatically and then raise a `FileReadError`."""
-        try:
-            with open(file_path, 'r') as file:
-                return json.load(file)
-
-        except FileNotFoundError:
-            if send_errors:
-                self.send_error(404, error_message_notfound)
-            raise FileReadError
-
-        except OSError:
-            if error_message_os: error_message_os += ' '
-            if send_errors:
-                self.send_error(500, f"(Server Error) Could not read {error_message_os}file.")
-            raise FileReadError
-
-    def write_json_file(
-            self,
-            file_path: str,
-            json_object,
-            error_message_os: str = "",
-            create_file: bool = False,
-            error_message_already_exists: str = "(Server Error) Did not create {}file because it should already exist."
-    ):
-        """Tries to write to a JSON file in the server backend using the provided absolute `file_path`.\n
-        If `create_file` is False and the file does not already exist,
-        it will respond to the HTTP request automatically using `error_message_notfound` and then raise a `FileWriteError`.
-        `error_message_notfound` should have curly brackets for formatting stuff.\n
-        If it fails because of `OSError`, it will respond to the HTTP request automatically
-        using `error_message_os` and then raise a `FileWriteError`."""
-        if error_message_os: error_message_os += ' '
-
-        if create_file is False:
-            if not os.path.exists(file_path):  # UNTESTED
-                self.send_error(500, error_message_already_exists.format(error_message_os))
-                raise FileWriteError
 
+    def read_account(self, username: str, error_message_notfound: str = "User not found.") -> dict:
+        """Tries to get an account from `storage`. The returned dict is shared and must not be modified.\n
+        If it fails, it will respond to the HTTP request automatically and then raise a `ReadError`."""
         try:
-            with open(file_path, 'w') as file:
-                json.dump(json_object, file)
+            return storage.get_account(username)
 
-        except OSError:
-            self.send_error(500, f"(Server Error) Could not write to {error_message_os}file.")
-            raise FileWriteError
+        except UnknownUserError:
+            self.send_error(404, error_message_notfound)
+            raise ReadError
 
-    def do_POST_register(self):
-        content_length = int(self.headers["Content-Length"])
-        post_data_raw = self.rfile.read(content_length)
+        except (StorageError, OSError):
+            self.send_error(500, "(Server Error) Could not read user meta.")
+            raise ReadError
 
+    def read_channel(self, channel_id: str, error_message_notfound: str = "Channel not found.") -> dict:
+        """Tries to get a channel from `storage`. The returned dict is shared and must not be modified.\n
+        If it fails, it will respond to the HTTP request automatically and then raise a `ReadError`."""
         try:
-            post_data = json.loads(post_data_raw)
-        except ValueError:
-            self.send_error(400, "Content Type should be JSON.")
-            return
+            channel_meta = storage.get_channel(channel_id)
 
-        try:
-            username = post_data["username"]
-            displayname = post_data["displayname"]
-            password = post_data["password"]
-            public_key = post_data["publicKey"]
-            assert isinstance(username, str) and isinstance(displayname, str) and isinstance(password, str) and isinstance(public_key, str)
-        except (KeyError, AssertionError):
-            self.send_error(400,
-                            "JSON object needs to have attributes: 'username', 'displayname', 'password', 'publicKey'.")
-            return
+        except UnknownChannelError:
+            self.send_error(404, error_message_notfound)
+            raise ReadError
+
+        except (StorageError, OSError):
+            self.send_error(500, "(Server Error) Could not read channel meta.")
+            raise ReadError
+
+        if channel_meta['deleted']:   # not purged yet
+            self.send_error(404, error_message_notfound)
+            raise ReadError
+        return channel_meta
+
+    def do_POST_register(self, post_data: dict):
+        username = post_data["username"]
+        displayname = post_data["displayname"]
+        password = post_data["password"]
+        public_key = post_data["publicKey"]
 
         if not validate_username(username):
             self.send_error(400,
@@ -252,14 +449,17 @@ class HTTPHandler(SimpleHTTPRequestHandler):
             self.send_error(400, "Public key should be in Base64-encoded \"raw\" format.")
             return
 
-        user_dir = os.path.join(backend_dir, "accounts", username)
-        meta_file = os.path.join(user_dir, "meta.json")
+        retry_after = ip_login_limiter.acquire(self.client_address[0])
+        if retry_after:
+            self.send_retry_later(429, "Too many attempts, please try again later.", retry_after)
+            return
 
-        if os.path.exists(meta_file):
-            self.send_error(400, "User already exists.")
+        try:
+            password_hash = password_hasher.hash(password)
+        except HasherBusyError:
+            self.send_retry_later(503, "The server is busy, please try again in a moment.", 1)
             return
 
-        password_hash = hash_password(password, username)
         generated_token = generate_token()
         generated_token_hash = hash_token(generated_token)
 
@@ -267,42 +467,34 @@ class HTTPHandler(SimpleHTTPRequestHandler):
             "displayname": displayname,
             "accountCreated": int(time.time()),
             "passwordHash": password_hash,
-            "validTokens": [generated_token_hash],
             "deleted": False,
             "publicKey": public_key,
             "channels": {}
         }
 
-        os.makedirs(user_dir)
         try:
-            self.write_json_file(meta_file, meta, "user meta", True)
-        except FileWriteError:
+            storage.create_account(username, meta)
+        except AccountExistsError:
+            self.send_error(400, "User already exists.")
             return
-
-        # Success! User dir and meta created. Return generated token.
-        self.send_response(200)
-        self.send_header('Content-Type', "text/json")
-        self.end_headers()
-        response = {'generatedToken': generated_token}
-        self.wfile.write(bytes(json.dumps(response), "utf8"))
-
-    def do_POST_login(self):
-        content_length = int(self.headers["Content-Length"])
-        post_data_raw = self.rfile.read(content_length)
-
-        try:
-            post_data = json.loads(post_data_raw)
-        except ValueError:
-            self.send_error(400, "Content Type should be JSON.")
+        except (StorageError, OSError):
+            self.send_error(500, "(Server Error) Could not write to user meta file.")
             return
 
         try:
-            username = post_data["username"]
-            password = post_data["password"]
-        except KeyError:
-            self.send_error(400, "JSON object needs to have attributes: 'username', 'password'.")
+            storage.sessions.add(username, generated_token_hash)
+        except (SessionStoreError, OSError):
+            self.send_error(500, "(Server Error) Could not write to user sessions file.")
             return
 
+        # Success! User dir and meta created. Return generated token.
+        response = {'generatedToken': generated_token}
+        self.send_json(response)
+
+    def do_POST_login(self, post_data: dict):
+        username = post_data["username"]
+        password = post_data["password"]
+
         if not validate_username(username):
             self.send_error(400, "Username should a 3-28 character string of alphanumeric characters including - and _")
             return
@@ -311,194 +503,120 @@ class HTTPHandler(SimpleHTTPRequestHandler):
             self.send_error(400, "Password should have a length between 1 and 128 characters.")
             return
 
-        user_dir = os.path.join(backend_dir, "accounts", username)
-        user_meta_file = os.path.join(user_dir, "meta.json")
+        retry_after = max(ip_login_limiter.acquire(self.client_address[0]), user_login_limiter.acquire(username))
+        if retry_after:
+            self.send_retry_later(429, "Too many login attempts, please try again later.", retry_after)
+            return
 
         try:
-            user_meta = self.read_json_file(user_meta_file, "User does not exist.", "user meta")
-        except FileReadError:
+            user_meta = self.read_account(username, "User does not exist.")
+        except ReadError:
             return
 
         if user_meta['deleted']:
             self.send_error(404, "User deleted.")
             return
 
-        stored_password_hash = user_meta["passwordHash"]
-        password_hash = hash_password(password, username)
+        try:
+            password_correct, hash_outdated = password_hasher.verify(password, user_meta["passwordHash"], username)
+        except HasherBusyError:
+            self.send_retry_later(503, "The server is busy, please try again in a moment.", 1)
+            return
 
-        if stored_password_hash != password_hash:
+        if not password_correct:
             self.send_error(401, "Incorrect password.")
             return
 
+        # Legacy hashes (and those with an old cost) are replaced while the password is known
+        if hash_outdated:
+            try:
+                storage.set_password_hash(username, password_hasher.hash(password))
+            except (HasherBusyError, StorageError, OSError):   # keep the old hash until the next login
+                http_log.warning("rehash_failed", username=username)
+
         generated_token = generate_token()
         generated_token_hashed = hash_token(generated_token)
-        user_meta['validTokens'].append(generated_token_hashed)
 
         try:
-            self.write_json_file(user_meta_file, user_meta, "user meta", False)
-        except FileWriteError:
+            storage.sessions.add(username, generated_token_hashed)
+        except (SessionStoreError, OSError):
+            self.send_error(500, "(Server Error) Could not write to user sessions file.")
             return
 
         # Success! Return generated token
-        self.send_response(200)
-        self.send_header('Content-Type', "text/json")
-        self.end_headers()
-
         response = {'generatedToken': generated_token}
-        self.wfile.write(bytes(json.dumps(response), "utf8"))
-
-    def do_POST_send_message(self, token: str, username: str):
-        content_length = int(self.headers["Content-Length"])
-        post_data_raw = self.rfile.read(content_length)
-
-        try:
-            post_data = json.loads(post_data_raw)
-        except ValueError:
-            self.send_error(400, "Content Type should be JSON.")
-            return
+        self.send_json(response)
 
-        if not self.validate_auth(token, username, True):
-            return
-
-        try:
-            sent_message_text = post_data["text"].strip()
-            channel_id = post_data["channel"]
-            temp_id = post_data["tempID"]
-            assert sent_message_text and channel_id and temp_id and isinstance(sent_message_text, str) and isinstance(channel_id, str) and isinstance(temp_id, str)
-        except (KeyError, AssertionError, ValueError):
+    def do_POST_send_message(self, username: str, post_data: dict):
+        sent_message_text = post_data["text"].strip()
+        channel_id = post_data["channel"]
+        temp_id = post_data["tempID"]
+        if not (channel_id and temp_id):
             self.send_error(400, "JSON object needs to have attributes: 'text', 'channel', 'tempID'.")
             return
+        if not validate_channel_id(channel_id):
+            self.send_error(400, "Invalid channel ID.")
+            return
 
         if not 1 <= len(sent_message_text) < 4096:
             self.send_error(400, "Message text should have a length between 1 and 4096.")
             return
 
-        channel_dir = os.path.join(backend_dir, "channels", channel_id)
-        channel_meta_file = os.path.join(channel_dir, "meta.json")
-
         try:
-            channel_meta = self.read_json_file(channel_meta_file, "Channel not found.", "channel meta")
-        except FileReadError:
+            channel_meta = self.read_channel(channel_id)
+        except ReadError:
             return
 
         if username not in channel_meta['members']:
             self.send_error(403, "You do not have permission to send messages in this channel!")
             return
 
-        batch_id = channel_meta['latestMessageBatch']
-        channel_messages_file = os.path.join(channel_dir, "message_batches", str(batch_id) + ".json")
-
-        try:
-            channel_messages = self.read_json_file(channel_messages_file, "Messages batch not found.", "messages batch")
-        except FileReadError:
-            return
-
-        created_new_batch = False
-        if len(channel_messages) >= MESSAGE_BATCH_SIZE:
-            created_new_batch = True
-            batch_id += 1
-            channel_messages_file = os.path.join(channel_dir, "message_batches", str(batch_id) + ".json")
-            channel_meta['latestMessageBatch'] = batch_id
-            try:
-                self.write_json_file(channel_meta_file, channel_meta, "channel meta", False)
-            except FileWriteError:
-                return
-            channel_messages = []
-
         message_obj = {
             "author": username,
             "text": sent_message_text,
             "timestamp": int(time.time()),
         }
-        channel_messages.append(message_obj)
-
-        try:
-            self.write_json_file(channel_messages_file, channel_messages, "messages batch", created_new_batch)
-        except FileWriteError:
-            return
 
-        # Success! Append message to latest message batch (or create a new one if necessary)
-        #          Also send message to every connected websocket client of that channel
-        if ws_clients_by_channel.get(channel_id) is not None:
-            for client in ws_clients_by_channel[channel_id]:
-                print(f"Sending message to WS Client {client.username}")
-
-                if client.username == username:
-                    message_obj["tempID"] = temp_id
-                response_ws = json.dumps(message_obj)
-                if client.username == username:
-                    del message_obj["tempID"]
-
-                try:
-                    asyncio.run(client.sock.send(response_ws))
-                except WSConnectionClosed:
-                    print(f"WS Connection to {client.username} was closed!")
-                # print("DEBUG after send")
-
-        self.send_response(200)
-        self.send_header('Content-Type', "text/json")
-        self.end_headers()
-        response = {}
-        self.wfile.write(bytes(json.dumps(response), "utf8"))
+        # Also send the message to every connected websocket client of that channel (on the websocket thread)
+        # as soon as it is stored; the coalescer stores messages in groups and calls this in the stored order
+        def broadcast():
+            with tracing.span("broadcast"):
+                ws_broadcaster.publish(channel_id, message_obj, username, temp_id)
 
-    def do_POST_delete_all_other_sessions(self, token: str, username: str):
-        if not self.validate_auth(token, username, send_errors=True):
-            # self.send_error(401, "Not authorized.")
+        try:
+            batch_id = message_writes.append(channel_id, message_obj, broadcast)
+        except (MessageStoreError, OSError):
+            self.send_error(500, "(Server Error) Could not store message.")
             return
 
-        user_dir = os.path.join(backend_dir, "accounts", username)
-        meta_file = os.path.join(user_dir, "meta.json")
-
         try:
-            user_meta = self.read_json_file(meta_file, "User does not exist.", "user meta")
-        except FileReadError:
+            storage.message_stored(channel_id, batch_id, message_obj)
+        except (StorageError, OSError):
+            self.send_error(500, "(Server Error) Could not write to channel meta file.")
             return
 
-        user_meta['validTokens'] = [token]
+        # Success! Appended message to latest message batch (or created a new one if necessary)
+        response = {"seq": message_obj['seq']}
+        self.send_json(response)
 
+    def do_POST_delete_all_other_sessions(self, token: str, username: str):
         try:
-            self.write_json_file(meta_file, user_meta, "user meta", False)
-        except FileWriteError:
+            storage.sessions.revoke_all_except(username, hash_token(token))
+        except (SessionStoreError, OSError):
+            self.send_error(500, "(Server Error) Could not write to user sessions file.")
             return
 
         # Success! Deleted all other sessions
-        self.send_response(200)
-        self.send_header('Content-Type', "text/json")
-        self.end_headers()
         response = {}
-        self.wfile.write(bytes(json.dumps(response), "utf8"))
+        self.send_json(response)
 
 
-    def do_POST_create_channel(self, token: str, username: str):
-        content_length = int(self.headers["Content-Length"])
-        post_data_raw = self.rfile.read(content_length)
-
-        try:
-            post_data = json.loads(post_data_raw)
-        except ValueError:
-            self.send_error(400, "Content Type should be JSON.")
-            return
-
-        try:
-            channel_name = post_data['channelName'].strip()
-            encrypted_channel_key = post_data['encryptedChannelKey']
-            channel_key_iv = post_data['iv']
-        except (KeyError, ValueError, TypeError):
-            self.send_error(400, "Channel Name/Encrypted Channel Key is missing or invalid; should be string")
-            return
-
-        if not self.validate_auth(token, username, True):
-            return
+    def do_POST_create_channel(self, username: str, post_data: dict):
+        channel_name = post_data['channelName'].strip()
+        encrypted_channel_key = post_data['encryptedChannelKey']
+        channel_key_iv = post_data['iv']
 
         channel_id = str(time.time_ns() + random.randint(1, 100))
-        channel_dir = os.path.join(backend_dir, "channels", channel_id)
-        message_batches_dir = os.path.join(channel_dir, "message_batches")
-        current_message_batch_file = os.path.join(message_batches_dir, "1.json")
-        channel_meta_file = os.path.join(channel_dir, "meta.json")
-
-        os.mkdir(channel_dir)
-        os.mkdir(message_batches_dir)
-
         channel_meta = {
             "name": channel_name,
             "timestampCreated": int(time.time()),
@@ -507,471 +625,477 @@ class HTTPHandler(SimpleHTTPRequestHandler):
             "deleted": False
         }
 
-        self.write_json_file(channel_meta_file, channel_meta, "channel meta", True)
-        self.write_json_file(current_message_batch_file, [], "message batch", True)
-
-        # Successfully created channel! Add user to channel
-        user_meta_file = os.path.join(backend_dir, "accounts", username, "meta.json")
-        user_meta = self.read_json_file(user_meta_file, "User doesn't exist but literally should because already authorized.", "user meta")
-        user_meta['channels'][channel_id] = {
-            "encryptedKey": encrypted_channel_key,
-            "iv": channel_key_iv
-        }
-        self.write_json_file(user_meta_file, user_meta, "user meta")
+        try:
+            storage.create_channel(channel_id, channel_meta, username, encrypted_channel_key, channel_key_iv)
+        except (StorageError, MessageStoreError, OSError):
+            self.send_error(500, "(Server Error) Could not create channel.")
+            return
 
-        self.send_response(200)
-        self.send_header('Content-Type', "text/json")
-        self.end_headers()
+        # Successfully created channel (and added user to it)!
         response = {
             "channelID": channel_id
         }
 
-        self.wfile.write(bytes(json.dumps(response), "utf8"))
-
+        self.send_json(response)
 
-    def do_POST_delete_channel(self, token: str, username: str):
-        content_length = int(self.headers["Content-Length"])
-        post_data_raw = self.rfile.read(content_length)
 
-        try:
-            post_data = json.loads(post_data_raw)
-        except ValueError:
-            self.send_error(400, "Content Type should be JSON.")
+    def do_POST_delete_channel(self, username: str, post_data: dict):
+        channel_id = post_data['channelID'].strip()
+        if not validate_channel_id(channel_id):
+            self.send_error(400, "Invalid channel ID.")
             return
 
+        # The channel is gone for its members right away; the messages and memberships are purged in the background
         try:
-            channel_id = post_data['channelID'].strip()
-        except (KeyError, ValueError, TypeError):
-            self.send_error(400, "Channel Name is missing or invalid; should be string")
-            return
-
-        if not self.validate_auth(token, username, True):
+            storage.mark_channel_deleted(channel_id, username)
+            job = jobs.submit("delete_channel", channel_id=channel_id)
+        except UnknownChannelError:
+            self.send_error(404, "Channel does not exist")
             return
-
-        channel_dir = os.path.join(backend_dir, "channels", channel_id)
-        channel_meta_file = os.path.join(channel_dir, "meta.json")
-
-        try:
-            channel_meta = self.read_json_file(channel_meta_file, "Channel does not exist", "channel meta")
-        except FileReadError:
-            return
-
-        if username not in channel_meta['members']:
+        except PermissionDeniedError:
             self.send_error(403, "You do not have permission to delete this channel!")
             return
-
-        if not channel_dir.strip() or len(channel_dir) < 20:
-            print("Channel Dir empty somehow; preventing deleting root!")
+        except (StorageError, OSError):
+            self.send_error(500, "(Server Error) Could not delete channel.")
             return
 
-        try:
-            shutil.rmtree(channel_dir)
-        except FileNotFoundError:  # channel didn't exist in the first place
-            pass
-
-        # Success! Deleted channel. Remove it from every user's meta file as well
-        for user in channel_meta['members']:
-            user_meta_file = os.path.join(backend_dir, "accounts", user, "meta.json")
-
-            try:
-                user_meta = self.read_json_file(user_meta_file, "User does not exist somehow", "user meta", False)
-            except FileReadError:   # user doesn't exist for some reason
-                print("User doesn't exist??")
-                continue
-
-            try:
-                del user_meta['channels'][channel_id]
-            except KeyError:   # user wasn't in channel for some reason
-                print("User wasn't in channel??")
-                continue
-
-            try:
-                self.write_json_file(user_meta_file, user_meta, "user meta", False)
-            except FileWriteError:
-                continue
+        # Success! Channel deleted, it is removed from every user's meta file by the job
+        response = {"channelID": channel_id, "jobID": job['id']}
+        self.send_json(response, 202)
 
 
-        self.send_response(200)
-        self.send_header('Content-Type', "text/json")
-        self.end_headers()
-        response = {}
-        self.wfile.write(bytes(json.dumps(response), "utf8"))
-
-
-    def do_POST_add_member_to_channel(self, token: str, username: str):
-        content_length = int(self.headers["Content-Length"])
-        post_data_raw = self.rfile.read(content_length)
-
-        try:
-            post_data = json.loads(post_data_raw)
-        except ValueError:
-            self.send_error(400, "Content Type should be JSON.")
-            return
-
-        try:
-            channel_id: str = post_data['channelID'].strip()
-            new_member: str = post_data['newMember'].strip()
-            encrypted_channel_key = post_data['encryptedChannelKey']
-            channel_key_iv: str = post_data['iv']
-            assert isinstance(channel_id, str) and isinstance(new_member, str) and isinstance(encrypted_channel_key, str) and isinstance(channel_key_iv, str)
-            assert validate_username(new_member)
-        except (KeyError, ValueError, TypeError, AssertionError):
+    def do_POST_add_member_to_channel(self, username: str, post_data: dict):
+        channel_id: str = post_data['channelID'].strip()
+        new_member: str = post_data['newMember'].strip()
+        encrypted_channel_key: str = post_data['encryptedChannelKey']
+        channel_key_iv: str = post_data['iv']
+        if not validate_channel_id(channel_id) or not validate_username(new_member):
             self.send_error(400, "Channel Name/New Member is missing or invalid; should be string")
             return
 
-        if not self.validate_auth(token, username, True):
-            return
-
-        new_member_meta_file = os.path.join(backend_dir, "accounts", new_member, "meta.json")
         try:
-            new_member_meta = self.read_json_file(new_member_meta_file, "Member does not exist!", "member meta")
-        except FileReadError:
+            storage.add_member(channel_id, username, new_member, encrypted_channel_key, channel_key_iv)
+        except UnknownUserError:
+            self.send_error(404, "Member does not exist!")
             return
-
-        if channel_id in new_member_meta['channels'].keys():
+        except AlreadyMemberError:
             self.send_error(400, "Member is already in the channel!")
             return
-
-        channel_dir = os.path.join(backend_dir, "channels", channel_id)
-        channel_meta_file = os.path.join(channel_dir, "meta.json")
-        try:
-            channel_meta = self.read_json_file(channel_meta_file, "Channel does not exist!", "channel meta")
-        except FileReadError:
+        except UnknownChannelError:
+            self.send_error(404, "Channel does not exist!")
             return
-
-        if username not in channel_meta['members']:
+        except PermissionDeniedError:
             self.send_error(403, "You do not have permission to add members to this channel!")
             return
-
-        # if new_member in channel_meta['members']:
-        #     self.send_error(400, "Member is already in the channel!")
-        #     return
-
-        new_member_meta['channels'][channel_id] = {
-            "encryptedKey": encrypted_channel_key,
-            "iv": channel_key_iv
-        }
-        channel_meta['members'].append(new_member)
-
-        try:
-            self.write_json_file(new_member_meta_file, new_member_meta, "member meta")
-        except FileWriteError:
-            return
-
-        try:
-            self.write_json_file(channel_meta_file, channel_meta, "channel meta")
-        except FileWriteError:
+        except (StorageError, OSError):
+            self.send_error(500, "(Server Error) Could not write to member or channel meta file.")
             return
 
         # Success! Added member to channel
-        self.send_response(200)
-        self.send_header('Content-Type', "text/json")
-        self.end_headers()
         response = {}
-        self.wfile.write(bytes(json.dumps(response), "utf8"))
-
+        self.send_json(response)
 
-    def do_POST_remove_member_from_channel(self, token: str, username: str):
-        content_length = int(self.headers["Content-Length"])
-        post_data_raw = self.rfile.read(content_length)
 
-        try:
-            post_data = json.loads(post_data_raw)
-        except ValueError:
-            self.send_error(400, "Content Type should be JSON.")
-            return
-
-        try:
-            channel_id: str = post_data['channelID'].strip()
-            member: str = post_data['newMember'].strip()
-            assert validate_username(member)
-        except (KeyError, ValueError, TypeError, AssertionError):
+    def do_POST_remove_member_from_channel(self, username: str, post_data: dict):
+        channel_id: str = post_data['channelID'].strip()
+        member: str = post_data['newMember'].strip()
+        if not validate_channel_id(channel_id) or not validate_username(member):
             self.send_error(400, "Channel Name/New Member is missing or invalid; should be string")
             return
 
-        if not self.validate_auth(token, username, True):
-            return
-
-        member_meta_file = os.path.join(backend_dir, "accounts", member, "meta.json")
         try:
-            member_meta = self.read_json_file(member_meta_file, "Member does not exist!", "member meta")
-        except FileReadError:
+            storage.remove_member(channel_id, username, member)
+        except UnknownUserError:
+            self.send_error(404, "Member does not exist!")
             return
-
-        if channel_id not in member_meta['channels'].keys():
+        except NotMemberError:
             self.send_error(404, "Member is not in the channel in the first place!")
             return
-
-        channel_dir = os.path.join(backend_dir, "channels", channel_id)
-        channel_meta_file = os.path.join(channel_dir, "meta.json")
-        try:
-            channel_meta = self.read_json_file(channel_meta_file, "Channel does not exist!", "channel meta")
-        except FileReadError:
+        except UnknownChannelError:
+            self.send_error(404, "Channel does not exist!")
             return
-
-        if username not in channel_meta['members']:
+        except PermissionDeniedError:
             self.send_error(403, "You do not have permission to remove members from this channel!")
             return
-
-        if member not in channel_meta['members']:
-            self.send_error(404, "Member is not in the channel in the first place!")
+        except (StorageError, OSError):
+            self.send_error(500, "(Server Error) Could not write to member or channel meta file.")
             return
 
-        del member_meta['channels'][channel_id]
-        channel_meta['members'].remove(member)
+        # Success! Removed member from channel
+        response = {}
+        self.send_json(response)
 
-        try:
-            self.write_json_file(member_meta_file, member_meta, "member meta")
-        except FileWriteError:
-            return
 
+    def do_POST_delete_account(self, username: str):
+        # Logs out every session right away; deleting all messages of the user in every channel, removing the user
+        # from these channels and purging the user meta is done in the background
         try:
-            self.write_json_file(channel_meta_file, channel_meta, "channel meta")
-        except FileWriteError:
+            storage.mark_account_deleted(username)
+            job = jobs.submit("delete_account", username=username)
+        except UnknownUserError:
+            self.send_error(404, "User does not exist.")
+            return
+        except (StorageError, SessionStoreError, OSError):
+            self.send_error(500, "(Server Error) Could not delete account.")
             return
 
-        # Success! Removed member from channel
-        self.send_response(200)
-        self.send_header('Content-Type', "text/json")
-        self.end_headers()
-        response = {}
-        self.wfile.write(bytes(json.dumps(response), "utf8"))
+        # Success! Account deleted.
+        response = {"jobID": job['id']}
+        self.send_json(response, 202)
 
 
-    def do_POST_delete_account(self, token: str, username: str):
-        if not self.validate_auth(token, username, True):
-            return
 
-        user_dir = os.path.join(backend_dir, "accounts", username)
-        user_meta_file = os.path.join(user_dir, "meta.json")
+    def do_POST(self):
+        self.dispatch("POST")
 
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_HEAD(self):
+        # Answered like GET, but `end_headers` swaps the body for nothing
+        wfile = self.wfile
         try:
-            user_meta = self.read_json_file(user_meta_file, "User does not exist.", "user meta")
-        except FileReadError:
+            self.dispatch("GET")
+        finally:
+            self.wfile = wfile
+
+    def dispatch(self, method: str):
+        """Calls the handler of the route matching the request (see `routes`), after doing what the route asks for:
+        parsing and checking the JSON body and checking that the user is logged in."""
+        url = urlparse(self.path)
+        route, params = routes.match(method, url.path)
+        if route is None or route.body is None:
+            self.discard_body()
+
+        if route is None:
+            if params is not None:
+                self.send_error(*params)
+            elif method == "GET":
+                self.route_label = "static"
+                self.send_static_file(unquote(url.path), parse_query(url.query).get('v'))
+            else:
+                self.send_error(404, "Invalid post URI.")
             return
 
-        # Delete all messages from every channel, then remove them from that channel as well
-        for channel in user_meta['channels']:
-            channel_dir = os.path.join(backend_dir, "channels", channel)
-            channel_meta_file = os.path.join(channel_dir, "meta.json")
-            try:
-                channel_meta = self.read_json_file(channel_meta_file, "Channel does not exist somehow", "channel meta", False)
-            except FileReadError:   # channel doesn't exist for some reason
-                print(f"Channel {channel} doesn't exist?")
-                continue
-
+        self.route_label = route.pattern
+        request_args = {}
+        if "query_components" in route.request_args:
+            request_args['query_components'] = parse_query(url.query)
 
-            for batch_number in range(channel_meta['latestMessageBatch'], 0, -1):
-                message_batch_file = os.path.join(channel_dir, "message_batches", f"{batch_number}.json")
-                try:
-                    message_batch = self.read_json_file(message_batch_file, "Message batch does not exist somehow", "message batch")
-                except FileReadError:
-                    print(f"Message batch #{batch_number} in channel {channel} doesn't exist?")
+        if route.body is not None:
+            with tracing.span("parse"):
+                post_data = self.read_json_body(route.body, route.body_error)
+            if post_data is None:
+                return
+            request_args['post_data'] = post_data
+
+        if route.auth or "token" in route.request_args or "username" in route.request_args:
+            cookies = SimpleCookie(self.headers.get('Cookie'))
+            token = cookies['token'].value if 'token' in cookies else None
+            username = cookies['username'].value if 'username' in cookies else None
+            if route.auth:
+                with tracing.span("auth"):
+                    authenticated = self.validate_auth(token, username, True)
+                if not authenticated:
                     return
+            if "token" in route.request_args:
+                request_args['token'] = token
+            if "username" in route.request_args:
+                request_args['username'] = username
+
+        route.handler(self, **params, **request_args)
+
+    def read_json_body(self, attributes: dict[str, type], error_message: str) -> dict | None:
+        """Reads the request body, which has to be a JSON object with `attributes` of the given types.
+        Otherwise responds with 400 and returns None."""
+        content_length = self.content_length()
+        if content_length is None:
+            self.close_connection = True   # where the next request starts is unknown
+            self.send_error(400, "Content Type should be JSON.")
+            return None
 
-                message_batch = [message for message in message_batch if message['author'] != username]
+        try:
+            post_data = json.loads(self.rfile.read(content_length))
+        except ValueError:
+            self.send_error(400, "Content Type should be JSON.")
+            return None
 
-                try:
-                    self.write_json_file(message_batch_file, message_batch, "message batch")
-                except FileWriteError:
-                    print(f"Could not write to message batch file #{batch_number} in channel {channel}")
-                    return
+        if not isinstance(post_data, dict) or not all(
+                isinstance(post_data.get(name), attribute_type) for name, attribute_type in attributes.items()):
+            self.send_error(400, error_message)
+            return None
+        return post_data
 
-            try:
-                channel_meta['members'].remove(username)
-            except ValueError:   # user wasn't in channel for some reason
-                print(f"User {username} wasn't in channel {channel}?")
-                continue
+    def content_length(self) -> int | None:
+        """The length of the request body (0 if there is none), or None if the header is invalid."""
+        try:
+            content_length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            return None
+        return content_length if content_length >= 0 else None
+
+    def discard_body(self):
+        """Reads the body of a request which doesn't need it, so the next request on the connection can be read.
+        Large bodies aren't worth reading; the connection is closed after the response instead."""
+        content_length = self.content_length()
+        if content_length is not None and content_length <= MAX_DISCARDED_BODY_SIZE:
+            self.rfile.read(content_length)
+        else:
+            self.close_connection = True
 
-            try:
-                self.write_json_file(channel_meta_file, channel_meta, "channel meta", False)
-            except FileWriteError:
-                print(f"Couldn't write to channel {channel} meta file")
-                continue
+    def send_static_file(self, url_path: str, version: str | None = None):
+        """Sends a file of `static_files`, compressed if the client accepts it. Requests for the current `version`
+        (`?v=<content hash>`, as linked in the HTML files) may be cached forever, all others have to be revalidated."""
+        static_file = static_files.get(url_path)
+        if static_file is None:
+            self.send_error(404, "File not found")
+            return
 
-        # Purge user meta
-        user_meta = {
-            "displayname": "Deleted User",
-            "accountCreated": 0,
-            "passwordHash": " ",
-            "validTokens": [],
-            "channels": [],
-            "publicKey": " ",
-            "deleted": True,
-        }
+        encoding = choose_encoding(self.headers.get('Accept-Encoding'), static_file.variants)
+        etag = static_file.etag if encoding == "identity" else f'{static_file.etag[:-1]}-{encoding}"'
+        if version is not None and version == static_file.version:
+            cache_control = f"public, max-age={IMMUTABLE_MAX_AGE}, immutable"
+        else:
+            cache_control = "no-cache"
 
-        try:
-            self.write_json_file(user_meta_file, user_meta, "user meta")
-        except FileWriteError:
+        if self.is_not_modified(etag, static_file.last_modified):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', cache_control)
+            self.send_header('Vary', "Accept-Encoding")
+            self.end_headers()
             return
 
-        # Success! Deleted account.
+        body = static_file.variants[encoding]
         self.send_response(200)
-        self.send_header('Content-Type', "text/json")
+        self.send_header('Content-Type', static_file.content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if encoding != "identity":
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(static_file.last_modified))
+        self.send_header('Cache-Control', cache_control)
+        self.send_header('Vary', "Accept-Encoding")
         self.end_headers()
-        response = {}
-        self.wfile.write(bytes(json.dumps(response), "utf8"))
-
+        try:
+            self.wfile.write(body)
+        except ConnectionAbortedError:
+            http_log.debug("static_file_aborted", path=url_path)
 
+    def do_GET_account_page(self, query_components: dict, token: str):
+        """The login and register pages; logged in users are sent to the index instead."""
+        if token is None:
+            self.send_static_file(urlparse(self.path).path, query_components.get('v'))
+            return
 
-    def do_POST(self):
-        print("[POST]", self.path)
+        self.send_redirect("/")  # redirect to index if already logged in TODO ??? index is nor
 
-        cookies = SimpleCookie(self.headers.get('Cookie'))
-        try:
-            token = cookies['token'].value
-            username = cookies['username'].value
-            assert validate_username(username)
-        except (AssertionError, KeyError):
-            token = None
-            username = None
-
-        if self.path == "/register":
-            self.do_POST_register()
-        elif self.path == "/login":
-            self.do_POST_login()
-        elif self.path == "/send_message":
-            self.do_POST_send_message(token, username)
-        elif self.path == "/logout_all_other_sessions":
-            self.do_POST_delete_all_other_sessions(token, username)
-        elif self.path == "/create_channel":
-            self.do_POST_create_channel(token, username)
-        elif self.path == "/delete_channel":
-            self.do_POST_delete_channel(token, username)
-        elif self.path == "/add_member_to_channel":
-            self.do_POST_add_member_to_channel(token, username)
-        elif self.path == "/remove_member_from_channel":
-            self.do_POST_remove_member_from_channel(token, username)
-        elif self.path == "/delete_account":
-            self.do_POST_delete_account(token, username)
-        else:
-            self.send_error(404, "Invalid post URI.")
+    def do_GET_channel_page(self, channel_id: str, token: str, username: str):
+        if not self.validate_auth(token, username):
+            self.send_redirect("/login.html")
             return
 
-    def do_GET_channels(self, path: str, query_components: dict, token: str, username: str):
-        regex_match = re.match(r"/channels/(\d+)(/?|/messages/?|/about/?)$", path)
-        if regex_match is None:
-            self.send_error(400, "Invalid channel ID or URI.")
-            return
+        self.send_static_file("/index.html")
 
-        channel_id, sub = regex_match.groups()
-        if not all(ch in "0123456789" for ch in channel_id):
-            self.send_error(400, "Invalid channel ID.")
+    def read_member_channel(self, channel_id: str, username: str) -> dict:
+        """Like `read_channel`, but also responds with 403 (and raises a `ReadError`) if the user isn't a member."""
+        channel_meta = self.read_channel(channel_id)
+        if username not in channel_meta['members']:
+            self.send_error(403, "You don't have permission to view this channel.")
+            raise ReadError
+        return channel_meta
 
-        sub = "" if sub is None else sub.strip("/")
-        channel_dir = os.path.join(backend_dir, "channels", channel_id)
+    def do_GET_channels_about(self, channel_id: str, username: str):
+        try:
+            channel_meta = self.read_member_channel(channel_id, username)
+        except ReadError:
+            return
 
-        if not sub:
-            if not self.validate_auth(token, username):
-                self.send_response(303)
-                self.send_header('Location', "/login.html")
-                # self.send_header('Content-Type', "text/json")
-                self.end_headers()
+        # Success, send channel about
+        response = channel_meta
+        self.send_json(response)
 
-                response = {}
-                self.wfile.write(bytes(json.dumps(response), "utf8"))
-                return
+    def do_GET_channel_messages(self, channel_id: str, query_components: dict, username: str):
+        try:
+            self.read_member_channel(channel_id, username)
+        except ReadError:
+            return
 
-            self.path = "/index.html"
-            try:
-                super().do_GET()
-            except ConnectionAbortedError:
-                print("Connection was aborted while trying to super().do_GET()")
+        if 'batches' in query_components:
+            self.do_GET_channel_message_batches(query_components, channel_id)
             return
 
-        if not self.validate_auth(token, username, True):
-            # self.send_error(401, "Not authorized.")
+        if {'before', 'limit', 'since'} & query_components.keys():
+            self.do_GET_channel_message_range(query_components, channel_id)
             return
 
-        channel_meta_file = os.path.join(channel_dir, "meta.json")
         try:
-            channel_meta = self.read_json_file(channel_meta_file, "Channel not found.", "channel meta")
-        except FileReadError:
+            batch_id = int(query_components['batch'])
+        except (ValueError, KeyError):
+            self.send_error(400, "Invalid or unspecified messages batch ID.")
             return
 
-        if username not in channel_meta['members']:
-            self.send_error(403, "You don't have permission to view this channel.")
+        # The stored batch is sent as is, without parsing it. The version is taken before reading,
+        # so a batch changing in between can only make the ETag outdated (and the next request a miss).
+        try:
+            etag, last_modified = storage.messages.batch_version(channel_id, batch_id)
+            historical = batch_id < storage.messages.latest_batch(channel_id)
+        except BatchNotFoundError:
+            self.send_error(404, "Message batch not found.")
             return
-
-        if sub == "about":
-            self.do_GET_channels_about(query_components, channel_dir)
-        elif sub == "messages":
-            self.do_GET_channel_messages(query_components, channel_dir)
-        else:
-            self.send_error(404, "This error can only happen if the regex is messed up.")
+        except (MessageStoreError, OSError):
+            self.send_error(500, "(Server Error) Could not read messages batch file.")
             return
 
-    def do_GET_channels_about(self, query_components: dict, channel_dir):
-        channel_meta_file = os.path.join(channel_dir, "meta.json")
+        if self.is_not_modified(etag, last_modified):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
 
         try:
-            channel_meta = self.read_json_file(channel_meta_file, "Channel not found.", "channel meta")
-        except FileReadError:
+            batch_file = storage.messages.open_batch_file(channel_id, batch_id)
+            batch_bytes = storage.messages.read_batch_raw(channel_id, batch_id) if batch_file is None else None
+        except BatchNotFoundError:
+            self.send_error(404, "Message batch not found.")
+            return
+        except (MessageStoreError, OSError):
+            self.send_error(500, "(Server Error) Could not read messages batch file.")
             return
 
-        # Success, send channel about
+        # Success! Send channel messages
         self.send_response(200)
         self.send_header('Content-Type', "text/json")
-        self.end_headers()
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(last_modified))
+        # Batches before the latest one only change when messages are deleted
+        if historical:
+            self.send_header('Cache-Control', f"private, max-age={HISTORICAL_BATCH_MAX_AGE}")
+        else:
+            self.send_header('Cache-Control', "private, no-cache")
 
-        response = channel_meta
-        self.wfile.write(bytes(json.dumps(response), "utf8"))
+        if batch_file is None:
+            self.send_header('Content-Length', str(len(batch_bytes)))
+            self.end_headers()
+            self.wfile.write(batch_bytes)
+            return
 
-    def do_GET_channel_messages(self, query_components: dict, channel_dir: str):
+        with batch_file:
+            self.send_header('Content-Length', str(os.fstat(batch_file.fileno()).st_size))
+            self.end_headers()
+            if self.command != "HEAD":   # sent on the socket directly, past `wfile`
+                self.connection.sendfile(batch_file)
+
+    def is_not_modified(self, etag: str, last_modified: float) -> bool:
+        """Checks the conditional request headers. `If-None-Match` takes precedence over `If-Modified-Since`."""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            client_etags = {client_etag.strip().removeprefix("W/") for client_etag in if_none_match.split(",")}
+            return etag in client_etags or "*" in client_etags
+
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is None:
+            return False
         try:
-            batch_id = int(query_components['batch'])
-        except (ValueError, KeyError):
-            self.send_error(400, "Invalid or unspecified messages batch ID.")
-            return
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
 
-        channel_messages_file = os.path.join(channel_dir, "message_batches", str(batch_id) + ".json")
+    def do_GET_channel_message_batches(self, query_components: dict, channel_id: str):
+        """`?batches=a-b` sends the batches a to b (inclusive) in one response: `{"<batchID>": [messages], ...}`.
+        Batches after the latest batch are left out. The stored messages are sent without parsing them."""
+        try:
+            first_batch_id, last_batch_id = (int(batch_id) for batch_id in query_components['batches'].split("-"))
+            assert 1 <= first_batch_id <= last_batch_id
+            assert last_batch_id - first_batch_id < MAX_BATCHES_PER_REQUEST
+        except (ValueError, AssertionError):
+            self.send_error(400, f"Batch range should be \"a-b\" and contain at most {MAX_BATCHES_PER_REQUEST} batches.")
+            return
 
         try:
-            channel_messages = self.read_json_file(channel_messages_file, "Message batch not found.", "messages batch")
-        except FileReadError:
+            last_batch_id = min(last_batch_id, storage.messages.latest_batch(channel_id))
+        except (MessageStoreError, OSError):
+            self.send_error(500, "(Server Error) Could not read messages.")
             return
 
-        # Success! Send channel messages
+        # Success! Stream batches. The length isn't known in advance, so the response is chunked
+        # (HTTP/1.0 clients don't know chunks; for them the end of the response is the end of the connection)
+        chunked = self.request_version != "HTTP/1.0"
         self.send_response(200)
         self.send_header('Content-Type', "text/json")
+        if chunked:
+            self.send_header('Transfer-Encoding', "chunked")
+        else:
+            self.close_connection = True
         self.end_headers()
 
-        response = channel_messages
-        self.wfile.write(bytes(json.dumps(response), "utf8"))
+        def write(data: bytes):
+            self.wfile.write(b"%x\r\n%b\r\n" % (len(data), data) if chunked else data)
+
+        separator = b"{"
+        for batch_id in range(first_batch_id, last_batch_id + 1):
+            try:
+                batch_raw = storage.messages.read_batch_raw(channel_id, batch_id)
+            except BatchNotFoundError:
+                continue
+            except (MessageStoreError, OSError):
+                http_log.error("batch_read_failed", exc_info=True, channel=channel_id, batch=batch_id)
+                self.close_connection = True
+                return
+
+            write(separator + bytes(f'"{batch_id}":', 'utf-8') + batch_raw)
+            separator = b","
 
-    def do_GET_users(self, path: str, query_components: dict, token: str, username: str):
-        regex_match = re.match(r"/users/([A-Za-z0-9\-_]{3,28})(/|/about/?)?$", path)
-        if regex_match is None:
-            self.send_error(400, "Invalid URI.")
+        write(b"{}" if separator == b"{" else b"}")
+        if chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
+    def do_GET_channel_message_range(self, query_components: dict, channel_id: str):
+        """`?before=<cursor>&limit=<n>&since=<timestamp>` sends up to `limit` messages (oldest first) from before
+        the cursor that are not older than `since`. All parameters are optional; without `before`
+        the newest messages are sent. Response: `{"messages": [...], "nextCursor": "<cursor>" or null}`.\n
+        `since` can be used to catch up on messages missed while the websocket was disconnected."""
+        try:
+            limit = int(query_components.get('limit', MESSAGE_BATCH_SIZE))
+            before = parse_cursor(query_components['before']) if 'before' in query_components else None
+            since = int(query_components['since']) if 'since' in query_components else None
+            assert 1 <= limit <= MAX_MESSAGES_PER_REQUEST
+        except (ValueError, AssertionError):
+            self.send_error(400, f"Invalid cursor, timestamp or limit (should be between 1 and {MAX_MESSAGES_PER_REQUEST}).")
             return
 
-        target_username, sub = regex_match.groups()
-        sub = "" if sub is None else sub.strip("/")
+        try:
+            lines, next_cursor = storage.messages.read_before(channel_id, before, limit, since)
+        except (MessageStoreError, OSError):
+            self.send_error(500, "(Server Error) Could not read messages.")
+            return
 
-        if not sub:
-            self.send_response(200)
-            self.send_header("Content-Type", "text/html")
-            self.end_headers()
-            message = "<h1>This is not yet implemented!</h1>"
-            self.wfile.write(bytes(message, 'utf-8'))
+        # Success! Send messages
+        next_cursor = json.dumps(None if next_cursor is None else format_cursor(next_cursor))
+        response = b'{"messages":[' + b",".join(lines) + b'],"nextCursor":' + bytes(next_cursor, 'utf-8') + b"}"
 
-        elif sub == "about":
-            self.do_GET_users_about(token, username, target_username)
+        self.send_response(200)
+        self.send_header('Content-Type', "text/json")
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
 
-    def do_GET_users_about(self, token: str, username: str, target_username: str):
-        account_dir = os.path.join(backend_dir, "accounts", target_username)
-        user_meta_file = os.path.join(account_dir, "meta.json")
+    def do_GET_user_page(self, target_username: str):
+        message = bytes("<h1>This is not yet implemented!</h1>", 'utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header('Content-Length', str(len(message)))
+        self.end_headers()
+        self.wfile.write(message)
 
+    def do_GET_users_about(self, target_username: str, username: str):
         if not validate_username(target_username):
             self.send_error(400, "Invalid username.")
             return
 
-        if not self.validate_auth(token, username):
-            return
-
         try:
-            user_meta_private = self.read_json_file(user_meta_file, "User not found.", "user meta")
-        except FileReadError:
+            user_meta_private = self.read_account(target_username)
+        except ReadError:
             return
 
         # Success! Send (filtered) account meta
@@ -981,86 +1105,156 @@ class HTTPHandler(SimpleHTTPRequestHandler):
             keys_filter = ['displayname', 'accountCreated', 'deleted', 'publicKey']
             user_meta_public = {key: value for key, value in user_meta_private.items() if key in keys_filter}
 
-        self.send_response(200)
-        self.send_header("Content-Type", "text/json")
-        self.end_headers()
-        self.wfile.write(bytes(json.dumps(user_meta_public), 'utf-8'))
-
-    def do_GET_self_channels(self, token: str, username: str):
-        if not self.validate_auth(token, username, True):
-            return
+        self.send_json(user_meta_public)
 
-        user_meta_file = os.path.join(backend_dir, "accounts", username, "meta.json")
+    def do_GET_self_channels(self, query_components: dict, username: str):
+        """Names of the user's channels by channel ID. With `?details=1`, also the time of the last message
+        of each channel: `{"<channel ID>": {"name": ..., "lastMessage": timestamp or null}}`."""
         try:
-            user_meta = self.read_json_file(user_meta_file, "There is no user associated with this username.", "user meta")
-        except FileReadError:
+            summaries = storage.channel_summaries(username)
+        except UnknownUserError:
+            self.send_error(404, "There is no user associated with this username.")
+            return
+        except (StorageError, MessageStoreError, OSError):
+            self.send_error(500, "(Server Error) Could not read user meta.")
             return
 
-        channel_names: dict[str, str] = {}
+        if query_components.get('details') == "1":
+            response = summaries
+        else:
+            response = {channel_id: summary['name'] for channel_id, summary in summaries.items()}
 
-        # Get names of all channels
-        for channel_id in user_meta['channels']:
-            channel_meta_file = os.path.join(backend_dir, "channels", channel_id, "meta.json")
-            try:
-                with open(channel_meta_file, 'r') as file:
-                    channel_meta = json.load(file)
+        self.send_json(response)
 
-            except (FileNotFoundError, OSError):
-                channel_name = "Unknown Channel"
-            else:
-                channel_name = channel_meta["name"]
+    def do_GET_export(self, username: str):
+        """Everything stored about the user: the account (without the password hash) and every message they wrote,
+        also in channels they left."""
+        try:
+            user_meta = self.read_account(username, "There is no user associated with this username.")
+        except ReadError:
+            return
+
+        try:
+            messages = storage.export_messages(username)
+        except (StorageError, MessageStoreError, OSError):
+            self.send_error(500, "(Server Error) Could not read messages.")
+            return
 
-            channel_names[channel_id] = channel_name
+        account = {key: user_meta[key] for key in ("displayname", "accountCreated", "publicKey", "channels")}
+        # The messages are stored encoded already; they are put into the response as they are
+        response = (
+            bytes(json.dumps({"username": username, "account": account})[:-1], "utf8") + b',"messages":{'
+            + b",".join(bytes(json.dumps(channel_id), "utf8") + b":[" + b",".join(lines) + b"]"
+                        for channel_id, lines in messages.items())
+            + b"}}"
+        )
 
         self.send_response(200)
-        self.send_header("Content-Type", "text/json")
+        self.send_header('Content-Type', "text/json")
+        self.send_header('Content-Disposition', f'attachment; filename="pigon-export-{username}.json"')
+        self.send_header('Content-Length', str(len(response)))
         self.end_headers()
-        self.wfile.write(bytes(json.dumps(channel_names), 'utf-8'))
+        self.wfile.write(response)
 
-    def do_GET(self):
-        cookies = SimpleCookie(self.headers.get('Cookie'))
-        try:
-            token = cookies['token'].value
-            username = cookies['username'].value
-        except KeyError:
-            token = None
-            username = None
-
-        query = urlparse(self.path).query
-        path = urlparse(self.path).path
-        if query:
-            query_components = dict(qc.split("=") for qc in query.split("&"))
-        else:
-            query_components = {}
+    def do_GET_job(self, job_id: str):
+        """Status of a background job, e.g. the deletion of an account. Knowing the (random) job ID is enough,
+        since the account which started it may be logged out already."""
+        job = jobs.get(job_id)
+        if job is None:
+            self.send_error(404, "Job not found (finished jobs are forgotten after a day).")
+            return
 
-        print("GET", self.path, query_components)
+        response = {key: job[key] for key in ("id", "kind", "status", "attempts", "created", "finished")}
+        self.send_json(response)
 
-        if path in {"/login.html", "/register.html"} and token is not None:
-            self.send_response(303)
-            self.send_header('Location', "/")  # redirect to index if already logged in TODO ??? index is nor
-            self.send_header('Content-Type', "text/json")
-            self.end_headers()
+    def do_GET_server_stats(self):
+        """Counters for tuning the server. Only available from the machine the server runs on."""
+        if not self.is_local_request():
+            self.send_error(403, "Server stats are only available locally.")
+            return
 
-            response = {}
-            self.wfile.write(bytes(json.dumps(response), "utf8"))
+        response = {
+            "messageWrites": message_writes.stats(),
+            "storage": storage.stats(),
+            "jobs": jobs.stats(),
+            "staticFiles": static_files.stats(),
+            "websocketAuth": dict(ws_auth_stats),
+            "passwords": dict(
+                password_hasher.stats(),
+                rateLimitedByUser=user_login_limiter.limited,
+                rateLimitedByIP=ip_login_limiter.limited,
+            ),
+        }
+        self.send_json(response)
+
+    def do_GET_metrics(self):
+        """The metrics in the Prometheus text format (see metrics.py). Only available from the machine the server
+        runs on, like the server stats; scrape it through a local agent or reverse proxy."""
+        if not self.is_local_request():
+            self.send_error(403, "Metrics are only available locally.")
             return
 
-        if path.startswith("/channels/"):
-            self.do_GET_channels(path, query_components, token, username)
+        body = metrics.REGISTRY.render()
+        self.send_response(200)
+        self.send_header('Content-Type', "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET_profiler(self):
+        """Whether a profile is running (see profiling.py). Like the other profiler endpoints, only available locally."""
+        if not self.is_local_request():
+            self.send_error(403, "The profiler is only available locally.")
             return
+        self.send_json(profiler.status())
 
-        if path.startswith("/users/"):
-            self.do_GET_users(path, query_components, token, username)
+    def do_POST_profiler_start(self, post_data: dict):
+        """Starts a profile of the live server: `{"mode": "cprofile"}` or `{"mode": "sampling", "interval": <seconds>}`."""
+        if not self.is_local_request():
+            self.send_error(403, "The profiler is only available locally.")
             return
 
-        if path == "/get_self_channels":
-            self.do_GET_self_channels(token, username)
+        interval = post_data.get("interval", profiling.DEFAULT_SAMPLING_INTERVAL)
+        if not isinstance(interval, (int, float)):
+            self.send_error(400, "The interval has to be a number of seconds.")
             return
 
         try:
-            super().do_GET()
-        except ConnectionAbortedError:
-            print("Connection was aborted while trying to super().do_GET()")
+            profiler.start(post_data["mode"], interval)
+        except profiling.ProfilerBusyError:
+            self.send_error(409, "A profile is running already.")
+            return
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+
+        self.send_json(profiler.status())
+
+    def do_POST_profiler_stop(self):
+        """Stops the profile and sends its result as a download: a pstats dump for "cprofile",
+        collapsed stacks (for flame graphs) for "sampling"."""
+        if not self.is_local_request():
+            self.send_error(403, "The profiler is only available locally.")
+            return
+
+        try:
+            mode, body = profiler.stop()
+        except profiling.ProfilerNotRunningError:
+            self.send_error(409, "No profile is running.")
+            return
+
+        file_name = f"pigon-{time.strftime('%Y%m%d-%H%M%S')}" + (".pstats" if mode == "cprofile" else ".collapsed.txt")
+        self.send_response(200)
+        self.send_header('Content-Type', "application/octet-stream" if mode == "cprofile" else "text/plain; charset=utf-8")
+        self.send_header('Content-Disposition', f'attachment; filename="{file_name}"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def is_local_request(self) -> bool:
+        """For the endpoints meant for the operator of the server. Behind a reverse proxy every request is local,
+        so the proxy has to block these paths."""
+        return self.client_address[0] in {"127.0.0.1", "::1", "::ffff:127.0.0.1"}
 
     def validate_auth(self, token: str, username: str, send_errors: bool=False) -> bool:
         send_error = self.send_error if send_errors else lambda *_: None
@@ -1069,45 +1263,341 @@ class HTTPHandler(SimpleHTTPRequestHandler):
             send_error(401, "Not authorized. Please provide token and username.")
             return False
 
-        user_meta_file = os.path.join(backend_dir, "accounts", username, "meta.json")
+        if not validate_username(username):
+            send_error(401, "There is no user associated with this username.")
+            return False
 
         try:
-            with open(user_meta_file, 'r') as file:
-                user_meta = json.load(file)
+            token_valid = storage.sessions.validate(username, hash_token(token))
 
-        except FileNotFoundError:
+        except UnknownUserError:
             send_error(401, "There is no user associated with this username.")
             return False
 
-        except OSError:
-            send_error(500, "(Server Error) Could not read user meta file.")
+        except (SessionStoreError, OSError):
+            send_error(500, "(Server Error) Could not read user sessions file.")
             return False
 
-        token_hashed = hash_token(token)
-        for valid_token_hash in user_meta['validTokens']:
-            if token_hashed == valid_token_hash:
-                break
-        else:
+        if not token_valid:
             send_error(401, "Invalid token.")
             return False
 
         return True
 
 
+# -------- Routes --------
+routes = Router()
+routes.add("POST", "/register", HTTPHandler.do_POST_register,
+           body={"username": str, "displayname": str, "password": str, "publicKey": str},
+           body_error="JSON object needs to have attributes: 'username', 'displayname', 'password', 'publicKey'.")
+routes.add("POST", "/login", HTTPHandler.do_POST_login,
+           body={"username": str, "password": str},
+           body_error="JSON object needs to have attributes: 'username', 'password'.")
+routes.add("POST", "/send_message", HTTPHandler.do_POST_send_message, auth=True,
+           body={"text": str, "channel": str, "tempID": str},
+           body_error="JSON object needs to have attributes: 'text', 'channel', 'tempID'.")
+routes.add("POST", "/logout_all_other_sessions", HTTPHandler.do_POST_delete_all_other_sessions, auth=True)
+routes.add("POST", "/create_channel", HTTPHandler.do_POST_create_channel, auth=True,
+           body={"channelName": str, "encryptedChannelKey": str, "iv": str},
+           body_error="Channel Name/Encrypted Channel Key is missing or invalid; should be string")
+routes.add("POST", "/delete_channel", HTTPHandler.do_POST_delete_channel, auth=True,
+           body={"channelID": str},
+           body_error="Channel Name is missing or invalid; should be string")
+routes.add("POST", "/add_member_to_channel", HTTPHandler.do_POST_add_member_to_channel, auth=True,
+           body={"channelID": str, "newMember": str, "encryptedChannelKey": str, "iv": str},
+           body_error="Channel Name/New Member is missing or invalid; should be string")
+routes.add("POST", "/remove_member_from_channel", HTTPHandler.do_POST_remove_member_from_channel, auth=True,
+           body={"channelID": str, "newMember": str},
+           body_error="Channel Name/New Member is missing or invalid; should be string")
+routes.add("POST", "/delete_account", HTTPHandler.do_POST_delete_account, auth=True)
+
+routes.add("GET", "/login.html", HTTPHandler.do_GET_account_page)
+routes.add("GET", "/register.html", HTTPHandler.do_GET_account_page)
+routes.add("GET", "/channels/<digits:channel_id>", HTTPHandler.do_GET_channel_page)
+routes.add("GET", "/channels/<digits:channel_id>/about", HTTPHandler.do_GET_channels_about, auth=True)
+routes.add("GET", "/channels/<digits:channel_id>/messages", HTTPHandler.do_GET_channel_messages, auth=True)
+routes.add_prefix_error("GET", "/channels", 400, "Invalid channel ID or URI.")
+routes.add("GET", "/users/<username:target_username>", HTTPHandler.do_GET_user_page)
+routes.add("GET", "/users/<username:target_username>/about", HTTPHandler.do_GET_users_about, auth=True)
+routes.add_prefix_error("GET", "/users", 400, "Invalid URI.")
+routes.add("GET", "/get_self_channels", HTTPHandler.do_GET_self_channels, auth=True)
+routes.add("GET", "/export", HTTPHandler.do_GET_export, auth=True)
+routes.add("GET", "/server_stats", HTTPHandler.do_GET_server_stats)
+routes.add("GET", "/metrics", HTTPHandler.do_GET_metrics)
+routes.add("GET", "/profiler", HTTPHandler.do_GET_profiler)
+routes.add("POST", "/profiler/start", HTTPHandler.do_POST_profiler_start,
+           body={"mode": str}, body_error="JSON object needs to have attributes: 'mode'.")
+routes.add("POST", "/profiler/stop", HTTPHandler.do_POST_profiler_stop)
+routes.add("GET", "/jobs/<job_id>", HTTPHandler.do_GET_job)
+
+
 class HTTPServer(BaseHTTPServer):
-    """The main server, you pass in base_path which is the path you want to serve requests from"""
+    """The main server, handling one request at a time."""
 
-    def __init__(self, base_path, server_address, RequestHandlerClass=HTTPHandler):
-        self.base_path = base_path
+    def __init__(self, server_address, RequestHandlerClass=HTTPHandler):
         BaseHTTPServer.__init__(self, server_address, RequestHandlerClass)
 
+    def is_busy(self) -> bool:
+        """Whether connections are waiting to be handled. Requests are handled one at a time here,
+        so connections are never kept open."""
+        return True
+
+    def handle_error(self, request, client_address):
+        http_log.error("unhandled_exception", exc_info=True, client=client_address[0])
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """Handles requests on `max_workers` worker threads, so one slow request doesn't stall every other user.\n
+    Unlike `socketserver.ThreadingMixIn` the number of threads is bounded: when all workers are busy,
+    new connections wait in the listen backlog until a worker is free again."""
+    request_queue_size = 128    # the listen backlog; socketserver's default of 5 resets connections in bursts
+
+    def __init__(self, server_address, max_workers: int, RequestHandlerClass=HTTPHandler):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="http-worker")
+        self.worker_slots = threading.BoundedSemaphore(max_workers)
+        self.waiting_connections = 0   # accepted, but every worker is busy
+        HTTPServer.__init__(self, server_address, RequestHandlerClass)
+
+    def is_busy(self) -> bool:
+        """Whether a connection waits for a worker; connections waiting for their next request then give up theirs."""
+        return self.waiting_connections > 0
+
+    def process_request(self, request, client_address):
+        self.waiting_connections += 1
+        self.worker_slots.acquire()
+        self.waiting_connections -= 1
+        future = self.executor.submit(self.process_request_worker, request, client_address)
+        future.add_done_callback(lambda _: self.worker_slots.release())
+
+    def process_request_worker(self, request, client_address):
+        """Same as `socketserver.ThreadingMixIn.process_request_thread`."""
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.executor.shutdown()
+
+    async def serve_on_loop(self):
+        """Accepts connections on the running event loop (shared with the websocket server) instead of
+        in `serve_forever`. The requests themselves are still handled by the worker threads."""
+        loop = asyncio.get_running_loop()
+        worker_slots = asyncio.Semaphore(self.max_workers)
+        self.socket.setblocking(False)
+
+        while True:
+            request, client_address = await loop.sock_accept(self.socket)
+            self.waiting_connections += 1
+            await worker_slots.acquire()
+            self.waiting_connections -= 1
+            request.setblocking(True)
+            future = loop.run_in_executor(self.executor, self.process_request_worker, request, client_address)
+            future.add_done_callback(lambda _: worker_slots.release())
+
+
+async def asyncio_main(httpd: ThreadPoolHTTPServer, ws_port: int):
+    await asyncio.gather(ws_main(ws_port), httpd.serve_on_loop())
+
 
 web_dir = os.path.join(os.path.dirname(__file__), "../frontend_files")
 backend_dir = os.path.join(os.path.dirname(__file__), "../backend_files")
-httpd = HTTPServer(web_dir, ("", 8000))
+
+
+def collect_metrics():
+    """The metrics which are read off the state of the server when /metrics is requested (see metrics.py)."""
+    connections, channel_clients = ws_broadcaster.client_counts()
+    yield "pigon_websocket_connections", "gauge", "Connected websocket clients.", [("", {}, connections)]
+    yield "pigon_websocket_channel_clients", "gauge", "Websocket clients subscribed to a channel.", [
+        ("", {"channel": channel_id}, count) for channel_id, count in sorted(channel_clients.items())
+    ]
+
+    yield "pigon_jobs", "gauge", "Background jobs by status.", [
+        ("", {"status": status}, count) for status, count in jobs.stats().items()
+    ]
+
+    password_stats = password_hasher.stats()
+    yield "pigon_password_hashes_total", "counter", "Passwords hashed or verified with scrypt.", [
+        ("", {}, password_stats['hashed'])
+    ]
+    yield "pigon_password_hashes_rejected_total", "counter", "Logins rejected because the hashing threads were busy.", [
+        ("", {}, password_stats['rejected'])
+    ]
+    yield "pigon_login_rate_limited_total", "counter", "Login and register attempts over the rate limit.", [
+        ("", {"by": "user"}, user_login_limiter.limited), ("", {"by": "ip"}, ip_login_limiter.limited)
+    ]
+
+    write_stats = message_writes.stats()
+    for key, name, help_text in (
+            ("batchSize", "pigon_message_write_batch_size", "Messages stored with one write."),
+            ("flushSeconds", "pigon_message_write_seconds", "Time to store a group of messages."),
+    ):
+        histogram = write_stats[key]
+        yield name, "histogram", help_text, metrics.histogram_samples(
+            histogram['buckets'].keys(), histogram['buckets'].values(), histogram['sum']
+        )
+
+    yield "pigon_log_records_dropped_total", "counter", "Log records dropped because the log queue was full.", [
+        ("", {}, logs.dropped())
+    ]
+
+    meta_cache_stats = storage.stats().get('metaCache')
+    if meta_cache_stats is not None:
+        yield "pigon_meta_cache_lookups_total", "counter", "Lookups in the cache of parsed meta files.", [
+            ("", {"result": "hit"}, meta_cache_stats['hits']), ("", {"result": "miss"}, meta_cache_stats['misses'])
+        ]
+
+
+def queue_pending_deletions() -> None:
+    """Queues the purge jobs of accounts and channels which were flagged as deleted without their job being queued
+    (jobs which are still queued from the last run aren't queued twice)."""
+    try:
+        usernames, channel_ids = storage.pending_deletions()
+        for username in usernames:
+            jobs.submit("delete_account", username=username)
+        for channel_id in channel_ids:
+            jobs.submit("delete_channel", channel_id=channel_id)
+    except (StorageError, OSError):
+        http_log.error("pending_deletions_failed", exc_info=True)
+        return
+    if usernames or channel_ids:
+        http_log.info("pending_deletions", accounts=len(usernames), channels=len(channel_ids))
+
+
+def purge_account(username: str) -> None:
+    try:
+        storage.delete_account(username)
+    except UnknownUserError:   # purged already
+        pass
+    ws_broadcaster.forget_author(username)
+
+
+def purge_channel(channel_id: str) -> None:
+    storage.delete_channel(channel_id)
+    ws_broadcaster.forget(channel_id)
+
+
+def open_storage(backend: str) -> Storage:
+    if backend == "sqlite":
+        return SQLiteStorage(
+            os.path.join(backend_dir, "pigon.sqlite3"), MESSAGE_BATCH_SIZE, durable_writer.mode,
+            SESSION_TTL, MAX_SESSIONS_PER_USER
+        )
+
+    file_locks = PathLocks()
+    meta_cache = JSONFileCache(META_CACHE_SIZE, file_locks, durable_writer)
+    message_store = MESSAGE_STORES[MESSAGE_STORAGE](os.path.join(backend_dir, "channels"), MESSAGE_BATCH_SIZE, durable_writer)
+    session_store = SessionStore(
+        os.path.join(backend_dir, "accounts"), meta_cache, durable_writer, SESSION_TTL, MAX_SESSIONS_PER_USER
+    )
+    author_index = AuthorIndex(os.path.join(backend_dir, "accounts"), file_locks, durable_writer)
+    return JSONStorage(backend_dir, meta_cache, message_store, session_store, author_index)
+
+
+def main():
+    global LOG_SAMPLE_RATE, SLOW_REQUEST_THRESHOLD, backend_dir
+    parser = argparse.ArgumentParser(description="Pigon Messenger server")
+    parser.add_argument(
+        "--concurrency", choices=["single", "threadpool", "asyncio"], default=HTTP_CONCURRENCY,
+        help="single: handle one HTTP request at a time; "
+             "threadpool: handle HTTP requests on a pool of worker threads; "
+             "asyncio: like threadpool, but HTTP connections are accepted on the websocket server's event loop"
+    )
+    parser.add_argument("--workers", type=int, default=HTTP_WORKERS, help="number of HTTP worker threads")
+    parser.add_argument("--port", type=int, default=HTTP_PORT, help="port of the HTTP server")
+    parser.add_argument("--ws-port", type=int, default=WS_PORT, help="port of the websocket server")
+    parser.add_argument(
+        "--backend-dir", default=backend_dir,
+        help="where the accounts, channels and jobs are stored (default: backend_files/ next to src/)"
+    )
+    parser.add_argument(
+        "--durability", choices=DURABILITY_MODES, default=WRITE_DURABILITY,
+        help="how much is flushed to the disk before a write counts as done; see durable_writes.py"
+    )
+    parser.add_argument(
+        "--write-delay", type=float, default=MESSAGE_WRITE_DELAY,
+        help="seconds new messages of a channel are collected to store them with one write (0: only while writing)"
+    )
+    parser.add_argument(
+        "--storage", choices=["json", "sqlite"], default=STORAGE,
+        help="json: the original JSON files in backend_files/; sqlite: one SQLite database (see storage.py)"
+    )
+    parser.add_argument(
+        "--login-attempts-per-user", type=int, default=LOGIN_ATTEMPTS_PER_USER,
+        help="login attempts allowed per username and minute (0: unlimited)"
+    )
+    parser.add_argument(
+        "--login-attempts-per-ip", type=int, default=LOGIN_ATTEMPTS_PER_IP,
+        help="login and register attempts allowed per IP address and minute (0: unlimited; "
+             "behind a reverse proxy all requests come from the proxy's address)"
+    )
+    parser.add_argument(
+        "--log-level", choices=["debug", "info", "warning", "error"], default=LOG_LEVEL,
+        help="the least severe log events which are written to stdout"
+    )
+    parser.add_argument("--log-format", choices=logs.LOG_FORMATS, default=LOG_FORMAT, help="json lines or plain text")
+    parser.add_argument(
+        "--log-sample-rate", type=float, default=LOG_SAMPLE_RATE,
+        help="fraction (0 to 1) of the HTTP requests and websocket messages which are logged; errors always are"
+    )
+    parser.add_argument(
+        "--slow-request-threshold", type=float, default=SLOW_REQUEST_THRESHOLD,
+        help="log requests slower than this many seconds with the time spent per span (parsing, auth, "
+             "password hashing, file reads, file writes, broadcast); 0: don't time the spans"
+    )
+    parser.add_argument(
+        "--dev", action="store_true",
+        help="development mode: reload the frontend files when they change (otherwise they are loaded once)"
+    )
+    args = parser.parse_args()
+    log_listener = logs.setup(args.log_level, args.log_format, LOG_QUEUE_SIZE)
+    LOG_SAMPLE_RATE = args.log_sample_rate
+    SLOW_REQUEST_THRESHOLD = args.slow_request_threshold
+    durable_writer.set_mode(args.durability)
+
+    global user_login_limiter, ip_login_limiter
+    user_login_limiter = RateLimiter(args.login_attempts_per_user, args.login_attempts_per_user)
+    ip_login_limiter = RateLimiter(args.login_attempts_per_ip, args.login_attempts_per_ip)
+
+    global storage, message_writes, jobs, static_files
+    backend_dir = args.backend_dir
+    metrics.REGISTRY.add_collector(collect_metrics)
+    static_files = StaticFiles(web_dir, args.dev)
+    storage = open_storage(args.storage)
+    message_writes = WriteCoalescer(storage.messages, args.write_delay, storage.messages_storing)
+    jobs = JobQueue(
+        os.path.join(backend_dir, "jobs"), durable_writer,
+        {"delete_account": purge_account, "delete_channel": purge_channel}, JOB_WORKERS, JOB_MAX_ATTEMPTS
+    )
+    jobs.start()
+    queue_pending_deletions()
+
+    if args.concurrency == "single":
+        httpd = HTTPServer(("", args.port))
+    else:
+        httpd = ThreadPoolHTTPServer(("", args.port), args.workers)
+
+    http_log.info("started", port=args.port, concurrency=args.concurrency, storage=args.storage)
+    try:
+        if args.concurrency == "asyncio":
+            asyncio.run(asyncio_main(httpd, args.ws_port))
+            return
+
+        # v TODO less disgusting?????
+        threading.Thread(target=asyncio.run, args=(ws_main(args.ws_port),), daemon=True).start()
+        httpd.serve_forever()
+    finally:
+        ws_auth_executor.shutdown(wait=False)
+        jobs.close()
+        password_hasher.close()
+        storage.close()
+        durable_writer.close()
+        log_listener.stop()
+
 
 if __name__ == "__main__":
-    print("Started.")
-    # v TODO less disgusting?????
-    threading.Thread(target=asyncio.run, args=(ws_main(),), daemon=True).start()
-    httpd.serve_forever()
+    main()
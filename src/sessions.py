@@ -0,0 +1,178 @@
+"""Login sessions, indexed by token hash.
+
+Sessions are persisted per user in `accounts/<user>/sessions.json` (`{tokenHash: timestampCreated}`),
+separately from the account meta, so logging in doesn't rewrite the whole account meta file.
+They are loaded into memory the first time a user is seen and expire `ttl` seconds after creation.
+
+Accounts created before this file existed have their token hashes in the `validTokens` list of the account meta;
+those are moved to the session file the first time the user is loaded.
+"""
+import json
+import os
+import threading
+import time
+
+import metrics
+import tracing
+from durable_writes import DurableWriter
+from meta_cache import JSONFileCache
+
+
+class SessionStoreError(Exception): ...
+class UnknownUserError(SessionStoreError): ...
+
+
+class Session:
+    __slots__ = ("username", "token_hash", "created")
+
+    def __init__(self, username: str, token_hash: str, created: int) -> None:
+        self.username = username
+        self.token_hash = token_hash
+        self.created = created
+
+
+class SessionStore:
+    """In-memory index of all loaded sessions with write-through to the per-user session files.
+    Account meta files are read and written through `meta_cache`, session files are written by `writer`."""
+
+    def __init__(
+            self,
+            accounts_dir: str,
+            meta_cache: JSONFileCache,
+            writer: DurableWriter,
+            ttl: int,
+            max_sessions_per_user: int
+    ) -> None:
+        self.accounts_dir = accounts_dir
+        self.meta_cache = meta_cache
+        self.writer = writer
+        self.ttl = ttl
+        self.max_sessions_per_user = max_sessions_per_user
+        self._sessions: dict[str, Session] = {}
+        self._sessions_by_user: dict[str, dict[str, Session]] = {}   # insertion order = creation order
+        self._lock = threading.RLock()
+
+    def _sessions_file(self, username: str) -> str:
+        return os.path.join(self.accounts_dir, username, "sessions.json")
+
+    def _meta_file(self, username: str) -> str:
+        return os.path.join(self.accounts_dir, username, "meta.json")
+
+    def _read_legacy_tokens(self, username: str) -> list[str]:
+        try:
+            user_meta = self.meta_cache.get(self._meta_file(username), mutable=False)
+        except FileNotFoundError:
+            raise UnknownUserError(username)
+        return user_meta.get('validTokens', [])
+
+    def _drop_legacy_tokens(self, username: str) -> None:
+        """Removes `validTokens` from the account meta. Only called after the session file was written."""
+        meta_file = self._meta_file(username)
+        user_meta = self.meta_cache.get(meta_file)
+        if user_meta.pop('validTokens', None) is None:
+            return
+        self.meta_cache.write(meta_file, user_meta)
+
+    def _is_expired(self, session: Session, now: float) -> bool:
+        return now - session.created > self.ttl
+
+    def _user_sessions(self, username: str) -> dict[str, Session]:
+        """Returns the sessions of a user, loading them from disk if necessary. Must be called with the lock held."""
+        user_sessions = self._sessions_by_user.get(username)
+        if user_sessions is not None:
+            return user_sessions
+
+        try:
+            with tracing.span("file_read"), open(self._sessions_file(username), 'rb') as file:
+                data = file.read()
+            metrics.record_read("sessions", len(data))
+            stored_sessions: dict[str, int] = json.loads(data)
+            migrated = False
+        except FileNotFoundError:
+            now = int(time.time())
+            stored_sessions = {token_hash: now for token_hash in self._read_legacy_tokens(username)}
+            migrated = True
+
+        now = time.time()
+        user_sessions = {}
+        for token_hash, created in sorted(stored_sessions.items(), key=lambda item: item[1]):
+            session = Session(username, token_hash, created)
+            if not self._is_expired(session, now):
+                user_sessions[token_hash] = session
+                self._sessions[token_hash] = session
+
+        self._sessions_by_user[username] = user_sessions
+        if migrated or len(user_sessions) != len(stored_sessions):
+            self._save(username)
+        if migrated:
+            self._drop_legacy_tokens(username)
+        return user_sessions
+
+    def _save(self, username: str) -> None:
+        user_sessions = self._sessions_by_user[username]
+        self.writer.write_json(
+            self._sessions_file(username),
+            {token_hash: session.created for token_hash, session in user_sessions.items()}
+        )
+
+    def _remove(self, username: str, token_hashes: list[str]) -> None:
+        user_sessions = self._sessions_by_user[username]
+        for token_hash in token_hashes:
+            del user_sessions[token_hash]
+            del self._sessions[token_hash]
+
+    def validate(self, username: str, token_hash: str) -> bool:
+        """Checks whether `token_hash` belongs to a valid session of `username`.
+        Raises `UnknownUserError` if the user doesn't exist."""
+        with self._lock:
+            user_sessions = self._user_sessions(username)
+            session = user_sessions.get(token_hash)
+            if session is None:
+                return False
+
+            if self._is_expired(session, time.time()):
+                self._remove(username, [token_hash])
+                self._save(username)
+                return False
+
+            return True
+
+    def validate_cached(self, username: str, token_hash: str) -> bool | None:
+        """Like `validate`, but only looks at the sessions in memory and never waits for the lock, so it can be
+        called on an event loop. Returns None if that isn't enough to tell (the user's sessions aren't loaded yet,
+        or the session expired and has to be removed); `validate` has to be called then."""
+        session = self._sessions.get(token_hash)
+        if session is None:
+            # Dict lookups are atomic; a user's sessions are only put in `_sessions_by_user` once they are complete
+            return False if username in self._sessions_by_user else None
+        if session.username != username:
+            return False
+        if self._is_expired(session, time.time()):
+            return None
+        return True
+
+    def add(self, username: str, token_hash: str) -> None:
+        """Creates a new session. The oldest sessions are dropped if the user has too many."""
+        with self._lock:
+            user_sessions = self._user_sessions(username)
+            session = Session(username, token_hash, int(time.time()))
+            user_sessions[token_hash] = session
+            self._sessions[token_hash] = session
+
+            surplus = len(user_sessions) - self.max_sessions_per_user
+            if surplus > 0:
+                self._remove(username, list(user_sessions)[:surplus])
+
+            self._save(username)
+
+    def revoke_all_except(self, username: str, token_hash: str) -> None:
+        with self._lock:
+            user_sessions = self._user_sessions(username)
+            self._remove(username, [other_hash for other_hash in user_sessions if other_hash != token_hash])
+            self._save(username)
+
+    def revoke_all(self, username: str) -> None:
+        with self._lock:
+            user_sessions = self._user_sessions(username)
+            self._remove(username, list(user_sessions))
+            self._save(username)
@@ -0,0 +1,544 @@
+"""SQLite implementation of the storage interface of storage.py.
+
+Everything is kept in one database file in WAL mode, so reading never waits for writing.
+Every thread gets its own connection; the SQL statements are constants, so each connection prepares them once
+and reuses them from its statement cache. Operations touching several tables run in a single transaction.
+
+Messages are addressed like in the other message stores: by batch and position in the batch.
+Deleted messages keep their row (with the body set to NULL), so positions and batches don't shift.
+"""
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterable
+
+import tracing
+from message_store import BatchNotFoundError, ChannelNotFoundError, MessageStore, MessageStoreError, encode_message
+from sessions import SessionStoreError, UnknownUserError
+from storage import (
+    DELETED_ACCOUNT, AccountExistsError, AlreadyMemberError, NotMemberError, PermissionDeniedError,
+    Storage, StorageError, UnknownChannelError
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    username TEXT PRIMARY KEY,
+    displayname TEXT NOT NULL,
+    account_created INTEGER NOT NULL,
+    password_hash TEXT NOT NULL,
+    public_key TEXT NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    token_hash TEXT PRIMARY KEY,
+    username TEXT NOT NULL REFERENCES accounts (username),
+    created INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_by_user ON sessions (username, created);
+CREATE TABLE IF NOT EXISTS channels (
+    channel_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    timestamp_created INTEGER NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    messages_modified REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS memberships (
+    id INTEGER PRIMARY KEY,     -- members are listed in the order they were added
+    channel_id TEXT NOT NULL REFERENCES channels (channel_id),
+    username TEXT NOT NULL REFERENCES accounts (username),
+    encrypted_key TEXT NOT NULL,
+    iv TEXT NOT NULL,
+    UNIQUE (channel_id, username)
+);
+CREATE INDEX IF NOT EXISTS memberships_by_user ON memberships (username);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    channel_id TEXT NOT NULL REFERENCES channels (channel_id),
+    batch_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    author TEXT NOT NULL,
+    body BLOB                   -- the JSON encoded message; NULL once deleted
+);
+CREATE UNIQUE INDEX IF NOT EXISTS messages_by_channel ON messages (channel_id, batch_id, position);
+CREATE INDEX IF NOT EXISTS messages_by_author ON messages (author, channel_id);
+"""
+
+# `PRAGMA synchronous` for the durability modes of durable_writes.py. In WAL mode "NORMAL" only syncs
+# when the WAL is checkpointed, so a power loss can lose the latest transactions (like with group commit).
+SYNCHRONOUS_BY_DURABILITY = {"none": "OFF", "fsync-file": "FULL", "fsync-dir": "FULL", "group-commit": "NORMAL"}
+
+
+class Database:
+    """Hands out one connection per thread and runs transactions on it."""
+
+    def __init__(self, db_file: str, durability: str) -> None:
+        self.db_file = db_file
+        self.synchronous = SYNCHRONOUS_BY_DURABILITY[durability]
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+        try:
+            self.connection().executescript(SCHEMA)
+        except sqlite3.Error as e:
+            raise StorageError(str(e)) from e
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Transactions are started explicitly (see `transaction`), hence no isolation level
+            connection = sqlite3.connect(
+                self.db_file, timeout=30, isolation_level=None, check_same_thread=False, cached_statements=256
+            )
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute(f"PRAGMA synchronous = {self.synchronous}")
+            connection.execute("PRAGMA foreign_keys = ON")
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    @contextmanager
+    def transaction(self, error_type: type[Exception], write: bool = False):
+        """Runs the block in a transaction and yields the connection. Write transactions take the write lock
+        right away, so what they read stays valid until they commit. SQLite errors are raised as `error_type`."""
+        connection = self.connection()
+        with tracing.span("file_write" if write else "file_read"):
+            try:
+                connection.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+                try:
+                    yield connection
+                    connection.execute("COMMIT")
+                except BaseException:
+                    connection.execute("ROLLBACK")
+                    raise
+            except sqlite3.Error as e:
+                raise error_type(str(e)) from e
+
+    def close(self) -> None:
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+
+
+class SQLiteMessageStore(MessageStore):
+    """The `messages` table. Channels are created and deleted by `SQLiteStorage`."""
+
+    def __init__(self, database: Database, batch_size: int) -> None:
+        # Nothing is stored in the channel directories, and SQLite takes care of durability itself
+        self.database = database
+        self.batch_size = batch_size
+
+    @staticmethod
+    def _latest_batch(connection: sqlite3.Connection, channel_id: str) -> int:
+        latest = connection.execute("SELECT max(batch_id) FROM messages WHERE channel_id = ?", (channel_id,)).fetchone()[0]
+        if latest is not None:
+            return latest
+        if connection.execute("SELECT 1 FROM channels WHERE channel_id = ?", (channel_id,)).fetchone() is None:
+            raise ChannelNotFoundError(channel_id)
+        return 1
+
+    def _check_batch(self, connection: sqlite3.Connection, channel_id: str, batch_id: int) -> None:
+        if not 1 <= batch_id <= self._latest_batch(connection, channel_id):
+            raise BatchNotFoundError(batch_id)
+
+    def create_channel(self, channel_id: str) -> None:
+        pass
+
+    def latest_batch(self, channel_id: str) -> int:
+        with self.database.transaction(MessageStoreError) as connection:
+            return self._latest_batch(connection, channel_id)
+
+    def append_many(self, channel_id: str, message_objs: list[dict]) -> list[int]:
+        with self.database.transaction(MessageStoreError, write=True) as connection:
+            batch_id = self._latest_batch(connection, channel_id)
+            count, live_count = connection.execute(
+                "SELECT count(*), count(body) FROM messages WHERE channel_id = ? AND batch_id = ?", (channel_id, batch_id)
+            ).fetchone()
+
+            rows = []
+            for message_obj in message_objs:
+                if live_count >= self.batch_size:
+                    batch_id += 1
+                    count = live_count = 0
+                rows.append((channel_id, batch_id, count, message_obj.get('timestamp', 0), message_obj['author'],
+                             encode_message(message_obj)))
+                count += 1
+                live_count += 1
+
+            connection.executemany(
+                "INSERT INTO messages (channel_id, batch_id, position, timestamp, author, body) VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            connection.execute("UPDATE channels SET messages_modified = ? WHERE channel_id = ?", (time.time(), channel_id))
+
+        return [row[1] for row in rows]
+
+    def latest_sequence(self, channel_id: str) -> int:
+        # Deleted messages keep their row: the newest message's number plus the deleted rows after it
+        # (see `LogMessageStore.latest_sequence`)
+        with self.database.transaction(MessageStoreError) as connection:
+            self._latest_batch(connection, channel_id)
+            count = connection.execute("SELECT count(*) FROM messages WHERE channel_id = ?", (channel_id,)).fetchone()[0]
+            newest = connection.execute(
+                "SELECT id, body FROM messages WHERE channel_id = ? AND body IS NOT NULL ORDER BY id DESC LIMIT 1",
+                (channel_id,)
+            ).fetchone()
+            if newest is None:
+                return count
+            deleted_after = connection.execute(
+                "SELECT count(*) FROM messages WHERE channel_id = ? AND id > ?", (channel_id, newest[0])
+            ).fetchone()[0]
+        return max(count, json.loads(newest[1]).get('seq', 0) + deleted_after)
+
+    def read_batch(self, channel_id: str, batch_id: int) -> list[dict]:
+        return [json.loads(line) for _, _, line in self.batch_entries(channel_id, batch_id)]
+
+    def batch_entries(self, channel_id: str, batch_id: int) -> list[tuple[int, int, bytes]]:
+        with self.database.transaction(MessageStoreError) as connection:
+            self._check_batch(connection, channel_id, batch_id)
+            return connection.execute(
+                "SELECT position, timestamp, body FROM messages "
+                "WHERE channel_id = ? AND batch_id = ? AND body IS NOT NULL ORDER BY position",
+                (channel_id, batch_id)
+            ).fetchall()
+
+    def batch_version(self, channel_id: str, batch_id: int) -> tuple[str, float]:
+        with self.database.transaction(MessageStoreError) as connection:
+            self._check_batch(connection, channel_id, batch_id)
+            count, live_count, last_id = connection.execute(
+                "SELECT count(*), count(body), max(id) FROM messages WHERE channel_id = ? AND batch_id = ?",
+                (channel_id, batch_id)
+            ).fetchone()
+            modified = connection.execute(
+                "SELECT messages_modified FROM channels WHERE channel_id = ?", (channel_id,)
+            ).fetchone()[0]
+
+        return f'"{batch_id:x}-{last_id or 0:x}-{count:x}-{live_count:x}"', modified
+
+    def read_before(
+            self,
+            channel_id: str,
+            before: tuple[int, int] | None,
+            limit: int,
+            since: int | None = None
+    ) -> tuple[list[bytes], tuple[int, int] | None]:
+        query = "SELECT batch_id, position, body FROM messages WHERE channel_id = ? AND body IS NOT NULL"
+        parameters: list = [channel_id]
+        if before is not None:
+            query += " AND (batch_id, position) < (?, ?)"
+            parameters += before
+        if since is not None:
+            query += " AND timestamp >= ?"
+            parameters.append(since)
+        query += " ORDER BY batch_id DESC, position DESC LIMIT ?"
+        parameters.append(limit + 1)
+
+        with self.database.transaction(MessageStoreError) as connection:
+            self._latest_batch(connection, channel_id)
+            rows = connection.execute(query, parameters).fetchall()
+
+        lines = [body for _, _, body in rows[:limit]]
+        if len(rows) <= limit:
+            return lines[::-1], None
+        batch_id, position, _ = rows[limit]
+        return lines[::-1], (batch_id, position + 1)
+
+    def read_author(self, channel_id: str, username: str, batch_ids: Iterable[int] | None = None) -> list[bytes]:
+        # `messages_by_author` finds the messages directly; `batch_ids` isn't needed
+        with self.database.transaction(MessageStoreError) as connection:
+            rows = connection.execute(
+                "SELECT body FROM messages WHERE author = ? AND channel_id = ? AND body IS NOT NULL "
+                "ORDER BY batch_id, position",
+                (username, channel_id)
+            ).fetchall()
+        return [body for body, in rows]
+
+    def remove_author(self, channel_id: str, username: str, batch_ids: Iterable[int] | None = None) -> int:
+        with self.database.transaction(MessageStoreError, write=True) as connection:
+            removed = connection.execute(
+                "UPDATE messages SET body = NULL WHERE channel_id = ? AND author = ? AND body IS NOT NULL",
+                (channel_id, username)
+            ).rowcount
+            connection.execute("UPDATE channels SET messages_modified = ? WHERE channel_id = ?", (time.time(), channel_id))
+        return removed
+
+
+class SQLiteSessionStore:
+    """The `sessions` table; same interface as `sessions.SessionStore`."""
+
+    def __init__(self, database: Database, ttl: int, max_sessions_per_user: int) -> None:
+        self.database = database
+        self.ttl = ttl
+        self.max_sessions_per_user = max_sessions_per_user
+
+    def validate(self, username: str, token_hash: str) -> bool:
+        with self.database.transaction(SessionStoreError) as connection:
+            row = connection.execute(
+                "SELECT (SELECT created FROM sessions WHERE token_hash = ? AND username = ?) FROM accounts WHERE username = ?",
+                (token_hash, username, username)
+            ).fetchone()
+        if row is None:
+            raise UnknownUserError(username)
+
+        created = row[0]
+        if created is None:
+            return False
+
+        if time.time() - created > self.ttl:
+            with self.database.transaction(SessionStoreError, write=True) as connection:
+                connection.execute("DELETE FROM sessions WHERE token_hash = ?", (token_hash,))
+            return False
+
+        return True
+
+    def validate_cached(self, username: str, token_hash: str) -> bool | None:
+        """Sessions are only in the database, so this never knows; see `sessions.SessionStore.validate_cached`."""
+        return None
+
+    def add(self, username: str, token_hash: str) -> None:
+        now = int(time.time())
+        with self.database.transaction(SessionStoreError, write=True) as connection:
+            try:
+                connection.execute(
+                    "INSERT INTO sessions (token_hash, username, created) VALUES (?, ?, ?)", (token_hash, username, now)
+                )
+            except sqlite3.IntegrityError:
+                raise UnknownUserError(username)
+
+            # Drop expired sessions, then the oldest ones if the user has too many
+            connection.execute("DELETE FROM sessions WHERE username = ? AND created < ?", (username, now - self.ttl))
+            connection.execute(
+                "DELETE FROM sessions WHERE username = ? AND token_hash NOT IN ("
+                "SELECT token_hash FROM sessions WHERE username = ? ORDER BY created DESC, rowid DESC LIMIT ?)",
+                (username, username, self.max_sessions_per_user)
+            )
+
+    def revoke_all_except(self, username: str, token_hash: str) -> None:
+        with self.database.transaction(SessionStoreError, write=True) as connection:
+            connection.execute("DELETE FROM sessions WHERE username = ? AND token_hash != ?", (username, token_hash))
+
+    def revoke_all(self, username: str) -> None:
+        with self.database.transaction(SessionStoreError, write=True) as connection:
+            connection.execute("DELETE FROM sessions WHERE username = ?", (username,))
+
+
+class SQLiteStorage(Storage):
+    """Accounts, channels and memberships in their own tables. `latestMessageBatch` is not stored;
+    it comes from the messages table."""
+
+    def __init__(self, db_file: str, batch_size: int, durability: str, session_ttl: int, max_sessions_per_user: int) -> None:
+        self.database = Database(db_file, durability)
+        self.messages = SQLiteMessageStore(self.database, batch_size)
+        self.sessions = SQLiteSessionStore(self.database, session_ttl, max_sessions_per_user)
+
+    @staticmethod
+    def _check_account(connection: sqlite3.Connection, username: str) -> None:
+        if connection.execute("SELECT 1 FROM accounts WHERE username = ?", (username,)).fetchone() is None:
+            raise UnknownUserError(username)
+
+    @staticmethod
+    def _check_channel(connection: sqlite3.Connection, channel_id: str) -> None:
+        """Raises `UnknownChannelError` for channels flagged as deleted as well."""
+        row = connection.execute("SELECT deleted FROM channels WHERE channel_id = ?", (channel_id,)).fetchone()
+        if row is None or row[0]:
+            raise UnknownChannelError(channel_id)
+
+    @staticmethod
+    def _is_member(connection: sqlite3.Connection, channel_id: str, username: str) -> bool:
+        return connection.execute(
+            "SELECT 1 FROM memberships WHERE channel_id = ? AND username = ?", (channel_id, username)
+        ).fetchone() is not None
+
+    def get_account(self, username: str) -> dict:
+        with self.database.transaction(StorageError) as connection:
+            row = connection.execute(
+                "SELECT displayname, account_created, password_hash, public_key, deleted FROM accounts WHERE username = ?",
+                (username,)
+            ).fetchone()
+            if row is None:
+                raise UnknownUserError(username)
+            memberships = connection.execute(
+                "SELECT channel_id, encrypted_key, iv FROM memberships WHERE username = ? ORDER BY id", (username,)
+            ).fetchall()
+
+        displayname, account_created, password_hash, public_key, deleted = row
+        if deleted:
+            return dict(DELETED_ACCOUNT)
+        return {
+            "displayname": displayname,
+            "accountCreated": account_created,
+            "passwordHash": password_hash,
+            "deleted": False,
+            "publicKey": public_key,
+            "channels": {channel_id: {"encryptedKey": encrypted_key, "iv": iv} for channel_id, encrypted_key, iv in memberships},
+        }
+
+    def create_account(self, username: str, account: dict) -> None:
+        with self.database.transaction(StorageError, write=True) as connection:
+            try:
+                connection.execute(
+                    "INSERT INTO accounts (username, displayname, account_created, password_hash, public_key, deleted) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (username, account['displayname'], account['accountCreated'], account['passwordHash'],
+                     account['publicKey'], account['deleted'])
+                )
+            except sqlite3.IntegrityError:
+                raise AccountExistsError(username)
+
+            connection.executemany(
+                "INSERT INTO memberships (channel_id, username, encrypted_key, iv) VALUES (?, ?, ?, ?)",
+                [(channel_id, username, key['encryptedKey'], key['iv']) for channel_id, key in account['channels'].items()]
+            )
+
+    def set_password_hash(self, username: str, password_hash: str) -> None:
+        with self.database.transaction(StorageError, write=True) as connection:
+            self._check_account(connection, username)
+            connection.execute(
+                "UPDATE accounts SET password_hash = ? WHERE username = ? AND NOT deleted", (password_hash, username)
+            )
+
+    def mark_account_deleted(self, username: str) -> None:
+        with self.database.transaction(StorageError, write=True) as connection:
+            self._check_account(connection, username)
+            connection.execute("UPDATE accounts SET deleted = 1 WHERE username = ?", (username,))
+            connection.execute("DELETE FROM sessions WHERE username = ?", (username,))
+
+    def delete_account(self, username: str) -> None:
+        now = time.time()
+        with self.database.transaction(StorageError, write=True) as connection:
+            self._check_account(connection, username)
+            # Including the channels the user left
+            connection.execute(
+                "UPDATE channels SET messages_modified = ? WHERE channel_id IN "
+                "(SELECT DISTINCT channel_id FROM messages WHERE author = ? AND body IS NOT NULL)",
+                (now, username)
+            )
+            connection.execute("UPDATE messages SET body = NULL WHERE author = ? AND body IS NOT NULL", (username,))
+            connection.execute("DELETE FROM memberships WHERE username = ?", (username,))
+            connection.execute("DELETE FROM sessions WHERE username = ?", (username,))
+            connection.execute(
+                "UPDATE accounts SET displayname = ?, account_created = ?, password_hash = ?, public_key = ?, deleted = 1 "
+                "WHERE username = ?",
+                (DELETED_ACCOUNT['displayname'], DELETED_ACCOUNT['accountCreated'], DELETED_ACCOUNT['passwordHash'],
+                 DELETED_ACCOUNT['publicKey'], username)
+            )
+
+    def pending_deletions(self) -> tuple[list[str], list[str]]:
+        with self.database.transaction(StorageError) as connection:
+            # Purged accounts get the password hash of `DELETED_ACCOUNT`
+            usernames = connection.execute(
+                "SELECT username FROM accounts WHERE deleted AND password_hash != ? ORDER BY username",
+                (DELETED_ACCOUNT['passwordHash'],)
+            ).fetchall()
+            channel_ids = connection.execute(
+                "SELECT channel_id FROM channels WHERE deleted ORDER BY channel_id"
+            ).fetchall()
+        return [username for username, in usernames], [channel_id for channel_id, in channel_ids]
+
+    def export_messages(self, username: str) -> dict[str, list[bytes]]:
+        with self.database.transaction(StorageError) as connection:
+            rows = connection.execute(
+                "SELECT channel_id, body FROM messages WHERE author = ? AND body IS NOT NULL "
+                "ORDER BY channel_id, batch_id, position",
+                (username,)
+            ).fetchall()
+
+        messages: dict[str, list[bytes]] = {}
+        for channel_id, body in rows:
+            messages.setdefault(channel_id, []).append(body)
+        return messages
+
+    def get_channel(self, channel_id: str) -> dict:
+        with self.database.transaction(StorageError) as connection:
+            row = connection.execute(
+                "SELECT name, timestamp_created, deleted FROM channels WHERE channel_id = ?", (channel_id,)
+            ).fetchone()
+            if row is None:
+                raise UnknownChannelError(channel_id)
+            members = connection.execute(
+                "SELECT username FROM memberships WHERE channel_id = ? ORDER BY id", (channel_id,)
+            ).fetchall()
+            latest_batch = connection.execute(
+                "SELECT max(batch_id) FROM messages WHERE channel_id = ?", (channel_id,)
+            ).fetchone()[0]
+
+        name, timestamp_created, deleted = row
+        return {
+            "name": name,
+            "timestampCreated": timestamp_created,
+            "members": [username for username, in members],
+            "latestMessageBatch": latest_batch or 1,
+            "deleted": bool(deleted),
+        }
+
+    def channel_summaries(self, username: str) -> dict[str, dict]:
+        # The newest message of each channel is found through `messages_by_channel`, without reading the others
+        with self.database.transaction(StorageError) as connection:
+            self._check_account(connection, username)
+            rows = connection.execute(
+                "SELECT channels.channel_id, channels.name, ("
+                "    SELECT timestamp FROM messages WHERE messages.channel_id = channels.channel_id AND body IS NOT NULL"
+                "    ORDER BY batch_id DESC, position DESC LIMIT 1"
+                ") FROM memberships JOIN channels USING (channel_id) "
+                "WHERE memberships.username = ? AND NOT channels.deleted ORDER BY memberships.id",
+                (username,)
+            ).fetchall()
+        return {channel_id: {"name": name, "lastMessage": last_message} for channel_id, name, last_message in rows}
+
+    def create_channel(self, channel_id: str, channel: dict, creator: str, encrypted_key: str, iv: str) -> None:
+        with self.database.transaction(StorageError, write=True) as connection:
+            self._check_account(connection, creator)
+            connection.execute(
+                "INSERT INTO channels (channel_id, name, timestamp_created, deleted, messages_modified) VALUES (?, ?, ?, ?, ?)",
+                (channel_id, channel['name'], channel['timestampCreated'], channel['deleted'], time.time())
+            )
+            connection.execute(
+                "INSERT INTO memberships (channel_id, username, encrypted_key, iv) VALUES (?, ?, ?, ?)",
+                (channel_id, creator, encrypted_key, iv)
+            )
+
+    def mark_channel_deleted(self, channel_id: str, acting_user: str) -> None:
+        with self.database.transaction(StorageError, write=True) as connection:
+            self._check_channel(connection, channel_id)
+            if not self._is_member(connection, channel_id, acting_user):
+                raise PermissionDeniedError(acting_user)
+            connection.execute("UPDATE channels SET deleted = 1 WHERE channel_id = ?", (channel_id,))
+
+    def delete_channel(self, channel_id: str) -> None:
+        with self.database.transaction(StorageError, write=True) as connection:
+            connection.execute("DELETE FROM messages WHERE channel_id = ?", (channel_id,))
+            connection.execute("DELETE FROM memberships WHERE channel_id = ?", (channel_id,))
+            connection.execute("DELETE FROM channels WHERE channel_id = ?", (channel_id,))
+
+    def add_member(self, channel_id: str, acting_user: str, new_member: str, encrypted_key: str, iv: str) -> None:
+        with self.database.transaction(StorageError, write=True) as connection:
+            self._check_account(connection, new_member)
+            if self._is_member(connection, channel_id, new_member):
+                raise AlreadyMemberError(new_member)
+            self._check_channel(connection, channel_id)
+            if not self._is_member(connection, channel_id, acting_user):
+                raise PermissionDeniedError(acting_user)
+
+            connection.execute(
+                "INSERT INTO memberships (channel_id, username, encrypted_key, iv) VALUES (?, ?, ?, ?)",
+                (channel_id, new_member, encrypted_key, iv)
+            )
+
+    def remove_member(self, channel_id: str, acting_user: str, member: str) -> None:
+        with self.database.transaction(StorageError, write=True) as connection:
+            self._check_account(connection, member)
+            if not self._is_member(connection, channel_id, member):
+                raise NotMemberError(member)
+            self._check_channel(connection, channel_id)
+            if not self._is_member(connection, channel_id, acting_user):
+                raise PermissionDeniedError(acting_user)
+
+            connection.execute("DELETE FROM memberships WHERE channel_id = ? AND username = ?", (channel_id, member))
+
+    def close(self) -> None:
+        self.database.close()
@@ -0,0 +1,181 @@
+"""In-memory cache of the frontend files (`frontend_files/`), with precompressed variants.
+
+Every file is read once at startup and compressed with gzip (and brotli, if the `brotli` package is installed),
+so requests for static files never touch the disk. Each file gets a strong ETag from its content hash.
+
+In the HTML files, the links to scripts, stylesheets and images get the content hash appended
+(`/index_logic.js?v=<hash>`). Requests with the current hash are cached by browsers for a year without asking
+again; when a file changes, its hash and therefore the URL in the HTML change. The HTML files themselves
+(and requests without or with an old hash) have to be revalidated every time, which is a cheap 304 response
+while nothing changed. Links to other pages are left alone: some pages are served by handlers which redirect
+depending on the session (e.g. /login.html when logged in), so they must never be cached.
+
+In development mode, the files are checked for changes (at most once a second, when they are requested)
+and everything is loaded again if any file changed.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+import time
+from typing import NamedTuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import logs
+
+# Only these are worth compressing; images like favicon.ico are compressed already (or barely shrink)
+COMPRESSIBLE_TYPES = {"text/html", "text/css", "text/javascript", "application/javascript", "application/json", "image/svg+xml"}
+LINK = re.compile(rb'(?P<attribute>(?:src|href)=")(?P<path>/[^"?#]*)"')
+# Only links to these are versioned
+SUBRESOURCE_TYPES = {"text/css", "text/javascript", "application/javascript"}
+HASH_LENGTH = 16
+IMMUTABLE_MAX_AGE = 60 * 60 * 24 * 365
+
+log = logs.get_logger("static_files")
+
+
+class StaticFile(NamedTuple):
+    content_type: str
+    etag: str                       # of the uncompressed variant; the others get a suffix
+    last_modified: float
+    variants: dict[str, bytes]      # content encoding ("identity", "gzip", "br") -> body
+    version: str | None             # the content hash used in links; None for files which aren't linked versioned
+
+
+class StaticFiles:
+    def __init__(self, web_dir: str, dev_mode: bool = False, check_interval: float = 1.0) -> None:
+        self.web_dir = web_dir
+        self.dev_mode = dev_mode
+        self.check_interval = check_interval
+        self._files: dict[str, StaticFile] = {}
+        self._versions: dict[str, tuple[int, int]] = {}   # file path -> (mtime, size) when it was loaded
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self.reloads = 0
+        self.load()
+
+    def get(self, url_path: str) -> StaticFile | None:
+        """The file for a URL path (e.g. "/index.html"; "/" is the index), or None if there is none."""
+        if self.dev_mode and time.monotonic() - self._checked >= self.check_interval:
+            self._reload_if_changed()
+        return self._files.get("/index.html" if url_path == "/" else url_path)
+
+    def load(self) -> None:
+        """Reads, rewrites and compresses every file. The new files replace the old ones at once,
+        so requests in the meantime are served the old ones."""
+        versions = self._scan()
+        contents = {}
+        for file_path in versions:
+            with open(file_path, 'rb') as file:
+                contents[self._url_path(file_path)] = (file_path, file.read())
+
+        # The hashes of the files which are linked have to be known before rewriting the links in the HTML files
+        hashes = {url_path: self._hash(content) for url_path, (_, content) in contents.items()
+                  if is_subresource(mimetypes.guess_type(url_path)[0])}
+
+        def versioned_link(match: re.Match) -> bytes:
+            url_path = match.group('path').decode('utf-8', 'replace')
+            if url_path not in hashes:
+                return match.group(0)
+            return match.group('attribute') + match.group('path') + b"?v=" + hashes[url_path].encode() + b'"'
+
+        files = {}
+        for url_path, (file_path, content) in contents.items():
+            content_type = mimetypes.guess_type(url_path)[0] or "application/octet-stream"
+            if content_type == "text/html":
+                content = LINK.sub(versioned_link, content)
+            files[url_path] = StaticFile(
+                content_type=content_type,
+                etag=f'"{self._hash(content)}"',
+                last_modified=versions[file_path][0] / 1e9,
+                variants=self._compress(content, content_type),
+                version=hashes.get(url_path),
+            )
+
+        self._files = files
+        self._versions = versions
+        self._checked = time.monotonic()
+
+    def stats(self) -> dict:
+        return {
+            "files": len(self._files),
+            "bytes": sum(len(body) for file in self._files.values() for body in file.variants.values()),
+            "reloads": self.reloads,
+        }
+
+    def _reload_if_changed(self) -> None:
+        with self._lock:
+            if time.monotonic() - self._checked < self.check_interval:   # another thread just checked
+                return
+            if self._scan() == self._versions:
+                self._checked = time.monotonic()
+                return
+            log.info("reloading")
+            try:
+                self.load()
+            except OSError as e:   # e.g. a file deleted while loading; the next check tries again
+                log.warning("reload_failed", error=str(e))
+                return
+            self.reloads += 1
+
+    def _scan(self) -> dict[str, tuple[int, int]]:
+        versions = {}
+        for dir_path, _, file_names in os.walk(self.web_dir):
+            for file_name in file_names:
+                file_path = os.path.join(dir_path, file_name)
+                stat = os.stat(file_path)
+                versions[file_path] = (stat.st_mtime_ns, stat.st_size)
+        return versions
+
+    def _url_path(self, file_path: str) -> str:
+        return "/" + os.path.relpath(file_path, self.web_dir).replace(os.sep, "/")
+
+    @staticmethod
+    def _hash(content: bytes) -> str:
+        return hashlib.sha256(content).hexdigest()[:HASH_LENGTH]
+
+    @staticmethod
+    def _compress(content: bytes, content_type: str) -> dict[str, bytes]:
+        variants = {"identity": content}
+        if content_type not in COMPRESSIBLE_TYPES:
+            return variants
+
+        compressed = {"gzip": gzip.compress(content, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            compressed["br"] = brotli.compress(content, quality=11)
+        for encoding, body in compressed.items():
+            if len(body) < len(content):
+                variants[encoding] = body
+        return variants
+
+
+def is_subresource(content_type: str | None) -> bool:
+    """Whether files of a content type are loaded by pages (scripts, stylesheets, images), as opposed to pages."""
+    return content_type is not None and (content_type in SUBRESOURCE_TYPES or content_type.startswith("image/"))
+
+
+def choose_encoding(accept_encoding: str | None, available) -> str:
+    """Picks the most compact of the `available` content encodings the client accepts (`Accept-Encoding` header)."""
+    if not accept_encoding:
+        return "identity"
+
+    accepted = set()
+    for item in accept_encoding.split(","):
+        encoding, _, params = item.strip().partition(";")
+        try:
+            quality = float(params.strip().removeprefix("q=")) if params else 1.0
+        except ValueError:
+            continue
+        if quality > 0:
+            accepted.add(encoding.strip().lower())
+
+    for encoding in ("br", "gzip"):
+        if encoding in available and (encoding in accepted or "*" in accepted):
+            return encoding
+    return "identity"
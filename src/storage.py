@@ -0,0 +1,463 @@
+"""Persistence of accounts, sessions, channels, memberships and messages.
+
+Request handlers only talk to a `Storage`; which one is used is decided at startup (`--storage`, see server.py):
+
+- `JSONStorage` is the original layout under `backend_files/`: one meta JSON file per account
+  (`accounts/<user>/meta.json`, memberships are stored in there as well) and per channel (`channels/<id>/meta.json`),
+  the messages in one of the layouts of message_store.py and the sessions as described in sessions.py.
+- `SQLiteStorage` (sqlite_storage.py) keeps everything in one SQLite database.
+
+Accounts and channels are handed out as the dicts the HTTP API sends, i.e. in the layout of the JSON meta files.
+They are shared and must not be modified.
+"""
+import math
+import os
+import shutil
+import threading
+
+import logs
+from author_index import AuthorIndex
+from file_locks import PathLocks
+from message_store import ChannelNotFoundError, MessageStore
+from meta_cache import JSONFileCache
+from sessions import SessionStore, UnknownUserError
+
+
+class StorageError(Exception): ...
+class UnknownChannelError(StorageError): ...
+class AccountExistsError(StorageError): ...
+class PermissionDeniedError(StorageError): ...
+class AlreadyMemberError(StorageError): ...
+class NotMemberError(StorageError): ...
+
+
+DELETED_ACCOUNT = {
+    "displayname": "Deleted User",
+    "accountCreated": 0,
+    "passwordHash": " ",
+    "channels": [],
+    "publicKey": " ",
+    "deleted": True,
+}
+
+log = logs.get_logger("storage")
+
+
+def list_subdirs(path: str) -> list[str]:
+    try:
+        with os.scandir(path) as entries:
+            return sorted(entry.name for entry in entries if entry.is_dir())
+    except FileNotFoundError:
+        return []
+
+
+class Storage:
+    """Interface of the storage backends. Methods raise `UnknownUserError`/`UnknownChannelError` for accounts and
+    channels which don't exist and `OSError` or `StorageError` (or the error types of `messages`/`sessions`)
+    if the storage itself fails. Channel operations done in the name of a user (`acting_user`) raise
+    `PermissionDeniedError` if that user isn't a member of the channel.\n
+    Deleting an account or a channel happens in two steps: the request flags it as deleted (which is quick)
+    and a background job (see jobs.py) purges it later."""
+    messages: MessageStore
+    sessions: SessionStore
+
+    def get_account(self, username: str) -> dict:
+        raise NotImplementedError
+
+    def create_account(self, username: str, account: dict) -> None:
+        """Raises `AccountExistsError` if the username is taken (also by a deleted account)."""
+        raise NotImplementedError
+
+    def set_password_hash(self, username: str, password_hash: str) -> None:
+        """Replaces the password hash of an account, e.g. to upgrade an outdated hash. Does nothing for deleted accounts."""
+        raise NotImplementedError
+
+    def mark_account_deleted(self, username: str) -> None:
+        """Flags an account as deleted, so it can't log in anymore, and logs out all its sessions.
+        The account is purged later by `delete_account`."""
+        raise NotImplementedError
+
+    def delete_account(self, username: str) -> None:
+        """Deletes the messages and memberships of a user, purges the account and logs out all its sessions.
+        The username stays taken. Runs as a background job: it can be interrupted and must be safe to run again."""
+        raise NotImplementedError
+
+    def pending_deletions(self) -> tuple[list[str], list[str]]:
+        """Returns the usernames and channel IDs flagged as deleted which weren't purged yet, so their jobs can be
+        queued again when the server starts (e.g. if queueing the job failed after flagging). Reads every account."""
+        raise NotImplementedError
+
+    def get_channel(self, channel_id: str) -> dict:
+        """Also returns channels flagged as deleted which weren't purged yet (with `"deleted": True`)."""
+        raise NotImplementedError
+
+    def create_channel(self, channel_id: str, channel: dict, creator: str, encrypted_key: str, iv: str) -> None:
+        """Creates a channel with `creator` as its first member."""
+        raise NotImplementedError
+
+    def mark_channel_deleted(self, channel_id: str, acting_user: str) -> None:
+        """Flags a channel as deleted; members can't be added to or removed from it anymore.
+        The channel is purged later by `delete_channel`."""
+        raise NotImplementedError
+
+    def delete_channel(self, channel_id: str) -> None:
+        """Deletes a channel including its messages and removes it from every member. Does nothing if the channel
+        doesn't exist (anymore). Runs as a background job: it can be interrupted and must be safe to run again."""
+        raise NotImplementedError
+
+    def add_member(self, channel_id: str, acting_user: str, new_member: str, encrypted_key: str, iv: str) -> None:
+        """Raises `AlreadyMemberError` if `new_member` is in the channel already."""
+        raise NotImplementedError
+
+    def remove_member(self, channel_id: str, acting_user: str, member: str) -> None:
+        """Raises `NotMemberError` if `member` isn't in the channel."""
+        raise NotImplementedError
+
+    def export_messages(self, username: str) -> dict[str, list[bytes]]:
+        """Returns every (encoded) message written by a user, by channel ID, oldest first.
+        Includes channels the user isn't a member of anymore."""
+        raise NotImplementedError
+
+    def channel_summaries(self, username: str) -> dict[str, dict]:
+        """Returns `{"name": ..., "lastMessage": timestamp or None}` of every (not deleted) channel the user is in,
+        by channel ID. Called on every page load, so it must not read every channel."""
+        raise NotImplementedError
+
+    def messages_storing(self, channel_id: str, message_objs: list[dict]) -> None:
+        """Called right before messages are stored (one channel at a time, see write_coalescer.py), so indexes
+        like the author index record them first: a message which was stored must never be missing from them."""
+
+    def message_stored(self, channel_id: str, batch_id: int, message_obj: dict) -> None:
+        """Called after `message_obj` was stored in `batch_id`, so `latestMessageBatch` of the channel can be updated."""
+
+    def stats(self) -> dict:
+        return {}
+
+    def close(self) -> None:
+        """Called when the server shuts down."""
+
+
+class JSONStorage(Storage):
+    """The meta JSON files, read and written through `meta_cache`. Every read-modify-write of meta files
+    holds the locks of all files involved (account files are always locked before channel files).
+    `author_index` keeps track of the batches each user wrote in (see author_index.py).\n
+    For listing the channels of a user, the names and last message times of channels are kept in memory
+    (loaded on first use, then updated along with the channels); which channels a user is in is already
+    recorded in the (cached) account meta."""
+
+    def __init__(
+            self,
+            backend_dir: str,
+            meta_cache: JSONFileCache,
+            messages: MessageStore,
+            sessions: SessionStore,
+            author_index: AuthorIndex
+    ) -> None:
+        self.accounts_dir = os.path.join(backend_dir, "accounts")
+        self.channels_dir = os.path.join(backend_dir, "channels")
+        self.meta_cache = meta_cache
+        self.locks: PathLocks = meta_cache.locks
+        self.messages = messages
+        self.sessions = sessions
+        self.author_index = author_index
+        self._channel_names: dict[str, str] = {}
+        self._last_messages: dict[str, int] = {}
+        self._summaries_lock = threading.Lock()
+
+    def _account_file(self, username: str) -> str:
+        return os.path.join(self.accounts_dir, username, "meta.json")
+
+    def _channel_file(self, channel_id: str) -> str:
+        return os.path.join(self.channels_dir, channel_id, "meta.json")
+
+    def _read_account(self, username: str, mutable: bool = True) -> dict:
+        try:
+            return self.meta_cache.get(self._account_file(username), mutable)
+        except FileNotFoundError:
+            raise UnknownUserError(username)
+
+    def _read_channel(self, channel_id: str, mutable: bool = True) -> dict:
+        try:
+            return self.meta_cache.get(self._channel_file(channel_id), mutable)
+        except FileNotFoundError:
+            raise UnknownChannelError(channel_id)
+
+    def get_account(self, username: str) -> dict:
+        return self._read_account(username, mutable=False)
+
+    def create_account(self, username: str, account: dict) -> None:
+        account_file = self._account_file(username)
+        with self.locks.hold(account_file):
+            if os.path.exists(account_file):
+                raise AccountExistsError(username)
+            os.makedirs(os.path.dirname(account_file), exist_ok=True)
+            self.author_index.create(username)
+            self.meta_cache.write(account_file, account)
+
+    def set_password_hash(self, username: str, password_hash: str) -> None:
+        account_file = self._account_file(username)
+        with self.locks.hold(account_file):
+            account = self._read_account(username)
+            if account['deleted']:
+                return
+            account['passwordHash'] = password_hash
+            self.meta_cache.write(account_file, account)
+
+    def mark_account_deleted(self, username: str) -> None:
+        account_file = self._account_file(username)
+        with self.locks.hold(account_file):
+            account = self._read_account(username)
+            account['deleted'] = True
+            self.meta_cache.write(account_file, account)
+
+        self.sessions.revoke_all(username)
+
+    def delete_account(self, username: str) -> None:
+        account_file = self._account_file(username)
+
+        # Not holding the lock while revoking the sessions: the session store locks the account file itself
+        with self.locks.hold(account_file):
+            account = self._read_account(username, mutable=False)
+
+            # Only the batches the user wrote in are searched, including those of channels the user left.
+            # Accounts without author index: every batch of the channels the user is in
+            authored_batches = self.author_index.batches(username)
+            channel_ids = list(account['channels'])
+            if authored_batches is not None:
+                channel_ids += [channel_id for channel_id in authored_batches if channel_id not in account['channels']]
+
+            # Delete all messages from every channel, then remove the user from that channel as well
+            for channel_id in channel_ids:
+                is_member = channel_id in account['channels']
+                channel_file = self._channel_file(channel_id)
+                with self.locks.hold(channel_file):
+                    try:
+                        channel = self._read_channel(channel_id)
+                    except UnknownChannelError:   # channel doesn't exist for some reason (or was deleted after leaving it)
+                        if is_member:
+                            log.warning("missing_channel", channel=channel_id, username=username)
+                        continue
+
+                    batch_ids = None if authored_batches is None else authored_batches.get(channel_id, [])
+                    self.messages.remove_author(channel_id, username, batch_ids)
+
+                    if not is_member:
+                        continue
+                    if username not in channel['members']:
+                        log.warning("not_a_member", channel=channel_id, username=username)
+                        continue
+                    channel['members'].remove(username)
+                    try:
+                        self.meta_cache.write(channel_file, channel)
+                    except OSError:
+                        log.error("channel_write_failed", exc_info=True, channel=channel_id)
+
+            self.meta_cache.write(account_file, dict(DELETED_ACCOUNT))
+            self.author_index.remove(username)
+
+        self.sessions.revoke_all(username)
+
+    def pending_deletions(self) -> tuple[list[str], list[str]]:
+        usernames = []
+        for username in list_subdirs(self.accounts_dir):
+            try:
+                account = self._read_account(username, mutable=False)
+            except UnknownUserError:
+                continue
+            # Purged accounts are replaced by `DELETED_ACCOUNT`
+            if account['deleted'] and account['passwordHash'] != DELETED_ACCOUNT['passwordHash']:
+                usernames.append(username)
+
+        channel_ids = []
+        for channel_id in list_subdirs(self.channels_dir):
+            try:
+                channel = self._read_channel(channel_id, mutable=False)
+            except UnknownChannelError:
+                continue
+            if channel['deleted']:
+                channel_ids.append(channel_id)
+        return usernames, channel_ids
+
+    def get_channel(self, channel_id: str) -> dict:
+        return self._read_channel(channel_id, mutable=False)
+
+    def create_channel(self, channel_id: str, channel: dict, creator: str, encrypted_key: str, iv: str) -> None:
+        channel_file = self._channel_file(channel_id)
+        os.mkdir(os.path.dirname(channel_file))
+        self.meta_cache.write(channel_file, channel)
+        self.messages.create_channel(channel_id)
+        with self._summaries_lock:
+            self._channel_names[channel_id] = channel['name']
+
+        account_file = self._account_file(creator)
+        with self.locks.hold(account_file):
+            account = self._read_account(creator)
+            account['channels'][channel_id] = {"encryptedKey": encrypted_key, "iv": iv}
+            self.meta_cache.write(account_file, account)
+
+    def mark_channel_deleted(self, channel_id: str, acting_user: str) -> None:
+        channel_file = self._channel_file(channel_id)
+        with self.locks.hold(channel_file):
+            channel = self._read_channel(channel_id)
+            if channel['deleted']:
+                raise UnknownChannelError(channel_id)
+            if acting_user not in channel['members']:
+                raise PermissionDeniedError(acting_user)
+            channel['deleted'] = True
+            self.meta_cache.write(channel_file, channel)
+        self._forget_summary(channel_id)
+
+    def delete_channel(self, channel_id: str) -> None:
+        channel_file = self._channel_file(channel_id)
+        channel_dir = os.path.dirname(channel_file)
+
+        try:
+            channel = self._read_channel(channel_id, mutable=False)
+        except UnknownChannelError:   # purged already
+            return
+
+        # Remove the channel from every member's account first and the channel files last,
+        # so running this again after an interruption still finds the members
+        for username in channel['members']:
+            account_file = self._account_file(username)
+            with self.locks.hold(account_file):
+                try:
+                    account = self._read_account(username)
+                except UnknownUserError:   # user doesn't exist for some reason
+                    log.warning("missing_account", channel=channel_id, username=username)
+                    continue
+
+                if account['channels'].pop(channel_id, None) is None:   # removed in an earlier run
+                    continue
+
+                self.meta_cache.write(account_file, account)
+
+        if not channel_dir.strip() or len(channel_dir) < 20:
+            raise StorageError("Channel dir empty somehow; preventing deleting root!")
+
+        with self.locks.hold(channel_file):
+            try:
+                shutil.rmtree(channel_dir)
+            except FileNotFoundError:   # channel didn't exist in the first place
+                pass
+            self.messages.forget_channel(channel_id)
+        self._forget_summary(channel_id)
+
+    def add_member(self, channel_id: str, acting_user: str, new_member: str, encrypted_key: str, iv: str) -> None:
+        account_file = self._account_file(new_member)
+        channel_file = self._channel_file(channel_id)
+
+        with self.locks.hold(account_file, channel_file):
+            account = self._read_account(new_member)
+            if channel_id in account['channels']:
+                raise AlreadyMemberError(new_member)
+
+            channel = self._read_channel(channel_id)
+            if channel['deleted']:
+                raise UnknownChannelError(channel_id)
+            if acting_user not in channel['members']:
+                raise PermissionDeniedError(acting_user)
+
+            account['channels'][channel_id] = {"encryptedKey": encrypted_key, "iv": iv}
+            channel['members'].append(new_member)
+            self.meta_cache.write(account_file, account)
+            self.meta_cache.write(channel_file, channel)
+
+    def remove_member(self, channel_id: str, acting_user: str, member: str) -> None:
+        account_file = self._account_file(member)
+        channel_file = self._channel_file(channel_id)
+
+        with self.locks.hold(account_file, channel_file):
+            account = self._read_account(member)
+            if channel_id not in account['channels']:
+                raise NotMemberError(member)
+
+            channel = self._read_channel(channel_id)
+            if channel['deleted']:
+                raise UnknownChannelError(channel_id)
+            if acting_user not in channel['members']:
+                raise PermissionDeniedError(acting_user)
+            if member not in channel['members']:
+                raise NotMemberError(member)
+
+            del account['channels'][channel_id]
+            channel['members'].remove(member)
+            self.meta_cache.write(account_file, account)
+            self.meta_cache.write(channel_file, channel)
+
+    def export_messages(self, username: str) -> dict[str, list[bytes]]:
+        authored_batches = self.author_index.batches(username)
+        if authored_batches is None:   # account without author index: every batch of the channels the user is in
+            authored_batches = dict.fromkeys(self._read_account(username, mutable=False)['channels'])
+
+        messages = {}
+        for channel_id, batch_ids in authored_batches.items():
+            try:
+                lines = self.messages.read_author(channel_id, username, batch_ids)
+            except ChannelNotFoundError:   # deleted
+                continue
+            if lines:
+                messages[channel_id] = lines
+        return messages
+
+    def channel_summaries(self, username: str) -> dict[str, dict]:
+        account = self._read_account(username, mutable=False)
+        summaries = {}
+        for channel_id in account['channels']:
+            with self._summaries_lock:
+                name = self._channel_names.get(channel_id)
+                last_message = self._last_messages.get(channel_id)
+            if name is None:
+                name, last_message = self._load_summary(channel_id)
+                if name is None:   # deleted
+                    continue
+            summaries[channel_id] = {"name": name, "lastMessage": last_message}
+        return summaries
+
+    def _load_summary(self, channel_id: str) -> tuple[str | None, int | None]:
+        try:
+            channel = self._read_channel(channel_id, mutable=False)
+            if channel['deleted']:
+                return None, None
+            last_message = self.messages.last_timestamp(channel_id)
+        except (UnknownChannelError, ChannelNotFoundError):
+            return None, None
+
+        # Messages stored in the meantime have updated `_last_messages` already; the newer time wins
+        with self._summaries_lock:
+            self._channel_names[channel_id] = channel['name']
+            if last_message is not None:
+                self._last_messages[channel_id] = max(self._last_messages.get(channel_id, last_message), last_message)
+            return channel['name'], self._last_messages.get(channel_id)
+
+    def _forget_summary(self, channel_id: str) -> None:
+        with self._summaries_lock:
+            self._channel_names.pop(channel_id, None)
+            self._last_messages.pop(channel_id, None)
+
+    def messages_storing(self, channel_id: str, message_objs: list[dict]) -> None:
+        # Which batches the messages will end up in isn't known yet: record every batch they can go to
+        # (extra entries are harmless, see author_index.py)
+        latest_batch = self.messages.latest_batch(channel_id)
+        batch_ids = range(latest_batch, latest_batch + math.ceil(len(message_objs) / self.messages.batch_size) + 1)
+        for author in {message_obj['author'] for message_obj in message_objs}:
+            for batch_id in batch_ids:
+                self.author_index.add(author, channel_id, batch_id)
+
+    def message_stored(self, channel_id: str, batch_id: int, message_obj: dict) -> None:
+        with self._summaries_lock:
+            timestamp = message_obj['timestamp']
+            self._last_messages[channel_id] = max(self._last_messages.get(channel_id, timestamp), timestamp)
+
+        # The frontend gets the latest batch ID from the channel meta
+        if batch_id <= self._read_channel(channel_id, mutable=False)['latestMessageBatch']:
+            return
+
+        channel_file = self._channel_file(channel_id)
+        with self.locks.hold(channel_file):
+            channel = self._read_channel(channel_id, mutable=False)
+            if batch_id > channel['latestMessageBatch']:
+                self.meta_cache.write(channel_file, dict(channel, latestMessageBatch=batch_id))
+
+    def stats(self) -> dict:
+        return {"metaCache": self.meta_cache.stats()}
@@ -0,0 +1,72 @@
+"""Per-request span timing, to see where the time of a slow request went.
+
+The HTTP handler starts a `Trace` for every request (on the request's thread), and the code on the way marks
+what it is doing with `span(name)`: parsing the request, checking the session, hashing passwords, reading and
+writing files, broadcasting to websocket clients. Spans are exclusive: while a nested span runs (e.g. reading
+the sessions file while checking the session), the outer one is paused, so the spans never add up to more than
+the request took.
+The rest is the handler's own work (or waiting, e.g. for the write of a group of messages; see write_coalescer.py).
+
+Outside of a traced request (background threads, the websocket event loop), `span` does nothing.
+"""
+import threading
+import time
+
+_local = threading.local()
+
+
+class Trace:
+    __slots__ = ("started", "spans", "_stack")
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.spans: dict[str, float] = {}       # name -> seconds
+        self._stack: list[list] = []            # [name, started] of the running spans, innermost last
+
+    def enter(self, name: str) -> None:
+        now = time.perf_counter()
+        if self._stack:   # pause the outer span
+            outer = self._stack[-1]
+            self.spans[outer[0]] = self.spans.get(outer[0], 0.0) + now - outer[1]
+        self._stack.append([name, now])
+
+    def exit(self) -> None:
+        now = time.perf_counter()
+        name, started = self._stack.pop()
+        self.spans[name] = self.spans.get(name, 0.0) + now - started
+        if self._stack:
+            self._stack[-1][1] = now
+
+    def breakdown(self, duration: float) -> dict[str, float]:
+        """Milliseconds per span, plus "other" for the rest of `duration`."""
+        breakdown = {name: round(seconds * 1000, 2) for name, seconds in sorted(self.spans.items(), key=lambda item: -item[1])}
+        breakdown['other'] = round(max(0.0, duration - sum(self.spans.values())) * 1000, 2)
+        return breakdown
+
+
+class span:
+    """`with span("file_read"): ...` adds the time of the block to the current thread's trace, if there is one."""
+    __slots__ = ("name", "trace")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.trace = getattr(_local, "trace", None)
+
+    def __enter__(self) -> None:
+        if self.trace is not None:
+            self.trace.enter(self.name)
+
+    def __exit__(self, *exc_info) -> None:
+        if self.trace is not None:
+            self.trace.exit()
+
+
+def start() -> Trace:
+    trace = _local.trace = Trace()
+    return trace
+
+
+def finish() -> Trace | None:
+    trace = getattr(_local, "trace", None)
+    _local.trace = None
+    return trace
@@ -0,0 +1,258 @@
+"""Connected websocket clients and the fan-out of new messages to them."""
+import asyncio
+import concurrent.futures
+import json
+import time
+from collections import OrderedDict, deque
+
+from websockets import ConnectionClosed as WSConnectionClosed
+from websockets import WebSocketServerProtocol
+
+import logs
+import metrics
+
+log = logs.get_logger("websocket")
+
+
+class WSConnectedClient:
+    """One websocket connection. It authenticates once and can then subscribe to any number of channels."""
+    __slots__ = ("sock", "username", "token", "channel_ids", "send_queue", "sender_task")
+
+    def __init__(self, sock: WebSocketServerProtocol, send_queue_size: int) -> None:
+        self.sock = sock
+        self.username: str | None = None    # None until authenticated
+        self.token: str | None = None
+        self.channel_ids: set[str] = set()
+        self.send_queue: asyncio.Queue[str] = asyncio.Queue(send_queue_size)
+        self.sender_task: asyncio.Task | None = None
+
+    @property
+    def authenticated(self) -> bool:
+        return self.username is not None
+
+
+class WSClientRegistry:
+    """Index of the connected clients by socket and by subscribed channel. Only used on the websocket event loop.\n
+    A browser reconnecting with the same session replaces its old subscription to a channel,
+    in case the old socket isn't noticed to be dead yet."""
+
+    def __init__(self) -> None:
+        self._clients_by_sock: dict[WebSocketServerProtocol, WSConnectedClient] = {}
+        self._clients_by_channel: dict[str, set[WSConnectedClient]] = {}
+        self._clients_by_subscription: dict[tuple[str, str, str], WSConnectedClient] = {}
+
+    def __len__(self) -> int:
+        return len(self._clients_by_sock)
+
+    def add(self, client: WSConnectedClient) -> None:
+        self._clients_by_sock[client.sock] = client
+
+    def get(self, sock: WebSocketServerProtocol) -> WSConnectedClient | None:
+        return self._clients_by_sock.get(sock)
+
+    def clients_in(self, channel_id: str) -> set[WSConnectedClient]:
+        return self._clients_by_channel.get(channel_id, set())
+
+    def channel_client_counts(self) -> dict[str, int]:
+        return {channel_id: len(clients) for channel_id, clients in self._clients_by_channel.items()}
+
+    def subscribe(self, client: WSConnectedClient, channel_id: str) -> WSConnectedClient | None:
+        """Subscribes an authenticated client to a channel.
+        Returns the client of the same session whose subscription was replaced, if any."""
+        subscription = (client.username, client.token, channel_id)
+        replaced = self._clients_by_subscription.get(subscription)
+        if replaced is client:
+            return None
+        if replaced is not None:
+            self.unsubscribe(replaced, channel_id)
+
+        client.channel_ids.add(channel_id)
+        self._clients_by_channel.setdefault(channel_id, set()).add(client)
+        self._clients_by_subscription[subscription] = client
+        return replaced
+
+    def unsubscribe(self, client: WSConnectedClient, channel_id: str) -> None:
+        client.channel_ids.discard(channel_id)
+
+        channel_clients = self._clients_by_channel.get(channel_id)
+        if channel_clients is not None:
+            channel_clients.discard(client)
+            if not channel_clients:
+                del self._clients_by_channel[channel_id]
+
+        subscription = (client.username, client.token, channel_id)
+        if self._clients_by_subscription.get(subscription) is client:
+            del self._clients_by_subscription[subscription]
+
+    def remove(self, client: WSConnectedClient) -> None:
+        """Removes a client from every index. Cost is proportional to the number of channels it subscribed to."""
+        for channel_id in list(client.channel_ids):
+            self.unsubscribe(client, channel_id)
+        self._clients_by_sock.pop(client.sock, None)
+
+
+class _RecentMessage:
+    __slots__ = ("seq", "payload", "author", "payload_author")
+
+    def __init__(self, seq: int, payload: str, author: str, payload_author: str) -> None:
+        self.seq = seq
+        self.payload = payload
+        self.author = author
+        self.payload_author = payload_author
+
+
+class WSBroadcaster:
+    """Sends messages to websocket clients. All sending happens on the event loop of the websocket server.\n
+    HTTP request handlers run in other threads and must only call `publish`, which hands the message over
+    to the event loop. The payload is serialized once per message and put into the send queue of every
+    subscribed client. Each client's queue is drained by its own task, so one slow client doesn't delay the others;
+    a client whose queue runs full can't keep up and gets disconnected.\n
+    The last `replay_messages` messages of the `replay_channels` most recently active channels are kept,
+    so a client which reconnects can `resume` from the sequence number of the last message it got."""
+
+    def __init__(self, registry: WSClientRegistry, send_queue_size: int,
+                 replay_messages: int = 0, replay_channels: int = 0) -> None:
+        self.registry = registry
+        self.send_queue_size = send_queue_size
+        self.replay_messages = min(replay_messages, send_queue_size)
+        self.replay_channels = replay_channels
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self._recent: OrderedDict[str, deque[_RecentMessage]] = OrderedDict()   # least recently active first
+
+    def attach(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Sets the event loop the websocket server is running on."""
+        self.loop = loop
+
+    def register(self, sock: WebSocketServerProtocol) -> WSConnectedClient:
+        """Creates the client of a newly connected socket and starts its send queue. Must be called on the event loop."""
+        client = WSConnectedClient(sock, self.send_queue_size)
+        client.sender_task = asyncio.create_task(self._send_loop(client))
+        self.registry.add(client)
+        return client
+
+    def unregister(self, client: WSConnectedClient) -> None:
+        """Removes a client and stops its send queue. Must be called on the event loop."""
+        self.registry.remove(client)
+        client.sender_task.cancel()
+
+    def publish(self, channel_id: str, message_obj: dict, author: str, temp_id: str) -> None:
+        """Sends a new message to every client of a channel. Safe to call from any thread; returns immediately.\n
+        The author's own clients additionally get the `tempID` the message was sent with."""
+        if self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(self._fan_out, channel_id, message_obj, author, temp_id, time.perf_counter())
+
+    def client_counts(self, timeout: float = 1.0) -> tuple[int, dict[str, int]]:
+        """The number of connected clients, and of subscribed clients by channel ID. Safe to call from any thread."""
+        if self.loop is None:
+            return 0, {}
+        future = concurrent.futures.Future()
+        self.loop.call_soon_threadsafe(
+            lambda: future.set_result((len(self.registry), self.registry.channel_client_counts()))
+        )
+        return future.result(timeout)
+
+    def has_recent(self, channel_id: str) -> bool:
+        """Whether recent messages of a channel are kept. Must be called on the event loop."""
+        return bool(self._recent.get(channel_id))
+
+    def resume(self, client: WSConnectedClient, channel_id: str, last_seq: int, stored_seq: int | None = None) -> bool:
+        """Queues the messages of a channel after `last_seq` for a client which was just subscribed to it.
+        Must be called on the event loop, in the same step as the subscription, so no message is missed or sent twice.\n
+        `stored_seq` is the sequence number of the last stored message (see `WriteCoalescer.latest_sequence`),
+        needed if no recent messages are kept.
+        If the missed messages aren't known anymore, the client gets `{"resync": channel_id}` instead and has
+        to load them over HTTP; returns whether the messages could be replayed."""
+        recent = self._recent.get(channel_id)
+        if recent:
+            resumable = recent[0].seq <= last_seq + 1 and last_seq <= recent[-1].seq
+        else:
+            resumable = stored_seq is not None and stored_seq == last_seq
+
+        if resumable:
+            replayed = [message for message in recent or () if message.seq > last_seq]
+            payloads = [message.payload_author if message.author == client.username else message.payload
+                        for message in replayed]
+        else:
+            payloads = [json.dumps({"resync": channel_id})]
+
+        try:
+            for payload in payloads:
+                client.send_queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            log.warning("slow_client_evicted", username=client.username, client=str(client.sock.id))
+            metrics.WS_SLOW_CLIENTS.inc()
+            self._evict(client)
+            return False
+        if resumable:
+            metrics.WS_MESSAGES_QUEUED.inc(amount=len(payloads))
+        return resumable
+
+    def _fan_out(self, channel_id: str, message_obj: dict, author: str, temp_id: str, published: float) -> None:
+        clients = self.registry.clients_in(channel_id)
+        keep = self.replay_messages > 0 and 'seq' in message_obj
+        if not clients and not keep:
+            return
+
+        payload = json.dumps(message_obj)
+        payload_author = json.dumps(dict(message_obj, tempID=temp_id))
+        if keep:
+            self._remember(channel_id, _RecentMessage(message_obj['seq'], payload, author, payload_author))
+
+        queued = 0
+        for client in list(clients):
+            try:
+                client.send_queue.put_nowait(payload_author if client.username == author else payload)
+                queued += 1
+            except asyncio.QueueFull:
+                log.warning("slow_client_evicted", username=client.username, client=str(client.sock.id))
+                metrics.WS_SLOW_CLIENTS.inc()
+                self._evict(client)
+
+        metrics.WS_MESSAGES_QUEUED.inc(amount=queued)
+        metrics.WS_FAN_OUT_SECONDS.observe(time.perf_counter() - published)
+
+    def _remember(self, channel_id: str, message: _RecentMessage) -> None:
+        recent = self._recent.get(channel_id)
+        if recent is None:
+            recent = self._recent[channel_id] = deque(maxlen=self.replay_messages)
+            if len(self._recent) > self.replay_channels:
+                self._recent.popitem(last=False)
+        else:
+            self._recent.move_to_end(channel_id)
+        # The write coalescer publishes the messages of a channel in the order of their sequence numbers
+        recent.append(message)
+
+    def forget(self, channel_id: str) -> None:
+        """Drops the recent messages of a deleted channel. Safe to call from any thread."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._recent.pop, channel_id, None)
+
+    def forget_author(self, username: str) -> None:
+        """Drops the recent messages of a deleted account, so they aren't replayed. Safe to call from any thread."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._forget_author, username)
+
+    def _forget_author(self, username: str) -> None:
+        # Leaves gaps in the sequence numbers; `resume` answers with "resync" when a gap is at either end
+        for channel_id, recent in list(self._recent.items()):
+            kept = [message for message in recent if message.author != username]
+            if len(kept) == len(recent):
+                continue
+            if kept:
+                self._recent[channel_id] = deque(kept, maxlen=self.replay_messages)
+            else:
+                del self._recent[channel_id]
+
+    def _evict(self, client: WSConnectedClient) -> None:
+        self.unregister(client)
+        asyncio.create_task(client.sock.close(1013, "Client too slow"))
+
+    @staticmethod
+    async def _send_loop(client: WSConnectedClient) -> None:
+        while True:
+            payload = await client.send_queue.get()
+            try:
+                await client.sock.send(payload)
+            except WSConnectionClosed:
+                return
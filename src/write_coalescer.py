@@ -0,0 +1,173 @@
+"""Group commit for new messages: messages sent to the same channel at about the same time are stored with one write.
+
+The first request to send a message to a channel becomes the leader of a group. It waits `delay` seconds
+for more messages to arrive, then stores all of them with a single `MessageStore.append_many` call and wakes up
+the other requests of its group. Messages arriving while a group is being written start the next group,
+so with `delay=0` only the messages arriving during a write are grouped.
+
+Since the groups of a channel are written one at a time, this is also where the order of the messages is decided:
+every message gets the next sequence number of its channel (`seq`, stored with the message) right before its group
+is written. Sequence numbers increase by one per message. After a restart, or if a write fails, a channel
+continues from the highest number the message store has seen, deleted messages included (`MessageStore.latest_sequence`).
+"""
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable
+
+from message_store import MessageStore
+
+# Upper bounds of the histogram buckets; everything larger goes into the last ("+Inf") bucket
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+FLUSH_SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+class Histogram:
+    """Counts observed values in buckets with fixed upper bounds (like a Prometheus histogram)."""
+    __slots__ = ("bounds", "counts", "count", "sum", "max")
+
+    def __init__(self, bounds: tuple) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def to_json(self) -> dict:
+        labels = [str(bound) for bound in self.bounds] + ["+Inf"]
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+class _PendingMessage:
+    __slots__ = ("message_obj", "after_store", "batch_id", "error")
+
+    def __init__(self, message_obj: dict, after_store: Callable[[], None] | None) -> None:
+        self.message_obj = message_obj
+        self.after_store = after_store
+        self.batch_id: int | None = None
+        self.error: Exception | None = None
+
+
+class _ChannelQueue:
+    __slots__ = ("pending", "done", "flush_lock")
+
+    def __init__(self, lock: threading.Lock) -> None:
+        self.pending: list[_PendingMessage] = []   # the group that is still collecting messages
+        self.done = threading.Condition(lock)      # notified when a group was written
+        self.flush_lock = threading.Lock()         # only one group of a channel is written at a time
+
+
+class WriteCoalescer:
+    """Collects the messages sent to a channel for `delay` seconds and stores them with one write.
+    `before_store(channel_id, message_objs)` is called right before each write, with the group's messages,
+    e.g. to index them first; if it raises, the group isn't written."""
+
+    def __init__(
+            self,
+            message_store: MessageStore,
+            delay: float,
+            before_store: Callable[[str, list[dict]], None] | None = None
+    ) -> None:
+        self.message_store = message_store
+        self.delay = delay
+        self.before_store = before_store
+        self._channels: dict[str, _ChannelQueue] = {}
+        self._sequences: dict[str, int] = {}   # channel ID -> sequence number of the last stored message
+        self._lock = threading.Lock()
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.flush_seconds = Histogram(FLUSH_SECONDS_BUCKETS)
+        self.failed_flushes = 0
+
+    def append(self, channel_id: str, message_obj: dict, after_store: Callable[[], None] | None = None) -> int:
+        """Stores a message and returns the ID of the batch it was put in, once it was written.
+        Raises what `MessageStore.append_many` raised if the write of its group failed.\n
+        `after_store` is called right after the write, before any later message of the channel is stored,
+        so messages are e.g. broadcast in the order they were stored."""
+        pending = _PendingMessage(message_obj, after_store)
+
+        with self._lock:
+            channel_queue = self._channels.get(channel_id)
+            if channel_queue is None:
+                channel_queue = self._channels[channel_id] = _ChannelQueue(self._lock)
+            channel_queue.pending.append(pending)
+            leader = len(channel_queue.pending) == 1
+
+        if leader:
+            self._lead(channel_id, channel_queue)
+        else:
+            with channel_queue.done:
+                while pending.batch_id is None and pending.error is None:
+                    channel_queue.done.wait()
+
+        if pending.error is not None:
+            raise pending.error
+        return pending.batch_id
+
+    def _lead(self, channel_id: str, channel_queue: _ChannelQueue) -> None:
+        if self.delay > 0:
+            time.sleep(self.delay)
+
+        with channel_queue.flush_lock:
+            with self._lock:
+                group, channel_queue.pending = channel_queue.pending, []
+
+            start = time.perf_counter()
+            try:
+                sequence = self._sequences.get(channel_id)
+                if sequence is None:
+                    sequence = self.message_store.latest_sequence(channel_id)
+                for pending in group:
+                    sequence += 1
+                    pending.message_obj['seq'] = sequence
+                message_objs = [pending.message_obj for pending in group]
+                if self.before_store is not None:
+                    self.before_store(channel_id, message_objs)
+                batch_ids = self.message_store.append_many(channel_id, message_objs)
+                self._sequences[channel_id] = sequence
+            except Exception as e:
+                batch_ids = None
+                self._sequences.pop(channel_id, None)   # some of the messages may have been stored
+                for pending in group:
+                    pending.error = e
+            elapsed = time.perf_counter() - start
+
+            if batch_ids is not None:
+                for pending, batch_id in zip(group, batch_ids):
+                    pending.batch_id = batch_id
+                    if pending.after_store is not None:
+                        pending.after_store()
+
+            with self._lock:
+                if batch_ids is None:
+                    self.failed_flushes += 1
+                self.batch_sizes.observe(len(group))
+                self.flush_seconds.observe(elapsed)
+                if not channel_queue.pending:
+                    del self._channels[channel_id]
+                channel_queue.done.notify_all()
+
+    def latest_sequence(self, channel_id: str) -> int:
+        """The sequence number of the last stored message of a channel, including deleted messages (0 if there is none).
+        Reads it from the message store unless a message was stored in the channel since the server started."""
+        sequence = self._sequences.get(channel_id)
+        return self.message_store.latest_sequence(channel_id) if sequence is None else sequence
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "delay": self.delay,
+                "batchSize": self.batch_sizes.to_json(),
+                "flushSeconds": self.flush_seconds.to_json(),
+                "failedFlushes": self.failed_flushes,
+            }
@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+
+import pytest
+
+from durable_writes import DurableWriter
+from message_store import MESSAGE_STORES, BatchNotFoundError, LogMessageStore, format_cursor, parse_cursor
+
+BATCH_SIZE = 3
+CHANNEL_ID = "1700000000000000001"
+
+
+def message(author: str, seq: int, timestamp: int = 1000) -> dict:
+    return {"author": author, "text": f"{author} {seq}", "timestamp": timestamp, "seq": seq}
+
+
+def texts(lines: list[bytes]) -> list[str]:
+    return [json.loads(line)['text'] for line in lines]
+
+
+@pytest.fixture(params=sorted(MESSAGE_STORES))
+def open_store(request, tmp_path):
+    def open_store():
+        return MESSAGE_STORES[request.param](str(tmp_path), BATCH_SIZE, DurableWriter("none"))
+    return open_store
+
+
+@pytest.fixture
+def store(open_store):
+    store = open_store()
+    os.mkdir(store.channel_dir(CHANNEL_ID))   # created by the storage, along with the channel meta
+    store.create_channel(CHANNEL_ID)
+    return store
+
+
+def test_messages_fill_batches(store):
+    assert store.latest_batch(CHANNEL_ID) == 1
+    assert store.append_many(CHANNEL_ID, [message("alice", seq) for seq in range(1, 5)]) == [1, 1, 1, 2]
+    assert store.append(CHANNEL_ID, message("bob", 5)) == 2
+
+    assert store.latest_batch(CHANNEL_ID) == 2
+    assert [m['seq'] for m in store.read_batch(CHANNEL_ID, 1)] == [1, 2, 3]
+    assert [m['seq'] for m in store.read_batch(CHANNEL_ID, 2)] == [4, 5]
+    assert json.loads(store.read_batch_raw(CHANNEL_ID, 2)) == store.read_batch(CHANNEL_ID, 2)
+    assert store.last_timestamp(CHANNEL_ID) == 1000
+    with pytest.raises(BatchNotFoundError):
+        store.read_batch(CHANNEL_ID, 3)
+
+
+def test_read_before_pages_backwards(store):
+    store.append_many(CHANNEL_ID, [message("alice", seq, timestamp=seq) for seq in range(1, 8)])
+
+    lines, cursor = store.read_before(CHANNEL_ID, None, 4)
+    assert texts(lines) == ["alice 4", "alice 5", "alice 6", "alice 7"]
+    lines, cursor = store.read_before(CHANNEL_ID, cursor, 4)
+    assert texts(lines) == ["alice 1", "alice 2", "alice 3"] and cursor is None
+
+    lines, cursor = store.read_before(CHANNEL_ID, None, 10, since=6)
+    assert texts(lines) == ["alice 6", "alice 7"] and cursor is None
+
+
+def test_remove_author(store):
+    store.append_many(CHANNEL_ID, [message(author, seq) for seq, author in enumerate(["alice", "bob"] * 3, 1)])
+
+    assert store.remove_author(CHANNEL_ID, "alice") == 3
+    assert store.read_author(CHANNEL_ID, "alice") == []
+    assert texts(store.read_author(CHANNEL_ID, "bob")) == ["bob 2", "bob 4", "bob 6"]
+    assert store.remove_author(CHANNEL_ID, "bob", batch_ids=[2]) == 2
+    assert texts(store.read_author(CHANNEL_ID, "bob")) == ["bob 2"]
+
+
+def test_latest_sequence_includes_deleted_messages(store, open_store):
+    assert store.latest_sequence(CHANNEL_ID) == 0
+    store.append_many(CHANNEL_ID, [message("bob", 1), message("alice", 2), message("alice", 3)])
+    store.remove_author(CHANNEL_ID, "alice")
+
+    # As after a restart: nothing of the channel is in memory yet
+    reopened = open_store()
+    assert reopened.latest_sequence(CHANNEL_ID) == 3
+    assert [m['seq'] for m in reopened.read_batch(CHANNEL_ID, 1)] == [1]
+
+
+def test_batch_version_changes_with_batch(store):
+    store.append(CHANNEL_ID, message("alice", 1))
+    etag, _ = store.batch_version(CHANNEL_ID, 1)
+    store.append(CHANNEL_ID, message("alice", 2))
+    assert store.batch_version(CHANNEL_ID, 1)[0] != etag
+
+
+def test_cursor_round_trip():
+    assert parse_cursor(format_cursor((3, 0))) == (3, 0)
+    for cursor in ("", "3", "0.1", "1.-1", "a.b", "1.2.3"):
+        with pytest.raises(ValueError):
+            parse_cursor(cursor)
+
+
+def test_log_is_loaded_once(tmp_path):
+    store = LogMessageStore(str(tmp_path), BATCH_SIZE, DurableWriter("none"))
+    os.mkdir(store.channel_dir(CHANNEL_ID))
+    store.create_channel(CHANNEL_ID)
+    store.append_many(CHANNEL_ID, [message("alice", seq) for seq in range(1, 100)])
+
+    # Concurrent first reads after a restart share one loaded log
+    reopened = LogMessageStore(str(tmp_path), BATCH_SIZE, DurableWriter("none"))
+    loaded = []
+    load = reopened._load
+    reopened._load = lambda channel_id: loaded.append(channel_id) or load(channel_id)
+    threads = [threading.Thread(target=reopened.latest_batch, args=(CHANNEL_ID,)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert loaded == [CHANNEL_ID]
+    assert reopened.latest_batch(CHANNEL_ID) == 33
@@ -0,0 +1,61 @@
+import pytest
+
+from router import Router
+
+
+class Handler:
+    def plain(self): ...
+    def channel(self, channel_id: str, query_components: dict): ...
+    def batch(self, channel_id: str, batch_id: int, token: str, username: str): ...
+    def send(self, post_data: dict): ...
+
+
+@pytest.fixture
+def router() -> Router:
+    router = Router()
+    router.add("GET", "/server_stats", Handler.plain)
+    router.add("GET", "/channels/<digits:channel_id>", Handler.channel)
+    router.add("GET", "/channels/<digits:channel_id>/batches/<int:batch_id>", Handler.batch, auth=True)
+    router.add_prefix_error("GET", "/channels", 400, "Invalid channel ID or URI.")
+    router.add("POST", "/send_message", Handler.send, body={"text": str}, body_error="Needs 'text'.")
+    return router
+
+
+def test_exact_route(router):
+    route, params = router.match("GET", "/server_stats")
+    assert route.handler is Handler.plain and params == {}
+    assert router.match("GET", "/server_stats/")[0] is route
+
+
+def test_parameters_are_converted(router):
+    route, params = router.match("GET", "/channels/0012/batches/7/")
+    assert route.handler is Handler.batch
+    assert params == {"channel_id": "0012", "batch_id": 7}
+    assert route.auth and route.request_args == ("token", "username")
+
+
+def test_request_args_of_handler(router):
+    assert router.match("GET", "/channels/12")[0].request_args == ("query_components",)
+    route, _ = router.match("POST", "/send_message")
+    assert route.request_args == ("post_data",) and route.body == {"text": str} and route.body_error == "Needs 'text'."
+
+
+@pytest.mark.parametrize("path", ["/channels/12a", "/channels/-1", "/channels/..", "/channels/1/../2", "/channels/12/x"])
+def test_invalid_channel_ids_get_prefix_error(router, path):
+    assert router.match("GET", path) == (None, (400, "Invalid channel ID or URI."))
+
+
+def test_no_route(router):
+    assert router.match("GET", "/index.html") == (None, None)
+    assert router.match("POST", "/server_stats") == (None, None)
+    assert router.match("POST", "/channels/12") == (None, None)
+
+
+def test_body_needs_post_data():
+    with pytest.raises(ValueError):
+        Router().add("POST", "/send_message", Handler.plain, body={"text": str})
+
+
+def test_first_segment_has_to_be_literal():
+    with pytest.raises(ValueError):
+        Router().add("GET", "/<digits:channel_id>", Handler.channel)
@@ -0,0 +1,41 @@
+import pytest
+
+import server
+from storage import UnknownChannelError
+
+
+@pytest.mark.parametrize("channel_id", ["1700000000000000001", "1", "007"])
+def test_valid_channel_ids(channel_id):
+    assert server.validate_channel_id(channel_id)
+
+
+@pytest.mark.parametrize("channel_id", ["", "1/", "1/.", "../channels/1", "./1", " 1", "1 ", "-1", "1e3", "١٢", None, 1])
+def test_channel_ids_which_would_alias_others(channel_id):
+    # Used in file paths and as dict keys: they must not name the same channel as another ID
+    assert not server.validate_channel_id(channel_id)
+
+
+@pytest.mark.parametrize("path", ["/channels/1/../2", "/channels/1%2F..%2F2", "/channels/١"])
+def test_channel_routes_take_digits_only(path):
+    assert server.routes.match("GET", path) == (None, (400, "Invalid channel ID or URI."))
+
+
+class FakeStorage:
+    channels = {
+        "1": {"members": ["alice", "bob"], "deleted": False},
+        "2": {"members": ["alice"], "deleted": True},
+    }
+
+    def get_channel(self, channel_id: str) -> dict:
+        try:
+            return self.channels[channel_id]
+        except KeyError:
+            raise UnknownChannelError(channel_id)
+
+
+def test_websocket_subscriptions_need_membership(monkeypatch):
+    monkeypatch.setattr(server, "storage", FakeStorage())
+    assert server.is_channel_member("1", "bob")
+    assert not server.is_channel_member("1", "carol")
+    assert not server.is_channel_member("2", "alice")   # deleted
+    assert not server.is_channel_member("3", "alice")
@@ -0,0 +1,84 @@
+import json
+import os
+import time
+
+import pytest
+
+from durable_writes import DurableWriter
+from file_locks import PathLocks
+from meta_cache import JSONFileCache
+from sessions import SessionStore, UnknownUserError
+
+TTL = 60
+
+
+@pytest.fixture
+def accounts_dir(tmp_path):
+    accounts_dir = tmp_path / "accounts"
+    for username in ("alice", "bob"):
+        (accounts_dir / username).mkdir(parents=True)
+        (accounts_dir / username / "meta.json").write_text(json.dumps({"displayname": username, "channels": {}}))
+    return accounts_dir
+
+
+def open_sessions(accounts_dir, max_sessions_per_user: int = 3) -> SessionStore:
+    writer = DurableWriter("none")
+    return SessionStore(str(accounts_dir), JSONFileCache(16, PathLocks(), writer), writer, TTL, max_sessions_per_user)
+
+
+def test_sessions_are_persisted(accounts_dir):
+    sessions = open_sessions(accounts_dir)
+    sessions.add("alice", "hash1")
+    assert sessions.validate("alice", "hash1")
+    assert not sessions.validate("alice", "hash2")
+    assert not sessions.validate("bob", "hash1")
+
+    reopened = open_sessions(accounts_dir)
+    assert reopened.validate_cached("alice", "hash1") is None   # not loaded yet
+    assert reopened.validate("alice", "hash1")
+    assert reopened.validate_cached("alice", "hash1") is True
+    assert reopened.validate_cached("alice", "hash2") is False
+
+
+def test_unknown_user(accounts_dir):
+    with pytest.raises(UnknownUserError):
+        open_sessions(accounts_dir).validate("carol", "hash1")
+
+
+def test_oldest_sessions_are_dropped(accounts_dir):
+    sessions = open_sessions(accounts_dir, max_sessions_per_user=2)
+    for token_hash in ("hash1", "hash2", "hash3"):
+        sessions.add("alice", token_hash)
+    assert [sessions.validate("alice", token_hash) for token_hash in ("hash1", "hash2", "hash3")] == [False, True, True]
+
+
+def test_expired_sessions(accounts_dir):
+    (accounts_dir / "alice" / "sessions.json").write_text(json.dumps({"old": int(time.time()) - TTL - 1, "new": int(time.time())}))
+    sessions = open_sessions(accounts_dir)
+    assert not sessions.validate("alice", "old")
+    assert sessions.validate("alice", "new")
+    assert set(json.loads((accounts_dir / "alice" / "sessions.json").read_text())) == {"new"}
+
+
+def test_revoke(accounts_dir):
+    sessions = open_sessions(accounts_dir)
+    for token_hash in ("hash1", "hash2", "hash3"):
+        sessions.add("alice", token_hash)
+    sessions.add("bob", "hash4")
+
+    sessions.revoke_all_except("alice", "hash2")
+    assert [sessions.validate("alice", token_hash) for token_hash in ("hash1", "hash2", "hash3")] == [False, True, False]
+    sessions.revoke_all("alice")
+    assert not sessions.validate("alice", "hash2")
+    assert sessions.validate("bob", "hash4")
+    assert not open_sessions(accounts_dir).validate("alice", "hash2")
+
+
+def test_legacy_tokens_are_migrated(accounts_dir):
+    meta_file = accounts_dir / "alice" / "meta.json"
+    meta_file.write_text(json.dumps({"displayname": "alice", "channels": {}, "validTokens": ["hash1"]}))
+
+    assert open_sessions(accounts_dir).validate("alice", "hash1")
+    assert "validTokens" not in json.loads(meta_file.read_text())
+    assert os.path.exists(accounts_dir / "alice" / "sessions.json")
+    assert open_sessions(accounts_dir).validate("alice", "hash1")
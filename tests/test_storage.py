@@ -0,0 +1,150 @@
+import json
+import os
+
+import pytest
+
+from author_index import AuthorIndex
+from durable_writes import DurableWriter
+from file_locks import PathLocks
+from message_store import LogMessageStore
+from meta_cache import JSONFileCache
+from sessions import SessionStore, UnknownUserError
+from sqlite_storage import SQLiteStorage
+from storage import JSONStorage, PermissionDeniedError, UnknownChannelError
+from write_coalescer import WriteCoalescer
+
+BATCH_SIZE = 3
+CHANNEL_ID = "1700000000000000001"
+OTHER_CHANNEL_ID = "1700000000000000002"
+
+
+def open_json_storage(backend_dir: str) -> JSONStorage:
+    writer = DurableWriter("none")
+    locks = PathLocks()
+    meta_cache = JSONFileCache(64, locks, writer)
+    accounts_dir = os.path.join(backend_dir, "accounts")
+    return JSONStorage(
+        backend_dir, meta_cache,
+        LogMessageStore(os.path.join(backend_dir, "channels"), BATCH_SIZE, writer),
+        SessionStore(accounts_dir, meta_cache, writer, 60, 8),
+        AuthorIndex(accounts_dir, locks, writer),
+    )
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def storage(request, tmp_path):
+    if request.param == "sqlite":
+        storage = SQLiteStorage(str(tmp_path / "pigon.sqlite3"), BATCH_SIZE, "none", 60, 8)
+    else:
+        (tmp_path / "accounts").mkdir()
+        (tmp_path / "channels").mkdir()
+        storage = open_json_storage(str(tmp_path))
+
+    for username in ("alice", "bob", "carol"):
+        storage.create_account(username, {
+            "displayname": username, "accountCreated": 1000, "passwordHash": "hash", "deleted": False,
+            "publicKey": "key", "channels": {},
+        })
+    for channel_id in (CHANNEL_ID, OTHER_CHANNEL_ID):
+        storage.create_channel(channel_id, {
+            "name": f"channel {channel_id[-1]}", "timestampCreated": 1000, "members": ["alice"],
+            "latestMessageBatch": 1, "deleted": False,
+        }, "alice", "encrypted key", "iv")
+        storage.add_member(channel_id, "alice", "bob", "encrypted key", "iv")
+    yield storage
+    storage.close()
+
+
+def send(storage, channel_id: str, author: str, count: int = 1) -> None:
+    # Like the server does it: indexed by `messages_storing` before storing, `message_stored` afterwards
+    coalescer = WriteCoalescer(storage.messages, 0, storage.messages_storing)
+    for _ in range(count):
+        message_obj = {"author": author, "text": f"by {author}", "timestamp": 1000}
+        batch_id = coalescer.append(channel_id, message_obj)
+        storage.message_stored(channel_id, batch_id, message_obj)
+
+
+def authors(lines: list[bytes]) -> list[str]:
+    return [json.loads(line)['author'] for line in lines]
+
+
+def test_members(storage):
+    assert storage.get_channel(CHANNEL_ID)['members'] == ["alice", "bob"]
+    assert set(storage.get_account("bob")['channels']) == {CHANNEL_ID, OTHER_CHANNEL_ID}
+
+    with pytest.raises(PermissionDeniedError):
+        storage.add_member(CHANNEL_ID, "carol", "carol", "encrypted key", "iv")
+    storage.remove_member(CHANNEL_ID, "bob", "bob")
+    assert storage.get_channel(CHANNEL_ID)['members'] == ["alice"]
+    assert set(storage.get_account("bob")['channels']) == {OTHER_CHANNEL_ID}
+    with pytest.raises(UnknownChannelError):
+        storage.get_channel("1700000000000000003")
+
+
+def test_delete_account(storage):
+    send(storage, CHANNEL_ID, "alice", 2)
+    send(storage, CHANNEL_ID, "bob", 3)
+    send(storage, OTHER_CHANNEL_ID, "bob")
+    storage.remove_member(OTHER_CHANNEL_ID, "bob", "bob")
+
+    storage.mark_account_deleted("bob")
+    assert storage.pending_deletions() == (["bob"], [])
+    storage.delete_account("bob")
+
+    assert storage.pending_deletions() == ([], [])
+    assert storage.get_account("bob")['deleted']
+    assert storage.get_channel(CHANNEL_ID)['members'] == ["alice"]
+    # Including the messages in channels bob had left already
+    assert storage.export_messages("bob") == {}
+    assert authors(storage.messages.read_before(CHANNEL_ID, None, 10)[0]) == ["alice", "alice"]
+    assert storage.messages.read_before(OTHER_CHANNEL_ID, None, 10)[0] == []
+    assert storage.messages.latest_sequence(CHANNEL_ID) == 5
+
+
+def test_delete_channel(storage):
+    send(storage, CHANNEL_ID, "bob")
+    with pytest.raises(PermissionDeniedError):
+        storage.mark_channel_deleted(CHANNEL_ID, "carol")
+
+    storage.mark_channel_deleted(CHANNEL_ID, "alice")
+    assert storage.pending_deletions() == ([], [CHANNEL_ID])
+    storage.delete_channel(CHANNEL_ID)
+
+    assert storage.pending_deletions() == ([], [])
+    assert set(storage.get_account("bob")['channels']) == {OTHER_CHANNEL_ID}
+    assert storage.export_messages("bob") == {}
+
+
+def test_channel_summaries(storage):
+    send(storage, OTHER_CHANNEL_ID, "alice", BATCH_SIZE + 1)
+    summaries = storage.channel_summaries("bob")
+    assert set(summaries) == {CHANNEL_ID, OTHER_CHANNEL_ID}
+    assert storage.get_channel(OTHER_CHANNEL_ID)['latestMessageBatch'] == 2
+
+
+def test_sessions_of_unknown_users(storage):
+    with pytest.raises(UnknownUserError):
+        storage.sessions.validate("dave", "hash")
+
+
+def test_author_index_is_written_before_the_messages(tmp_path):
+    (tmp_path / "accounts").mkdir()
+    (tmp_path / "channels").mkdir()
+    storage = open_json_storage(str(tmp_path))
+    storage.create_account("alice", {
+        "displayname": "alice", "accountCreated": 1000, "passwordHash": "hash", "deleted": False,
+        "publicKey": "key", "channels": {},
+    })
+    storage.create_channel(CHANNEL_ID, {
+        "name": "channel", "timestampCreated": 1000, "members": ["alice"], "latestMessageBatch": 1, "deleted": False,
+    }, "alice", "encrypted key", "iv")
+
+    # As if the server stopped right after storing, before the broadcast and `message_stored`
+    message_objs = [{"author": "alice", "text": "hi", "timestamp": 1000, "seq": seq} for seq in range(1, 5)]
+    storage.messages_storing(CHANNEL_ID, message_objs)
+    storage.messages.append_many(CHANNEL_ID, message_objs)
+
+    reopened = open_json_storage(str(tmp_path))
+    assert {1, 2} <= set(reopened.author_index.batches("alice")[CHANNEL_ID])
+    reopened.delete_account("alice")
+    assert reopened.messages.read_author(CHANNEL_ID, "alice") == []
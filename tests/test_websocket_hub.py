@@ -0,0 +1,96 @@
+import asyncio
+import json
+
+from websocket_hub import WSBroadcaster, WSClientRegistry, WSConnectedClient
+
+CHANNEL_ID = "1700000000000000001"
+
+
+class FakeSocket:
+    id = "fake"
+
+
+def received(client: WSConnectedClient) -> list[dict]:
+    payloads = []
+    while not client.send_queue.empty():
+        payloads.append(json.loads(client.send_queue.get_nowait()))
+    return payloads
+
+
+def run_with_broadcaster(test) -> None:
+    async def main():
+        broadcaster = WSBroadcaster(WSClientRegistry(), send_queue_size=16, replay_messages=8, replay_channels=4)
+        broadcaster.attach(asyncio.get_running_loop())
+        await test(broadcaster)
+    asyncio.run(main())
+
+
+def connect(username: str) -> WSConnectedClient:
+    client = WSConnectedClient(FakeSocket(), 16)
+    client.username = username
+    client.token = "token"
+    return client
+
+
+async def publish(broadcaster: WSBroadcaster, authors: list[str]) -> None:
+    for seq, author in enumerate(authors, 1):
+        broadcaster.publish(CHANNEL_ID, {"author": author, "text": "hi", "seq": seq}, author, f"temp{seq}")
+    await asyncio.sleep(0)   # `publish` hands over to the event loop
+
+
+def test_resume_replays_missed_messages():
+    async def test(broadcaster):
+        await publish(broadcaster, ["alice", "bob", "alice"])
+
+        client = connect("alice")
+        assert broadcaster.resume(client, CHANNEL_ID, 1)
+        assert [(m['seq'], m.get('tempID')) for m in received(client)] == [(2, None), (3, "temp3")]
+
+        assert broadcaster.resume(client, CHANNEL_ID, 3)
+        assert received(client) == []
+    run_with_broadcaster(test)
+
+
+def test_resume_asks_for_resync_when_messages_are_unknown():
+    async def test(broadcaster):
+        client = connect("bob")
+        assert not broadcaster.resume(client, CHANNEL_ID, 0)   # nothing kept, and the stored sequence isn't known
+        assert received(client) == [{"resync": CHANNEL_ID}]
+        assert broadcaster.resume(client, CHANNEL_ID, 5, stored_seq=5)
+        assert received(client) == []
+
+        await publish(broadcaster, ["alice"] * 10)
+        assert not broadcaster.resume(client, CHANNEL_ID, 1)   # only the last 8 are kept
+        assert received(client) == [{"resync": CHANNEL_ID}]
+    run_with_broadcaster(test)
+
+
+def test_messages_of_deleted_accounts_are_not_replayed():
+    async def test(broadcaster):
+        await publish(broadcaster, ["alice", "bob", "alice", "bob"])
+        broadcaster.forget_author("alice")
+        await asyncio.sleep(0)
+
+        client = connect("bob")
+        assert not broadcaster.resume(client, CHANNEL_ID, 0)
+        assert received(client) == [{"resync": CHANNEL_ID}]
+        assert broadcaster.resume(client, CHANNEL_ID, 2)
+        assert [m['author'] for m in received(client)] == ["bob"]
+
+        broadcaster.forget_author("bob")
+        await asyncio.sleep(0)
+        assert not broadcaster.has_recent(CHANNEL_ID)
+    run_with_broadcaster(test)
+
+
+def test_fan_out_to_subscribed_clients():
+    async def test(broadcaster):
+        alice, bob, carol = connect("alice"), connect("bob"), connect("carol")
+        for client in (alice, bob):
+            broadcaster.registry.subscribe(client, CHANNEL_ID)
+        await publish(broadcaster, ["alice"])
+
+        assert received(alice) == [{"author": "alice", "text": "hi", "seq": 1, "tempID": "temp1"}]
+        assert received(bob) == [{"author": "alice", "text": "hi", "seq": 1}]
+        assert received(carol) == []
+    run_with_broadcaster(test)
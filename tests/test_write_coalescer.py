@@ -0,0 +1,87 @@
+import os
+import threading
+
+import pytest
+
+from durable_writes import DurableWriter
+from message_store import LogMessageStore
+from write_coalescer import WriteCoalescer
+
+CHANNEL_ID = "1700000000000000001"
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = LogMessageStore(str(tmp_path), 30, DurableWriter("none"))
+    os.mkdir(store.channel_dir(CHANNEL_ID))
+    store.create_channel(CHANNEL_ID)
+    return store
+
+
+def message(author: str) -> dict:
+    return {"author": author, "text": "hi", "timestamp": 1000}
+
+
+def send_concurrently(coalescer: WriteCoalescer, count: int, after_store=None) -> list[dict]:
+    message_objs = [message(f"user{i}") for i in range(count)]
+    threads = [
+        threading.Thread(target=coalescer.append, args=(CHANNEL_ID, message_obj, after_store and after_store(message_obj)))
+        for message_obj in message_objs
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return message_objs
+
+
+def test_concurrent_messages_are_grouped(store):
+    coalescer = WriteCoalescer(store, 0.05)
+    stored_order = []
+    send_concurrently(coalescer, 20, lambda message_obj: lambda: stored_order.append(message_obj['seq']))
+
+    stored = store.read_batch(CHANNEL_ID, 1)
+    assert [m['seq'] for m in stored] == list(range(1, 21))
+    assert stored_order == list(range(1, 21))   # `after_store` is called in the stored order
+    assert coalescer.stats()["batchSize"]["count"] < 20
+    assert coalescer.latest_sequence(CHANNEL_ID) == 20
+
+
+def test_sequence_continues_after_restart(store):
+    WriteCoalescer(store, 0).append(CHANNEL_ID, message("alice"))
+    store.remove_author(CHANNEL_ID, "alice")
+
+    message_obj = message("bob")
+    WriteCoalescer(store, 0).append(CHANNEL_ID, message_obj)
+    assert message_obj['seq'] == 2
+
+
+def test_before_store_sees_the_group_first(store):
+    calls = []
+
+    def before_store(channel_id, message_objs):
+        calls.append(([m['seq'] for m in message_objs], len(store.read_batch(channel_id, 1))))
+
+    send_concurrently(WriteCoalescer(store, 0.05, before_store), 5)
+
+    assert sorted(seq for seqs, _ in calls for seq in seqs) == [1, 2, 3, 4, 5]
+    stored = 0
+    for seqs, stored_before in calls:   # called before each group is stored
+        assert stored_before == stored
+        stored += len(seqs)
+
+
+def test_failed_before_store_stores_nothing(store):
+    def fail(channel_id, message_objs):
+        raise OSError("index not writable")
+
+    coalescer = WriteCoalescer(store, 0, fail)
+    with pytest.raises(OSError):
+        coalescer.append(CHANNEL_ID, message("alice"))
+    assert store.read_batch(CHANNEL_ID, 1) == []
+    assert coalescer.stats()["failedFlushes"] == 1
+
+    coalescer.before_store = None
+    message_obj = message("alice")
+    coalescer.append(CHANNEL_ID, message_obj)
+    assert message_obj['seq'] == 1